@@ -4,38 +4,77 @@ import asyncio
 import os
 
 import view
+from scheduler import Scheduler
 from downloader import Downloader, filter_videos, read_source_file
+from journal import Journal
+from listing import ListingIndex
+from rcd import Rcd
+from source_files import SizeIndex
+from verify import Verifier
 
 
 async def download(args, hub):
-	downloader = Downloader(hub=hub, prefix='dl', output_dir=args.output,
-	                        output_file=args.map_output,
-	                        server_map_file=args.server_map, dry_run=args.dry_run)
-	all_videos = read_source_file(filename=args.source, tsv=args.tab_separated)
-	args.server_map.close()
+	size_index = SizeIndex(args.size_index) if args.size_index else None
+	journal = Journal(args.journal) if args.journal else None
+	verifier = Verifier(args.verify_jobs) if args.verify else None
+	rcd = Rcd(bwlimit=args.bwlimit) if args.rcd else None
+	listing = ListingIndex(args.listing_index, ttl=args.listing_ttl * 60 * 60) \
+		if args.listing_index else None
+	try:
+		downloader = Downloader(hub=hub, prefix='dl', output_dir=args.output,
+		                        output_file=args.map_output,
+		                        server_map_file=args.server_map, dry_run=args.dry_run,
+		                        size_index=size_index, bwlimit=args.bwlimit,
+		                        merge_jobs=args.merge_jobs, journal=journal, listing=listing,
+		                        exact=args.exact, verifier=verifier, rcd=rcd,
+		                        scheduler=Scheduler(total=args.jobs, per_server=args.server_jobs,
+		                                            per_remote=args.remote_jobs))
+		all_videos = read_source_file(filename=args.source, tsv=args.tab_separated)
+		args.server_map.close()
+
+		if listing and args.refresh_listing:
+			remotes = [x for rclone_servers in downloader.server_map.values()
+			           for x in rclone_servers]
+			for remote, error in (await listing.update(remotes, force=True)).items():
+				print(f"Couldn't list {remote}: {error}", file=args.log_output)
 
-	job_options = {'download': not args.delete_instead, 'delete': args.delete_instead or args.move}
+		job_options = {'download': not args.delete_instead,
+		               'delete': args.delete_instead or args.move}
 
-	tasks = []
+		tasks = []
 
-	if args.delete:
-		tasks.append(downloader.download(filter_videos(all_videos, 'delete'),
-		                                 download=False, delete=True, keys=['delete']))
-	if args.keep:
-		tasks.append(downloader.download_and_merge(
-			filter_videos(all_videos, 'keep'), **job_options, keys=['keep']))
-	if args.archive:
-		tasks.append(downloader.download(filter_videos(all_videos, 'archive'), **job_options,
-		                                 keys=['inspect']))
-	if args.inspect:
-		tasks.append(downloader.download(filter_videos(all_videos, 'inspect'), **job_options,
-		                                 keys=['inspect']))
-	if args.merge:
-		tasks.append(downloader.download_and_merge(
-			filter_videos(all_videos, 'subs', 'audio', 'audio+video', 'video', 'video+subs',
-			              'audio+subs'), **job_options, keys=['merge']))
+		if args.delete:
+			tasks.append(downloader.download(filter_videos(all_videos, 'delete'),
+			                                 download=False, delete=True, keys=['delete']))
+		if args.keep:
+			tasks.append(downloader.download_and_merge(
+				filter_videos(all_videos, 'keep'), **job_options, pipeline=args.pipeline,
+				keys=['keep']))
+		if args.archive:
+			tasks.append(downloader.download(filter_videos(all_videos, 'archive'), **job_options,
+			                                 keys=['inspect']))
+		if args.inspect:
+			tasks.append(downloader.download(filter_videos(all_videos, 'inspect'), **job_options,
+			                                 keys=['inspect']))
+		if args.merge:
+			tasks.append(downloader.download_and_merge(
+				filter_videos(all_videos, 'subs', 'audio', 'audio+video', 'video', 'video+subs',
+				              'audio+subs'), **job_options, pipeline=args.pipeline, keys=['merge']))
 
-	await asyncio.gather(*tasks)
+		if rcd:
+			await rcd.start()
+		await asyncio.gather(*tasks)
+	finally:
+		if rcd:
+			await rcd.stop()
+		if size_index:
+			size_index.close()
+		if journal:
+			journal.close()
+		if listing:
+			listing.close()
+		if verifier:
+			verifier.close()
 
 	args.map_output.close()
 	args.log_output.close()
@@ -59,6 +98,9 @@ def main():
 	parser.add_argument('-m', '--merge', action='store_true',
 	                    help='Download, merge, and rename files with the results "audio", '
 	                         '"video+subs", etc.')
+	parser.add_argument('-p', '--pipeline', action='store_true',
+	                    help="With -k or -m, merge each video as soon as its files have been "
+	                         "downloaded, while the rest are still downloading")
 	parser.add_argument('-t', '--tab-separated', action='store_true',
 	                    help='Interpret input file as UTF-16 TSV rather than UTF-8 CSV')
 	parser.add_argument('--map-output', nargs='?', type=argparse.FileType('a'), default=os.devnull,
@@ -69,8 +111,51 @@ def main():
 	parser.add_argument('-n', '--dry-run', action='store_true',
 	                    help="Perform a dry run")
 	parser.add_argument('--server-map', help="Server map CSV file", type=argparse.FileType('r'))
+	parser.add_argument('-j', '--jobs', type=int,
+	                    help="maximum number of rclone processes to run at once (default: no "
+	                         "limit)")
+	parser.add_argument('--server-jobs', type=int,
+	                    help="maximum number of rclone processes to run at once for each server")
+	parser.add_argument('--remote-jobs', type=int,
+	                    help="maximum number of rclone processes to run at once for each rclone "
+	                         "remote")
+	parser.add_argument('--bwlimit',
+	                    help="bandwidth limit for each rclone process, in the format of rclone's "
+	                         "--bwlimit (like 10M)")
+	parser.add_argument('--merge-jobs', type=int,
+	                    help="maximum number of videos to merge at once (default: half the CPU "
+	                         "cores, up to 4)")
+	parser.add_argument('--journal',
+	                    help="SQLite file recording what has been downloaded, merged and deleted, "
+	                         "so an interrupted run can be resumed by running it again")
+	parser.add_argument('--listing-index',
+	                    help="SQLite file caching 'rclone lsjson' listings of each rclone server, "
+	                         "so each one is only asked for the files it has")
+	parser.add_argument('--listing-ttl', type=float, default=24,
+	                    help="hours before an rclone server in --listing-index is listed again "
+	                         "(default: 24)")
+	parser.add_argument('--refresh-listing', action='store_true',
+	                    help="list every rclone server in --listing-index again now")
+	parser.add_argument('--exact', action='store_true',
+	                    help="give rclone the exact paths of the files found in --listing-index "
+	                         "with --files-from, instead of filters it checks against every file")
+	parser.add_argument('--verify', action='store_true',
+	                    help="check each downloaded file against the server by MD5 hash, or by "
+	                         "size where the server has no hash, before merging it, and with -M "
+	                         "only delete the files that match from the server")
+	parser.add_argument('--verify-jobs', type=int, default=4,
+	                    help="maximum number of files to hash at once with --verify (default: 4)")
+	parser.add_argument('--rcd', action='store_true',
+	                    help="run transfers as jobs in one 'rclone rcd' daemon, instead of "
+	                         "starting an rclone process for each one. --bwlimit is then for all "
+	                         "of them together")
+	parser.add_argument('--size-index',
+	                    help="size index built by vidinfo.py --size-index, for files with no Size "
+	                         "in the source file")
 
 	args = parser.parse_args()
+	if args.exact and not args.listing_index:
+		parser.error("--exact needs --listing-index to find the paths of the files")
 	hub = aiopubsub.Hub()
 
 	ui = view.DownloadView(logfile=args.log_output, hub=hub)
@@ -3,33 +3,36 @@ import unicodedata
 import aiopubsub
 import asyncio
 import csv
+import functools
+import json
 import os
 import re
-import subprocess
 import uuid
 from humanize import naturalsize
 
-from merge import merge as merge_videos, remove_ext, ext, IMAGE_FILES
+from merge import merge_async as merge_videos, remove_ext, ext, IMAGE_FILES
+from scheduler import Scheduler, remote_name
+from verify import remote_files
+from source_files import iter_parquet_rows, parse_row
 
 
 def _create_filter_files(videos, include_videos=True, include_thumbnails=True,
-                         include_metadata=False):
+                         include_metadata=False, exclude_videos=()):
 	"""
 	Create filter files to select files from rsync.
 	:param include_metadata: Whether to include json files as well as video files
 	:param include_thumbnails: Whether to include thumbnail files as well as video files
 	:param videos: Videos to download
+	:param exclude_videos: Filenames of videos whose video files aren't wanted, only their
+	thumbnails and json files
 	:return: dictionary mapping server name to path to relevant file
 	"""
 	filter_map = {}  # server -> list of filters
-	add_extensions = IMAGE_FILES.copy() if include_thumbnails else []
-	if include_metadata:
-		add_extensions.append('*.json')
-
 	for v in videos:
-		extensions = add_extensions.copy()
-		if include_videos:
-			extensions.append(ext(v['Filename']))
+		extensions = _filter_extensions(v, include_videos, include_thumbnails, include_metadata,
+		                                exclude_videos)
+		if not extensions:
+			continue
 		if v['Server'] not in filter_map:
 			filter_map[v['Server']] = []
 		filter_map[v['Server']].append(
@@ -45,9 +48,52 @@ def _create_filter_files(videos, include_videos=True, include_thumbnails=True,
 	return filter_files
 
 
+def _create_file_list(paths):
+	"""
+	Create a file for rclone's --files-from
+	:param paths: exact paths of the files to select, relative to the root of the server
+	:return: path to the file
+	"""
+	filename = 'temp/' + str(uuid.uuid4())
+	with open(filename, 'w') as file:
+		file.writelines(f"{x}\n" for x in paths)
+	return filename
+
+
+def _filter_extensions(video, include_videos=True, include_thumbnails=True,
+                       include_metadata=False, exclude_videos=()):
+	"""
+	:return: list of the extensions of the files of a video to select, like _create_filter_files.
+	"*.json" stands for any json file.
+	"""
+	extensions = IMAGE_FILES.copy() if include_thumbnails else []
+	if include_metadata:
+		extensions.append('*.json')
+	if include_videos and video['Filename'] not in exclude_videos:
+		extensions.append(ext(video['Filename']))
+	return extensions
+
+
+def _group_by_destination(videos):
+	"""
+	Group videos that will be merged into the same file
+	:param videos: list of videos
+	:return: a dict like {new_filename(video): [videos]}
+	"""
+	destinations = {}
+	for video in videos:
+		target = new_filename(video)
+		if target not in destinations:
+			destinations[target] = []
+		destinations[target].append(video)
+	return destinations
+
+
 class Downloader:
 	def __init__(self, server_map_file, hub, prefix, output_dir='.', output_file=None,
-	             dry_run=False):
+	             dry_run=False, size_index=None, stats_interval='2s', scheduler=None,
+	             bwlimit=None, merge_jobs=None, journal=None, listing=None, exact=False,
+	             verifier=None, rcd=None):
 		"""
 		Initialize the downloader.
 		:param server_map_file: A server map file opened for reading
@@ -56,11 +102,41 @@ class Downloader:
 		:param output_dir: where to download to
 		:param output_file: An output file opened for writing
 		:param dry_run: Whether to do a dry run
+		:param size_index: SizeIndex to look up sizes missing from the source file (optional)
+		:param stats_interval: how often rclone reports transfer progress, like "2s"
+		:param scheduler: Scheduler limiting how many rclone processes run at once (optional)
+		:param bwlimit: bandwidth limit for each rclone process, in rclone's --bwlimit format
+		:param merge_jobs: maximum number of videos to merge at once (default: default_merge_jobs)
+		:param journal: Journal to record progress in and resume from (optional)
+		:param listing: ListingIndex of the files on each rclone server, so each one is only asked
+		for the files it has (optional)
+		:param exact: Whether to give rclone the exact paths of the files found in listing rather
+		than filters, so it looks up just those files instead of checking every file on the server
+		:param verifier: Verifier to check each downloaded file against the server before it's
+		merged or deleted from the server (optional)
+		:param rcd: started Rcd to run transfers as jobs in, rather than starting an rclone process
+		for each one (optional)
 		"""
 		self.__read_server_map(server_map_file)
+		self.size_index = size_index
+		self.journal = journal
+		self.listing = listing
+		self.exact = exact
+		self.verifier = verifier
+		self.rcd = rcd
+		self.unverified = set()  # (server name, path) of files that didn't match the server
+		self.stats_interval = stats_interval
+		self.scheduler = scheduler or Scheduler()
+		self.scheduler.on_change = lambda running, queued: self.__pub(
+			self.SchedulerMessage(running, queued), ['scheduler'])
+		self.task_stats = {}  # keys of each running rclone task -> its latest StatsMessage
+		self.finished_bytes = 0  # bytes transferred by rclone tasks that have finished
+		self.bwlimit = bwlimit
 		self.output_file = csv.writer(output_file)
 		self.dry_run = dry_run
 		self.output_dir = output_dir
+		self.merge_jobs = merge_jobs or default_merge_jobs()
+		self.merge_slots = None
 		self.publisher = aiopubsub.Publisher(hub, aiopubsub.Key(prefix))
 		if not os.path.exists('temp'):
 			os.makedirs('temp')
@@ -79,67 +155,89 @@ class Downloader:
 			server_map[row[0]].append(row[1])
 		self.server_map = server_map
 
+	def __size_map(self, videos):
+		"""
+		Get the sizes of videos from the source file, or the size index if they're missing
+		:param videos: list of videos
+		:return: a dict like {"video1.mkv": 40186938}
+		"""
+		size_map = {}
+		for v in videos:
+			if v['Size'] is not None:
+				size_map[v['Filename']] = v['Size']
+			elif self.size_index:
+				size = self.size_index.get(v['Filename'])
+				if size is not None:
+					size_map[v['Filename']] = size
+		return size_map
+
 	def __pub(self, message, keys):
 		self.publisher.publish(aiopubsub.Key(*keys), message)
 
-	async def run_rclone(self, server, destination, action, filter_file, keys, video_sizes=None):
+	def __pub_throughput(self):
+		running = self.task_stats.values()
+		self.__pub(self.ThroughputMessage(self.finished_bytes + sum(x.bytes for x in running),
+		                                  sum(x.speed for x in running), len(running)),
+		           ['throughput'])
+
+	async def run_rclone(self, server, destination, action, filter_file, keys, video_sizes=None,
+	                     server_name=None, on_file=None, files_from=False):
 		"""
-		Run rclone with the given parameters.
+		Run rclone with the given parameters, once the scheduler has a slot for it.
 		Sends messages corresponding to total
 		:param server: Which server to connect to
+		:param server_name: The server in the server map that server belongs to
 		:param destination: Destination to which to download
 		:param action: What to do
 		:param filter_file: Filter file
 		:param video_sizes: Video size map (optional)
 		:param keys: message keys
+		:param on_file: called with the path of each file that has been transferred or was
+		already there (optional)
+		:param files_from: Whether filter_file is a list of exact paths rather than filters
 		"""
-		command = ['rclone', action, '-vvn' if self.dry_run else '-vv', '--include-from',
-		           filter_file, server]
+		command = ['rclone', action, '-vv', '--use-json-log', '--stats', self.stats_interval,
+		           *(['--files-from', filter_file, '--no-traverse'] if files_from
+		             else ['--include-from', filter_file]), server]
+		if self.dry_run:
+			command.insert(2, '-n')
+		if self.bwlimit:
+			command[2:2] = ['--bwlimit', self.bwlimit]
 		if action != 'delete':
 			command.append(destination)
+		async with self.scheduler.slot(server_name, remote_name(server)):
+			try:
+				if self.rcd:
+					await self.__run_rcd_job(server, destination, action, filter_file, keys,
+					                         video_sizes, on_file, server_name, files_from)
+				else:
+					await self.__run_rclone_process(command, action, keys, video_sizes, on_file,
+					                                server_name, server)
+			finally:
+				stats = self.task_stats.pop(tuple(keys), None)
+				if stats:
+					self.finished_bytes += stats.bytes
+					self.__pub_throughput()
+
+	async def __run_rclone_process(self, command, action, keys, video_sizes, on_file,
+	                               server_name, server):
 		self.__pub(self.NewTaskMessage(command=' '.join(command)), keys)
 
 		p = await asyncio.create_subprocess_exec(*command, stderr=asyncio.subprocess.PIPE)
 
+		credited_bytes = {}  # video file -> bytes already sent in progress messages
 		while True:
 			data = await p.stderr.readline()
 			if data:
 				line = data.decode('utf-8').rstrip()
-
-				log_level = None
-				event = None
-				file = None
-				items = None
-				size = None
-				try:
-					log_level = line[:line.index(': ')][-7:].strip()
-					event = line[line.rfind(': ') + 2:]
-					file = line[line.index(': ') + 2:line.rfind(': ')]
-				except ValueError:
-					pass
-
-				if log_level and (event.endswith('--dry-run')
-				                  or event.endswith('skipping')  # Already downloaded; add to totals
-				                  or (event == 'Deleted' and action == 'delete')
-				                  or event.startswith('Copied')
-				                  or event.startswith('Multi-thread Copied')):
-					# Something significant happened
-					extension = ext(file)
-					if extension not in IMAGE_FILES and not extension.endswith('json'):
-						# Something happened to a video file so add it to the totals
-						items = 1
-						if video_sizes:
-							size = video_sizes.get(file, 0)
-				elif log_level == 'DEBUG':
-					# Ignore the unimportant debug message
+				# Debug messages are needed to see skipped files, but there are a lot of them, so
+				# don't bother decoding the rest
+				if '"level":"debug"' in line and 'skipping' not in line:
 					continue
-
-				# Send a message with deltas for total progress where applicable, plus rclone output
-				self.__pub(self.ProgressMessage(line, items, size), keys)
-			elif p.returncode is None:
-				await asyncio.sleep(10)  # Process is paused; wait for it to come back
+				self.__handle_rclone_log(parse_rclone_log(line), action, keys, video_sizes,
+				                         credited_bytes, on_file, server_name, server)
 			else:
-				break
+				break  # rclone closed stderr, so it's exiting
 
 		await p.wait()
 
@@ -147,51 +245,341 @@ class Downloader:
 		if p.returncode != 0:
 			raise RuntimeError(f'rclone exited with return code {p.returncode}')
 
-	async def download(self, videos, keys, download=True, delete=False):
+	async def download(self, videos, keys, download=True, delete=False, on_file=None):
 		"""
 		Download videos
 		:param videos: Videos to download
 		:param keys: message keys
 		:param download: Whether to perform the download
 		:param delete: Whether to delete the files from the server
+		:param on_file: called with the path of each file once it's been downloaded (optional).
+		If given, thumbnails and json files are all downloaded before any videos.
 		"""
-		# TODO: use locale.atoi (wasn't working)
-		size_map = {v['Filename']: int(v['Size'].strip().replace(',', '')) for v in videos if
-		            v['Size']} if download else None
+		size_map = self.__size_map(videos) if download else None
 
 		self.__pub(self.NewTaskMessage(
 			total_items=len(videos), total_bytes=sum(size_map.values()) if size_map else None),
 			keys)
 
+		done = self.__journaled(videos, download, delete)
+		for filename in done:
+			self.__pub(self.ProgressMessage(f"{filename}: already done, according to the journal",
+			                                1, size_map.get(filename) if size_map else None), keys)
+
+		unlisted = set()
+		if self.listing:
+			remotes = [x for server in dict.fromkeys(v['Server'] for v in videos)
+			           for x in self.server_map[server]]
+			for remote, error in (await self.listing.update(remotes)).items():
+				self.__pub(f"Couldn't list {remote}, so every file will be looked for there: "
+				           f"{error}", keys)
+				unlisted.add(remote)
+
 		tasks = []
-		if download:
-			rclone_action = 'move' if delete else 'copy'
-			filter_files = _create_filter_files(videos, include_metadata=not delete)
-			for server, filter_file in filter_files.items():
-				for rclone_server in self.server_map[server]:
-					tasks.append(
-						self.run_rclone(rclone_server, self.output_dir, rclone_action, filter_file,
-						                video_sizes=size_map, keys=(*keys, f't{len(tasks)}')))
-			if delete:
-				# Get just metadata files, which should not be deleted
-				metadata_filter_files = _create_filter_files(
-					videos, include_videos=False, include_thumbnails=False, include_metadata=True)
-				for server, filter_file in metadata_filter_files.items():
-					for rclone_server in self.server_map[server]:
-						tasks.append(
-							self.run_rclone(rclone_server, self.output_dir, 'copy', filter_file,
-							                video_sizes=size_map, keys=(*keys, f't{len(tasks)}')))
-		elif delete:
-			filter_files = _create_filter_files(videos, include_metadata=False)
-			for server, filter_file in filter_files.items():
-				for rclone_server in self.server_map[server]:
+		task_count = 0
+		temp_files = []
+
+		def add_tasks(action, destination=self.output_dir, **filter_options):
+			nonlocal task_count
+			for server, rclone_servers, remote_videos, paths in self.__routes(videos, unlisted,
+			                                                                  **filter_options):
+				files_from = self.exact and paths is not None
+				if files_from:
+					filter_file = _create_file_list(paths)
+				else:
+					filter_file = _create_filter_files(remote_videos, **filter_options).get(server)
+				if not filter_file:
+					continue
+				temp_files.append(filter_file)
+				for rclone_server in rclone_servers:
+					run = self.__verified_transfer if self.verifier and action != 'delete' \
+						else self.run_rclone
 					tasks.append(
-						self.run_rclone(rclone_server, None, 'delete', filter_file,
-						                keys=(*keys, f't{len(tasks)}')))
-
-		await asyncio.gather(*tasks)
+						run(rclone_server, destination, action, filter_file,
+						    video_sizes=size_map, keys=(*keys, f't{task_count}'),
+						    server_name=server, on_file=on_file, files_from=files_from))
+					task_count += 1
+
+		try:
+			if download:
+				rclone_action = 'move' if delete else 'copy'
+				if on_file:
+					# Attachments first, so each video can be merged as soon as it's downloaded.
+					# They mustn't be in the same transfer as the videos, or one merged (and so
+					# deleted) before rclone gets to it would be downloaded again.
+					add_tasks(rclone_action, include_videos=False, include_metadata=not delete)
+					if delete:
+						add_tasks('copy', include_videos=False, include_thumbnails=False,
+						          include_metadata=True)
+					await asyncio.gather(*tasks)
+					tasks.clear()
+					for filename in done:
+						on_file(filename)
+					add_tasks(rclone_action, include_thumbnails=False, exclude_videos=done)
+				else:
+					add_tasks(rclone_action, include_metadata=not delete, exclude_videos=done)
+					if delete:
+						# Get just metadata files, which should not be deleted
+						add_tasks('copy', include_videos=False, include_thumbnails=False,
+						          include_metadata=True)
+			elif delete:
+				add_tasks('delete', None, include_metadata=False, exclude_videos=done)
+
+			await asyncio.gather(*tasks)
+		finally:
+			for filename in temp_files:
+				os.remove(filename)
 		self.__pub(self.CompletedMessage(), keys)
 
+	async def __run_rcd_job(self, server, destination, action, filter_file, keys, video_sizes,
+	                        on_file, server_name, files_from):
+		"""
+		Run a transfer as a job in self.rcd, publishing the same messages as an rclone process.
+		Files are reported as they show up in core/transferred, but that only keeps the last few,
+		so what happened to every file is worked out afterwards from listings of the files the
+		filter selects on the server before and after the job.
+		"""
+		rc_command = {'copy': 'sync/copy', 'move': 'sync/move',
+		              'delete': 'operations/delete'}[action]
+		params = {'fs': server} if action == 'delete' else {'srcFs': server, 'dstFs': destination}
+		params['_filter'] = {'FilesFrom': [filter_file]} if files_from \
+			else {'IncludeFrom': [filter_file]}
+		config = {}
+		if files_from:
+			config['NoTraverse'] = True
+		if self.dry_run:
+			config['DryRun'] = True
+		if config:
+			params['_config'] = config
+		description = f"rclone rc {rc_command} {json.dumps(params)}"
+		self.__pub(self.NewTaskMessage(command=description), keys)
+
+		credited_bytes = {}  # video file -> bytes already sent in progress messages
+		seen = set()  # files already reported
+		handle = functools.partial(self.__handle_rclone_log, action=action, keys=keys,
+		                           video_sizes=video_sizes, credited_bytes=credited_bytes,
+		                           on_file=on_file, server_name=server_name, server=server)
+
+		def on_update(stats, transferred):
+			for item in transferred:
+				file = item.get('name')
+				if not file or file in seen:
+					continue
+				seen.add(file)
+				if item.get('error'):
+					handle({'level': 'error', 'msg': item['error'], 'object': file})
+				elif action == 'delete':
+					handle({'level': 'info', 'msg': 'Deleted', 'object': file})
+				else:
+					# Files that were already there are only checked
+					handle({'level': 'info', 'object': file,
+					        'msg': 'Unchanged skipping' if item.get('checked') else 'Copied (new)'})
+			handle({'level': 'info', 'msg': '', 'stats': stats})
+
+		selected = await self.rcd.list_files(server, _filter=params['_filter'])
+		status = await self.rcd.run_job(rc_command, params, on_update)
+		if self.dry_run:
+			for file in sorted(set(selected).difference(seen)):
+				handle({'level': 'notice', 'msg': f"Skipped {action} as --dry-run is set",
+				        'object': file})
+		else:
+			# Even a failed job can have finished with some files
+			remaining = selected if action == 'copy' else await self.rcd.list_files(
+				server, _filter=params['_filter'])
+			for file, size in sorted(selected.items()):
+				if action != 'delete' and file not in seen and downloaded(
+						os.path.join(destination, file), size):
+					seen.add(file)
+					handle({'level': 'info', 'msg': 'Copied (found after the job)',
+					        'object': file})
+				if action != 'copy' and file not in remaining and not (
+						action == 'delete' and file in seen):
+					handle({'level': 'info', 'msg': 'Deleted', 'object': file})
+
+		exitcode = 0 if status.get('success') else 1
+		self.__pub(self.CompletedMessage(command=description, exitcode=exitcode), keys)
+		if exitcode:
+			raise RuntimeError(f"rclone rc {rc_command} failed: {status.get('error')}")
+
+	def __handle_rclone_log(self, log, action, keys, video_sizes, credited_bytes, on_file,
+	                        server_name, server):
+		"""
+		Publish progress for a line of rclone's log, and record what happened to files
+		:param log: the line, parsed by parse_rclone_log
+		:param credited_bytes: dict of the bytes of each video file already sent in progress
+		messages, which is updated
+		"""
+		if 'stats' in log:
+			stats = self.StatsMessage(log['stats'])
+			self.__pub(stats, keys)
+			self.task_stats[tuple(keys)] = stats
+			self.__pub_throughput()
+			# Credit the bytes transferred so far, so big files don't sit at 0% until done
+			new_bytes = 0
+			for transfer in stats.transferring:
+				if is_video(transfer.name):
+					new_bytes += transfer.bytes - credited_bytes.get(transfer.name, 0)
+					credited_bytes[transfer.name] = transfer.bytes
+			if new_bytes:
+				self.__pub(self.ProgressMessage(None, processed_bytes=new_bytes), keys)
+			return
+
+		event = log.get('msg', '')
+		file = log.get('object')
+		if file and event == 'Deleted' and self.listing and not self.dry_run:
+			self.listing.remove(server, file)
+		if file and self.journal and not self.dry_run:
+			if event == 'Deleted':
+				self.journal.record(server_name, file, 'deleted')
+			elif action != 'delete' and (event.endswith('skipping')
+			                             or event.startswith('Copied')
+			                             or event.startswith('Multi-thread Copied')):
+				self.journal.record(server_name, file, 'transferred')
+		items = None
+		size = None
+		if file and ('--dry-run' in event
+		             or event.endswith('skipping')  # Already downloaded; add to totals
+		             or (event == 'Deleted' and action == 'delete')
+		             or event.startswith('Copied')
+		             or event.startswith('Multi-thread Copied')):
+			# Something significant happened
+			if is_video(file):
+				# Something happened to a video file so add it to the totals
+				items = 1
+				if video_sizes:
+					size = max(0, video_sizes.get(file, 0) - credited_bytes.pop(file, 0))
+			if on_file and action != 'delete':
+				on_file(file)
+		elif log['level'] == 'debug':
+			# Ignore the unimportant debug message
+			return
+
+		# Send a message with deltas for total progress where applicable, plus rclone output
+		self.__pub(self.ProgressMessage(format_rclone_log(log), items, size), keys)
+
+	async def __verified_transfer(self, server, destination, action, filter_file, keys,
+	                              video_sizes=None, server_name=None, on_file=None,
+	                              files_from=False):
+		"""
+		Copy files like run_rclone, checking each one against the server while the rest are still
+		being copied. With the action "move", only the files that match are then deleted from the
+		server. Files that don't match aren't passed to on_file.
+		"""
+		remote = asyncio.ensure_future(remote_files(server, filter_file, files_from))
+		checks = []
+		verified = []
+
+		async def check(path):
+			if not self.dry_run:
+				try:
+					error = await self.verifier.verify(os.path.join(destination, path),
+					                                   (await remote).get(path))
+				except Exception as ex:
+					error = f"couldn't check it: {ex}"
+				if error:
+					self.unverified.add((server_name, path))
+					self.__pub(self.ProgressMessage(
+						f"ERROR: {path}: {error}" + (f"; not deleting it from {server}"
+						                             if action == 'move' else '')), keys)
+					return
+				if self.journal:
+					self.journal.record(server_name, path, 'verified')
+			verified.append(path)
+			if on_file:
+				on_file(path)
+
+		def on_copied(path):
+			checks.append(asyncio.ensure_future(check(path)))
+
+		try:
+			await self.run_rclone(server, destination, 'copy', filter_file, keys, video_sizes,
+			                      server_name, on_copied, files_from)
+		finally:
+			# Files copied before an error can still be checked and deleted
+			await asyncio.gather(*checks)
+			if action == 'move' and verified:
+				delete_list = _create_file_list(verified)
+				try:
+					await self.run_rclone(server, None, 'delete', delete_list, keys,
+					                      server_name=server_name, files_from=True)
+				finally:
+					os.remove(delete_list)
+			if not remote.done():
+				remote.cancel()
+			elif not remote.cancelled():
+				remote.exception()  # already reported for each file, if any were copied
+
+	def __routes(self, videos, unlisted=(), **filter_options):
+		"""
+		Work out which rclone servers to get each video's files from. Without a listing index, every
+		rclone server of a video's server is asked for all of them.
+		:param videos: list of videos
+		:param unlisted: rclone servers that couldn't be listed, so may have any file
+		:param filter_options: options of _create_filter_files, saying which files are wanted
+		:return: list of (server name, list of rclone servers, videos to get from them, and the
+		paths of their files if the listing index has them, or None)
+		"""
+		server_videos = {}
+		for v in videos:
+			if v['Server'] not in server_videos:
+				server_videos[v['Server']] = []
+			server_videos[v['Server']].append(v)
+
+		routes = []
+		for server, videos in server_videos.items():
+			if not self.listing:
+				routes.append((server, self.server_map[server], videos, None))
+				continue
+			for rclone_server in self.server_map[server]:
+				if rclone_server in unlisted:
+					routes.append((server, [rclone_server], videos, None))
+					continue
+				remote_videos = []
+				paths = []
+				for v in videos:
+					video_paths = self.__listed_files(rclone_server, v,
+					                                  _filter_extensions(v, **filter_options))
+					if video_paths:
+						remote_videos.append(v)
+						paths += video_paths
+				if remote_videos:
+					routes.append((server, [rclone_server], remote_videos, paths))
+		return routes
+
+	def __listed_files(self, rclone_server, video, extensions):
+		"""
+		:return: list of the paths of a video's files with the given extensions that the listing
+		index has on an rclone server
+		"""
+		base = remove_ext(video['Filename']) + '.'
+		paths = []
+		for path in self.listing.find(rclone_server, base):
+			rest = path[len(base):]
+			if '/' not in rest and (rest in extensions
+			                        or ('*.json' in extensions and rest.endswith('.json'))):
+				paths.append(path)
+		return paths
+
+	def __journaled(self, videos, download, delete):
+		"""
+		Find the videos the journal says don't need to be transferred or deleted again
+		:param videos: list of videos
+		:param download: Whether they're being downloaded
+		:param delete: Whether they're being deleted from the server
+		:return: set of their Filenames
+		"""
+		if not self.journal:
+			return set()
+		if not self.dry_run:
+			self.journal.add(videos)
+		if not download:
+			return {v['Filename'] for v in videos if self.journal.has(v, 'deleted')}
+		# A copied file that has gone missing locally since is copied again, but a moved one can't
+		# be
+		return {v['Filename'] for v in videos
+		        if self.journal.has(v, 'transferred', *(['deleted'] if delete else []))
+		        and (delete or os.path.exists(os.path.join(self.output_dir, v['Filename'])))}
+
 	async def merge_and_rename(self, videos, keys):
 		"""
 		Merge and rename downloaded videos according to the rules suggested by videos
@@ -218,31 +606,47 @@ class Downloader:
 		# 	self.__pub(self.CompletedMessage(), keys)
 		# 	return
 
-		destinations = {}
-		for video in videos:
-			target = new_filename(video)
-			if target not in destinations:
-				destinations[target] = []
-			destinations[target].append(video)
+		destinations = _group_by_destination(videos)
 
 		self.__pub(self.NewTaskMessage(total_items=len(destinations)), keys)
 
-		for target, sources in destinations.items():
-			if len(sources):
-				av_files = [self.output_dir + '/' + x['Filename'] for x in sources if
-				            x['result'].startswith('keep') or x['result'] == 'audio+video']
-				video_files = [self.output_dir + '/' + x['Filename'] for x in sources if
-				               x['result'] in ['video', 'video+subs']]
-				audio_files = [self.output_dir + '/' + x['Filename'] for x in sources if
-				               x['result'] in ['audio', 'audio+subs']] \
-				              + video_files  # include all audio tracks
-				try:
-					merge_videos(
+		await asyncio.gather(*[self.__merge_group(target, sources, keys)
+		                       for target, sources in destinations.items()])
+
+		await self.__finish_merging(keys)
+
+	async def __merge_group(self, target, sources, keys):
+		"""
+		Merge the downloaded files of one destination into an mkv file, once fewer than merge_jobs
+		merges are running
+		:param target: new_filename of the videos
+		:param sources: videos with that new_filename
+		:param keys: message keys
+		"""
+		unverified = [x['Filename'] for x in sources
+		              if (x['Server'], x['Filename']) in self.unverified]
+		if unverified:
+			self.__pub(f"Not merging {target}: {', '.join(unverified)} didn't match the server",
+			           keys)
+		elif len(sources):
+			av_files = [self.output_dir + '/' + x['Filename'] for x in sources if
+			            x['result'].startswith('keep') or x['result'] == 'audio+video']
+			video_files = [self.output_dir + '/' + x['Filename'] for x in sources if
+			               x['result'] in ['video', 'video+subs']]
+			audio_files = [self.output_dir + '/' + x['Filename'] for x in sources if
+			               x['result'] in ['audio', 'audio+subs']] \
+			              + video_files  # include all audio tracks
+			if self.merge_slots is None:
+				# Created here so it belongs to the running event loop
+				self.merge_slots = asyncio.Semaphore(self.merge_jobs)
+			try:
+				async with self.merge_slots:
+					await merge_videos(
 						source_files=av_files,
 						audio_files=audio_files,
 						video_files=video_files,
-						subtitle_files=[self.output_dir + '/' + x['Filename'] for x in sources if
-						                x['result'] in ['subs', 'audio+subs', 'video+subs']],
+						subtitle_files=[self.output_dir + '/' + x['Filename'] for x in sources
+						                if x['result'] in ['subs', 'audio+subs', 'video+subs']],
 						output_filename=self.output_dir + '/' + target + '.mkv',
 						delete_source=True,
 						delete_json=True,  # json will not be deleted from server, only destination
@@ -250,34 +654,89 @@ class Downloader:
 						title=sources[0]['Output Title'],
 						pub=self.publisher, keys=[*keys, 'merge']
 					)
-					self.output_file.writerows([[x['Filename'], target + '.mkv'] for x in sources])
-				except Exception as ex:
-					self.__pub(ex, keys)
-					pass
-			self.__pub(self.ProgressMessage("Merged: " + target, processed_items=1),
-			           [*keys, 'merge'])
-
+				self.output_file.writerows([[x['Filename'], target + '.mkv'] for x in sources])
+				if self.journal and not self.dry_run:
+					for x in sources:
+						self.journal.record(x['Server'], x['Filename'], 'merged', target + '.mkv')
+			except Exception as ex:
+				self.__pub(ex, keys)
+				pass
+		self.__pub(self.ProgressMessage("Merged: " + target, processed_items=1),
+		           [*keys, 'merge'])
+
+	async def __finish_merging(self, keys):
 		# ugly hack to get rid of empty directories created in this process
-		subprocess.run(['find', self.output_dir, '-type', 'd', '-empty', '-delete'])
+		find = await asyncio.create_subprocess_exec(
+			'find', self.output_dir, '-type', 'd', '-empty', '-delete')
+		await find.wait()
 
 		self.__pub(self.CompletedMessage(), keys)
 
-	async def download_and_merge(self, videos, keys, download=True, delete=False):
+	async def download_and_merge(self, videos, keys, download=True, delete=False, pipeline=False):
 		"""
 		Download videos, then merge and rename
 		:param videos: A list of video dictionaries
 		:param download: Whether to perform the download
 		:param keys: message keys
 		:param delete: Whether to delete the files from the server
-		:param add_attachments: Whether to add json and image files as attachments in mkv
-		:param merge: Whether to merge downloaded video files according to the "result" column
-		:param rename: Whether to rename files to new_filename(video)
+		:param pipeline: Whether to merge each destination as soon as its files have been
+		downloaded, while the rest are still downloading
 		"""
+		if download and self.journal:
+			merged = [v for v in videos if self.journal.has(v, 'merged')]
+			if merged:
+				self.__pub(f"Skipping {len(merged)} files already merged, according to the journal",
+				           keys)
+				videos = [v for v in videos if not self.journal.has(v, 'merged')]
+				undeleted = [v for v in merged if not self.journal.has(v, 'deleted')]
+				if delete and undeleted:
+					await self.download(undeleted, [*keys, 'delete'], download=False, delete=True)
+
+		if download and pipeline:
+			await self.__download_and_merge_pipelined(videos, keys, delete)
+			return
 
 		await self.download(videos, [*keys, 'download'], download, delete)
 		if download:
 			await self.merge_and_rename(videos, [*keys, 'merge'])
 
+	async def __download_and_merge_pipelined(self, videos, keys, delete):
+		"""
+		Download videos, merging and renaming each destination as soon as rclone reports that all
+		of its files have arrived. Thumbnails and json files are downloaded first, so they're
+		there to be attached by the time the videos are.
+		"""
+		merge_keys = [*keys, 'merge']
+		destinations = _group_by_destination(videos)
+		waiting = {}  # video file -> destinations that need it
+		missing = {}  # destination -> number of its video files not downloaded yet
+		for target, sources in destinations.items():
+			filenames = {x['Filename'] for x in sources}
+			missing[target] = len(filenames)
+			for filename in filenames:
+				waiting.setdefault(filename, []).append(target)
+
+		merges = []
+
+		def on_file(filename):
+			for target in waiting.pop(filename, []):
+				missing[target] -= 1
+				if not missing[target]:
+					merges.append(asyncio.ensure_future(
+						self.__merge_group(target, destinations.pop(target), merge_keys)))
+
+		self.__pub(self.NewTaskMessage(total_items=len(destinations)), merge_keys)
+		try:
+			await self.download(videos, [*keys, 'download'], True, delete, on_file=on_file)
+		finally:
+			await asyncio.gather(*merges)
+
+		# Whatever is left has files that rclone never reported, so merge_videos reports them
+		await asyncio.gather(*[self.__merge_group(target, sources, merge_keys)
+		                       for target, sources in destinations.items()])
+
+		await self.__finish_merging(merge_keys)
+
 	class NewTaskMessage:
 		def __init__(self, command=None, total_items=None, total_bytes=None):
 			self.command = command
@@ -300,6 +759,62 @@ class Downloader:
 		def __str__(self):
 			return self.message
 
+	class StatsMessage:
+		def __init__(self, stats):
+			"""
+			Transfer statistics of one rclone process
+			:param stats: the "stats" object from rclone's JSON log
+			"""
+			self.bytes = stats.get('bytes', 0)
+			self.total_bytes = stats.get('totalBytes', 0)
+			self.speed = stats.get('speed', 0)
+			self.eta = stats.get('eta')
+			self.errors = stats.get('errors', 0)
+			self.transferring = [Downloader.FileProgress(x)
+			                     for x in stats.get('transferring') or []]
+
+		def __str__(self):
+			return f"{naturalsize(self.bytes)} / {naturalsize(self.total_bytes)} at " \
+			       f"{naturalsize(self.speed)}/s" + ''.join(f"; {x}" for x in self.transferring)
+
+	class FileProgress:
+		def __init__(self, transfer):
+			"""
+			Progress of a file being transferred
+			:param transfer: an item in the "transferring" list of rclone's stats
+			"""
+			self.name = transfer.get('name', '')
+			self.bytes = transfer.get('bytes', 0)
+			self.size = transfer.get('size', 0)
+			self.percentage = transfer.get('percentage', 0)
+			self.speed = transfer.get('speed', 0)
+
+		def __str__(self):
+			return f"{self.name}: {self.percentage}% at {naturalsize(self.speed)}/s"
+
+	class ThroughputMessage:
+		def __init__(self, bytes, speed, tasks):
+			"""
+			Transfer statistics of all rclone tasks together
+			:param bytes: bytes transferred so far, including by tasks that have finished
+			:param speed: sum of the current speeds of the running tasks, in bytes per second
+			:param tasks: number of running tasks that have reported statistics
+			"""
+			self.bytes = bytes
+			self.speed = speed
+			self.tasks = tasks
+
+		def __str__(self):
+			return f"{naturalsize(self.bytes)} transferred, {naturalsize(self.speed)}/s in total"
+
+	class SchedulerMessage:
+		def __init__(self, running, queued):
+			self.running = running
+			self.queued = queued
+
+		def __str__(self):
+			return f"{self.running} rclone processes running, {self.queued} queued"
+
 	class CompletedMessage:
 		def __init__(self, command=None, exitcode=None):
 			self.command = command
@@ -310,19 +825,78 @@ class Downloader:
 				else "task completed"
 
 
+def default_merge_jobs():
+	"""
+	:return: how many videos to merge at once by default. mkvmerge mostly copies data, so more than
+	a few at once just compete for the disk, but fewer than half the cores leaves the CPU idle.
+	"""
+	return max(1, min(4, (os.cpu_count() or 1) // 2))
+
+
+def is_video(filename):
+	extension = ext(filename)
+	return extension not in IMAGE_FILES and not extension.endswith('json')
+
+
+def downloaded(filename, size):
+	"""
+	:param filename: path to a downloaded file
+	:param size: its size on the server, or -1 if that isn't known
+	:return: whether the file is there with the same size
+	"""
+	try:
+		return size < 0 or os.path.getsize(filename) == size
+	except OSError:
+		return False
+
+
+def parse_rclone_log(line):
+	"""
+	Parse a line of rclone output written with --use-json-log
+	:param line: the line
+	:return: a dict with at least "level" and "msg", and "object" if it's about a file, or "stats"
+	if it's periodic stats. Lines that aren't JSON, such as errors before logging is set up, are
+	returned as errors.
+	"""
+	try:
+		log = json.loads(line)
+	except ValueError:
+		log = None
+	if not isinstance(log, dict):
+		return {'level': 'error', 'msg': line}
+	log.setdefault('level', 'info')
+	log.setdefault('msg', '')
+	return log
+
+
+def format_rclone_log(log):
+	"""
+	Format a parsed rclone log line like rclone's plain text logs
+	"""
+	message = log['msg'].strip()
+	if log.get('object'):
+		message = f"{log['object']}: {message}"
+	return f"{log['level'].upper()}: {message}"
+
+
 def read_source_file(filename, tsv=False):
 	"""
 	Read a source file into a list of video dictionaries
 	:param filename: A file opened for reading
-	:param tsv: The type of file: false for UTF-8 CSV, true for UTF-16 TSV
-	:return: A list of video dictionaries
+	:param tsv: The type of file: false for UTF-8 CSV, true for UTF-16 TSV. Files ending in
+	.parquet are read as Parquet
+	:return: A list of video dictionaries, with numbers like "Size" as ints
 	"""
+	expected_keys = ('Server', 'Filename', 'Size', 'Date', 'Duration', 'Group', 'Series',
+	                 'Episode', 'Output Title', 'Part', 'result')
+	if filename.endswith('.parquet'):
+		# Only the needed columns are read
+		return list(iter_parquet_rows(filename, list(expected_keys)))
 	with open(filename, 'r', newline='',
 	          encoding='utf-16' if tsv else 'utf-8') as csvfile:
 		reader = csv.DictReader(csvfile, dialect='excel-tab' if tsv else 'excel')
-		videos = list(reader)
-	for expected_key in ('Server', 'Filename', 'Size', 'Date', 'Duration', 'Group', 'Series',
-	                     'Episode', 'Output Title', 'Part', 'result'):
+		videos = [parse_row(x) for x in reader]
+	for expected_key in expected_keys:
 		if expected_key not in videos[0]:
 			raise ValueError(f"Did not find key {expected_key} in vidinfo csv. values: {videos[0]}")
 	return videos
@@ -0,0 +1,77 @@
+import sqlite3
+import time
+
+# What can have happened to a file, in the order it happens
+STATES = ('transferred', 'verified', 'merged', 'deleted')
+
+
+class Journal:
+	def __init__(self, filename):
+		"""
+		Open or create a journal of what has happened to each file, so an interrupted download
+		can pick up where it stopped. Every change is committed straight away, and the database
+		uses a write-ahead log, so a crash loses at most the change being written.
+		:param filename: path to a SQLite database
+		"""
+		self.connection = sqlite3.connect(filename)
+		self.connection.execute('PRAGMA journal_mode=WAL')
+		self.connection.execute('PRAGMA synchronous=NORMAL')
+		self.connection.executescript("""
+			CREATE TABLE IF NOT EXISTS files (
+				server TEXT NOT NULL,
+				path TEXT NOT NULL,
+				listed REAL NOT NULL,
+				transferred REAL,
+				verified REAL,
+				merged REAL,
+				deleted REAL,
+				target TEXT,
+				PRIMARY KEY (server, path)
+			) WITHOUT ROWID;
+		""")
+
+	def add(self, videos):
+		"""
+		Record that videos are to be processed, unless they already are in the journal
+		:param videos: list of video dictionaries
+		"""
+		now = time.time()
+		with self.connection:
+			self.connection.executemany(
+				'INSERT OR IGNORE INTO files (server, path, listed) VALUES (?, ?, ?)',
+				[(v['Server'], v['Filename'], now) for v in videos])
+
+	def record(self, server, path, state, target=None):
+		"""
+		Record that something has happened to a file
+		:param server: server name from the source file
+		:param path: path of the file on the server
+		:param state: one of STATES
+		:param target: what the file was merged into (optional)
+		"""
+		if state not in STATES:
+			raise ValueError(f"Unknown state {state}")
+		with self.connection:
+			self.connection.execute(
+				f'INSERT INTO files (server, path, listed, {state}, target) VALUES (?, ?, ?, ?, ?) '
+				f'ON CONFLICT (server, path) DO UPDATE SET {state} = excluded.{state}, '
+				f'target = COALESCE(excluded.target, target)',
+				(server, path, time.time(), time.time(), target))
+
+	def get(self, server, path):
+		"""
+		:return: the set of states a file has reached
+		"""
+		row = self.connection.execute(
+			f"SELECT {', '.join(STATES)} FROM files WHERE server = ? AND path = ?",
+			(server, path)).fetchone()
+		return {state for state, value in zip(STATES, row or ()) if value is not None}
+
+	def has(self, video, *states):
+		"""
+		:return: whether a video has reached all of the given states
+		"""
+		return set(states).issubset(self.get(video['Server'], video['Filename']))
+
+	def close(self):
+		self.connection.close()
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import sqlite3
+import tempfile
+import time
+
+
+def parse_lsjson_line(line):
+	"""
+	Parse a line of 'rclone lsjson' output, which has one object per line, so huge listings
+	don't have to be read into memory all at once
+	:param line: the line
+	:return: the object as a dict, or None for the brackets around the list
+	"""
+	line = line.strip().rstrip(',')
+	if not line or line in ('[', ']'):
+		return None
+	return json.loads(line)
+
+
+class ListingIndex:
+	def __init__(self, filename, ttl=24 * 60 * 60):
+		"""
+		Open or create a cache of what files each rclone remote has, so each file can be fetched
+		from just the remotes that have it
+		:param filename: path to a SQLite database
+		:param ttl: seconds before a remote is listed again
+		"""
+		self.ttl = ttl
+		self.lock = None
+		self.connection = sqlite3.connect(filename)
+		self.connection.executescript("""
+			CREATE TABLE IF NOT EXISTS objects (
+				remote TEXT NOT NULL,
+				path TEXT NOT NULL,
+				size INTEGER NOT NULL,
+				PRIMARY KEY (remote, path)
+			) WITHOUT ROWID;
+			CREATE TABLE IF NOT EXISTS listings (
+				remote TEXT PRIMARY KEY,
+				listed REAL NOT NULL
+			);
+		""")
+
+	def is_fresh(self, remote):
+		"""
+		:param remote: an rclone path like "wasabi-us:sdg-spout"
+		:return: whether the remote was listed less than ttl seconds ago
+		"""
+		row = self.connection.execute('SELECT listed FROM listings WHERE remote = ?',
+		                              (remote,)).fetchone()
+		return row is not None and time.time() - row[0] < self.ttl
+
+	async def refresh(self, remote):
+		"""
+		List every file on a remote with 'rclone lsjson', replacing what was cached for it
+		:param remote: an rclone path like "wasabi-us:sdg-spout"
+		"""
+		# rclone writes straight to a file, which is then read a line at a time, so huge
+		# listings are never all in memory
+		with tempfile.TemporaryFile() as listing:
+			p = await asyncio.create_subprocess_exec(
+				'rclone', 'lsjson', '-R', '--files-only', '--no-mimetype', '--no-modtime', remote,
+				stdout=listing, stderr=asyncio.subprocess.PIPE)
+			errors = await p.stderr.read()
+			if await p.wait() != 0:
+				raise RuntimeError(f"rclone lsjson {remote} exited with return code "
+				                   f"{p.returncode}: {errors.decode('utf-8').strip()}")
+			listing.seek(0)
+			items = (parse_lsjson_line(line.decode('utf-8')) for line in listing)
+			with self.connection:
+				self.connection.execute('DELETE FROM objects WHERE remote = ?', (remote,))
+				self.connection.executemany('INSERT OR REPLACE INTO objects VALUES (?, ?, ?)',
+				                            ((remote, x['Path'], x.get('Size', -1))
+				                             for x in items if x is not None))
+				self.connection.execute('INSERT OR REPLACE INTO listings VALUES (?, ?)',
+				                        (remote, time.time()))
+
+	async def update(self, remotes, force=False):
+		"""
+		List the remotes that haven't been listed within ttl seconds
+		:param remotes: list of rclone paths
+		:param force: list them all, however recently they were listed
+		:return: dict like {remote: exception} of remotes that couldn't be listed
+		"""
+		if self.lock is None:
+			# Created here so it belongs to the running event loop
+			self.lock = asyncio.Lock()
+		# Jobs starting at the same time would otherwise all list the same remotes
+		async with self.lock:
+			stale = [x for x in dict.fromkeys(remotes) if force or not self.is_fresh(x)]
+			results = await asyncio.gather(*[self.refresh(x) for x in stale],
+			                               return_exceptions=True)
+		return {remote: result for remote, result in zip(stale, results)
+		        if isinstance(result, Exception)}
+
+	def find(self, remote, prefix):
+		"""
+		Find the files on a remote that start with a prefix
+		:param remote: an rclone path
+		:param prefix: start of the paths, relative to the remote
+		:return: list of paths
+		"""
+		return [path for path, in self.connection.execute(
+			'SELECT path FROM objects WHERE remote = ? AND path >= ? AND path < ?',
+			(remote, prefix, prefix + '\U0010ffff'))]
+
+	def remove(self, remote, path):
+		"""
+		Forget a file that has been deleted from a remote
+		"""
+		with self.connection:
+			self.connection.execute('DELETE FROM objects WHERE remote = ? AND path = ?',
+			                        (remote, path))
+
+	def close(self):
+		self.connection.close()
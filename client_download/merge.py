@@ -3,6 +3,7 @@ import shlex
 
 import aiopubsub
 import argparse
+import asyncio
 import os
 import subprocess
 import uuid
@@ -33,11 +34,46 @@ def find_attachments(*filenames):
 	        and ext(attachment) != 'mkv'}
 
 
-def merge(source_files, audio_files, video_files, subtitle_files, output_filename, pub,
-          delete_source=False, delete_json=False, dry_run=False, title=None, keys=None):
-	if not keys:
-		keys = ['merge']
-
+def reserve_filename(filename):
+	"""
+	Claim an output filename by creating it empty, or the first free name with _1, _2 etc. added
+	if it exists. Creating the file fails if it already exists, so merges running at once (even
+	in different processes) never claim the same name.
+	:param filename: the preferred name
+	:return: the name that was claimed
+	"""
+	os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+	candidate = filename
+	i = 0
+	while True:
+		try:
+			os.close(os.open(candidate, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+			return candidate
+		except FileExistsError:
+			i += 1
+			candidate = f"{remove_ext(filename)}_{i}.{ext(filename)}"
+
+
+def release_filename(filename):
+	"""
+	Give up a name claimed by reserve_filename, if nothing was written to it
+	"""
+	try:
+		if os.path.getsize(filename) == 0:
+			os.remove(filename)
+	except OSError:
+		pass
+
+
+def merge_commands(source_files, audio_files, video_files, subtitle_files, output_filename,
+                   delete_source=False, delete_json=False, title=None, reserved=False):
+	"""
+	Work out the commands that merge files into an mkv file
+	:param reserved: Whether output_filename was claimed by reserve_filename, in which case
+	mkvmerge writes to a temporary file that then replaces it
+	:return: list of commands to run in order, each a list of arguments
+	"""
+	commands = []
 	attachments = find_attachments(*source_files, *audio_files, *video_files, *subtitle_files)
 
 	created_cover = False
@@ -47,12 +83,7 @@ def merge(source_files, audio_files, video_files, subtitle_files, output_filenam
 		cover = next((a for a in attachments if ext(a) in IMAGE_FILES), None)
 		if cover:
 			temp_filename = str(uuid.uuid4()) + '.jpg'
-			imagick_args = ['convert', cover, temp_filename]
-			print(' '.join(map(shlex.quote, imagick_args)))
-			if not dry_run:
-				result = subprocess.run(imagick_args)
-				if result.returncode != 0:
-					raise RuntimeError("Got non-zero exit code from convert")
+			commands.append(['convert', cover, temp_filename])
 			created_cover = True
 			cover_source = cover
 			cover = temp_filename
@@ -63,14 +94,15 @@ def merge(source_files, audio_files, video_files, subtitle_files, output_filenam
 	video_files = video_files or []
 	subtitle_files = subtitle_files or []
 
-	if os.path.isfile(output_filename):
+	if not reserved and os.path.isfile(output_filename):
 		i = 1
 		while os.path.isfile(f"{remove_ext(output_filename)}_{i}.{ext(output_filename)}"):
 			i += 1
 		output_filename = f"{remove_ext(output_filename)}_{i}.{ext(output_filename)}"
 
-	output = 'temp.mkv' if output_filename in (source_files + audio_files + video_files +
-	                                           subtitle_files) else output_filename
+	# A unique name next to the output, so merges running at once don't share a temporary file
+	output = f"{remove_ext(output_filename)}.{uuid.uuid4()}.mkv" if reserved or output_filename in (
+			source_files + audio_files + video_files + subtitle_files) else output_filename
 
 	args = ['mkvmerge', '--no-date', '-o', output]
 
@@ -90,6 +122,7 @@ def merge(source_files, audio_files, video_files, subtitle_files, output_filenam
 	else:
 		args += [arg for file in audio_files for arg in ('-D', file)]
 	args += [arg for file in subtitle_files for arg in ('-A', '-D', file)]
+	commands.append(args)
 
 	files_to_delete = set()
 	if delete_source:
@@ -100,26 +133,61 @@ def merge(source_files, audio_files, video_files, subtitle_files, output_filenam
 	if created_cover:
 		files_to_delete.add(cover)
 
-	pub.publish(aiopubsub.Key(*keys), ' '.join(map(shlex.quote, args)))
-	if not dry_run:
-		result = subprocess.run(args)
-		if result.returncode != 0:
-			raise RuntimeError("Got non-zero exit code from mkvmerge")
-
 	if len(files_to_delete) > 0:
-		pub.publish(aiopubsub.Key(*keys), 'rm ' + ' '.join(map(shlex.quote, files_to_delete)))
-		if not dry_run:
-			result = subprocess.run(['rm', *files_to_delete])
-			if result.returncode != 0:
-				raise RuntimeError("Got non-zero exit code from rm")
+		commands.append(['rm', *files_to_delete])
 
 	if output != output_filename:
-		pub.publish(aiopubsub.Key(*keys),
-		            f"mv {shlex.quote(output)} {shlex.quote(output_filename)}")
+		commands.append(['mv', output, output_filename])
+
+	return commands
+
+
+def merge(source_files, audio_files, video_files, subtitle_files, output_filename, pub,
+          delete_source=False, delete_json=False, dry_run=False, title=None, keys=None):
+	if not keys:
+		keys = ['merge']
+
+	if not dry_run:
+		output_filename = reserve_filename(output_filename)
+	try:
+		for command in merge_commands(source_files, audio_files, video_files, subtitle_files,
+		                              output_filename, delete_source, delete_json, title,
+		                              reserved=not dry_run):
+			pub.publish(aiopubsub.Key(*keys), ' '.join(map(shlex.quote, command)))
+			if not dry_run:
+				result = subprocess.run(command)
+				if result.returncode != 0:
+					raise RuntimeError(f"Got non-zero exit code from {command[0]}")
+	except BaseException:
+		if not dry_run:
+			release_filename(output_filename)
+		raise
+
+
+async def merge_async(source_files, audio_files, video_files, subtitle_files, output_filename,
+                      pub, delete_source=False, delete_json=False, dry_run=False, title=None,
+                      keys=None):
+	"""
+	Like merge, but runs the commands as asyncio subprocesses so the event loop isn't blocked
+	"""
+	if not keys:
+		keys = ['merge']
+
+	if not dry_run:
+		output_filename = reserve_filename(output_filename)
+	try:
+		for command in merge_commands(source_files, audio_files, video_files, subtitle_files,
+		                              output_filename, delete_source, delete_json, title,
+		                              reserved=not dry_run):
+			pub.publish(aiopubsub.Key(*keys), ' '.join(map(shlex.quote, command)))
+			if not dry_run:
+				process = await asyncio.create_subprocess_exec(*command)
+				if await process.wait() != 0:
+					raise RuntimeError(f"Got non-zero exit code from {command[0]}")
+	except BaseException:
 		if not dry_run:
-			result = subprocess.run(['mv', output, output_filename])
-			if result.returncode != 0:
-				raise RuntimeError("Got non-zero exit code from mv")
+			release_filename(output_filename)
+		raise
 
 
 def main():
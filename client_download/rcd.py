@@ -0,0 +1,119 @@
+import asyncio
+import base64
+import json
+import os
+import secrets
+import socket
+import urllib.error
+import urllib.request
+
+
+class Rcd:
+	def __init__(self, poll_interval=2.0, bwlimit=None):
+		"""
+		A local 'rclone rcd' daemon that runs transfers as jobs through rclone's remote control
+		API, so each one doesn't pay for starting rclone, reading its config and connecting
+		afresh
+		:param poll_interval: seconds between checks on the progress of a job
+		:param bwlimit: bandwidth limit for all jobs together, in rclone's --bwlimit format
+		"""
+		self.poll_interval = poll_interval
+		self.bwlimit = bwlimit
+		self.process = None
+		self.url = None
+		self.authorization = None
+
+	async def start(self, timeout=30):
+		"""
+		Start the daemon on a free local port, with a random password, and wait until it answers
+		:param timeout: seconds to wait for it
+		"""
+		with socket.socket() as s:
+			s.bind(('127.0.0.1', 0))
+			port = s.getsockname()[1]
+		user, password = 'download', secrets.token_urlsafe()
+		self.url = f"http://127.0.0.1:{port}/"
+		self.authorization = 'Basic ' + base64.b64encode(f"{user}:{password}".encode()).decode()
+		command = ['rclone', 'rcd', '--rc-addr', f"127.0.0.1:{port}"]
+		if self.bwlimit:
+			command += ['--bwlimit', self.bwlimit]
+		# In the environment rather than the arguments, so other users can't see the password
+		self.process = await asyncio.create_subprocess_exec(
+			*command, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+			env={**os.environ, 'RCLONE_RC_USER': user, 'RCLONE_RC_PASS': password})
+
+		for _ in range(int(timeout / 0.1)):
+			if self.process.returncode is not None:
+				raise RuntimeError(f"rclone rcd exited with return code {self.process.returncode}")
+			try:
+				await self.call('rc/noop')
+				return
+			except OSError:
+				await asyncio.sleep(0.1)
+		raise RuntimeError(f"rclone rcd didn't start listening on port {port}")
+
+	def __post(self, command, params):
+		request = urllib.request.Request(
+			self.url + command, data=json.dumps(params).encode(), method='POST',
+			headers={'Content-Type': 'application/json', 'Authorization': self.authorization})
+		try:
+			with urllib.request.urlopen(request) as response:
+				return json.load(response)
+		except urllib.error.HTTPError as ex:
+			# rclone explains errors in the body
+			try:
+				error = json.load(ex).get('error', ex.reason)
+			except ValueError:
+				error = ex.reason
+			raise RuntimeError(f"rclone rc {command} failed: {error}") from None
+
+	async def call(self, command, **params):
+		"""
+		Call the remote control API
+		:param command: like "sync/copy"
+		:param params: its parameters
+		:return: the response
+		"""
+		# The requests are small and local, so a thread is enough to not block the event loop
+		return await asyncio.get_running_loop().run_in_executor(None, self.__post, command, params)
+
+	async def run_job(self, command, params, on_update):
+		"""
+		Run a command as a job, and wait for it to finish
+		:param command: like "sync/copy"
+		:param params: its parameters
+		:param on_update: called with the job's stats (like rclone's "stats" log) and the list of
+		files it has recently finished with (from core/transferred, which only keeps the last
+		few) every poll_interval, and once it's done
+		:return: the job's status from job/status, with "success" and "error"
+		"""
+		job_id = (await self.call(command, _async=True, **params))['jobid']
+		group = f"job/{job_id}"
+		while True:
+			status = await self.call('job/status', jobid=job_id)
+			stats = await self.call('core/stats', group=group)
+			transferred = await self.call('core/transferred', group=group)
+			on_update(stats, transferred.get('transferred') or [])
+			if status.get('finished'):
+				return status
+			await asyncio.sleep(self.poll_interval)
+
+	async def list_files(self, fs, **params):
+		"""
+		List the files on a remote with operations/list
+		:param fs: an rclone path like "wasabi-us:sdg-spout"
+		:param params: other parameters, like _filter to list only some files
+		:return: a dict like {path: size in bytes}, where the size is -1 if it isn't known
+		"""
+		response = await self.call('operations/list', fs=fs, remote='', opt={
+			'recurse': True, 'filesOnly': True, 'noModTime': True, 'noMimeType': True}, **params)
+		return {x['Path']: x.get('Size', -1) for x in response.get('list') or []}
+
+	async def stop(self):
+		if self.process is None or self.process.returncode is not None:
+			return
+		try:
+			await self.call('core/quit')
+		except (OSError, RuntimeError):
+			self.process.terminate()
+		await self.process.wait()
@@ -0,0 +1,75 @@
+import asyncio
+import contextlib
+from collections import Counter
+
+
+def remote_name(rclone_server):
+	"""
+	Get the name of the rclone remote from an rclone path
+	:param rclone_server: an rclone path like "wasabi-us:sdg-spout" or "/bucket/archives/dl"
+	:return: the remote, like "wasabi-us", or "local" for local paths
+	"""
+	remote, separator, _ = rclone_server.partition(':')
+	# Windows drive letters aren't remotes
+	return remote if separator and len(remote) > 1 else 'local'
+
+
+class Scheduler:
+	def __init__(self, total=None, per_server=None, per_remote=None, on_change=None):
+		"""
+		Limit how many tasks run at once, in total, per server and per rclone remote. Tasks
+		wait for a slot until all of their limits have room.
+		:param total: maximum number of tasks in total (None for no limit)
+		:param per_server: maximum number of tasks per server in the server map (None for no limit)
+		:param per_remote: maximum number of tasks per rclone remote (None for no limit)
+		:param on_change: called with (running, queued) whenever a task starts, finishes or is
+		queued
+		"""
+		self.total = total
+		self.per_server = per_server
+		self.per_remote = per_remote
+		self.on_change = on_change
+		self.running = 0
+		self.queued = 0
+		self.running_servers = Counter()
+		self.running_remotes = Counter()
+		self.condition = None
+
+	def __has_room(self, server, remote):
+		return ((not self.total or self.running < self.total)
+		        and (not self.per_server or self.running_servers[server] < self.per_server)
+		        and (not self.per_remote or self.running_remotes[remote] < self.per_remote))
+
+	def __changed(self):
+		if self.on_change:
+			self.on_change(self.running, self.queued)
+
+	@contextlib.asynccontextmanager
+	async def slot(self, server, remote):
+		"""
+		Wait until a task can run, and hold its slot until the block exits
+		:param server: server name from the server map
+		:param remote: rclone remote, from remote_name
+		"""
+		if self.condition is None:
+			# Created here so it belongs to the running event loop
+			self.condition = asyncio.Condition()
+		async with self.condition:
+			if not self.__has_room(server, remote):
+				self.queued += 1
+				self.__changed()
+				await self.condition.wait_for(lambda: self.__has_room(server, remote))
+				self.queued -= 1
+			self.running += 1
+			self.running_servers[server] += 1
+			self.running_remotes[remote] += 1
+			self.__changed()
+		try:
+			yield
+		finally:
+			async with self.condition:
+				self.running -= 1
+				self.running_servers[server] -= 1
+				self.running_remotes[remote] -= 1
+				self.__changed()
+				self.condition.notify_all()
@@ -0,0 +1,105 @@
+import locale
+import sqlite3
+
+try:
+	import pyarrow
+	import pyarrow.parquet
+except ImportError:
+	pyarrow = None
+
+# Readers for the files written by client_processing: size indexes (size_index.py) and typed
+# vidinfo files (vidinfo_parquet.py). The formats are defined there; keep them in sync.
+
+# Columns of vidinfo files that hold numbers or booleans; the rest are strings
+integer_columns = {'Size', 'Subtitles', 'Height', 'original_row'}
+float_columns = {'Duration', 'Video bitrate', 'FPS', 'Audio bitrate', 'Total bitrate'}
+boolean_columns = {'alive'}
+typed_columns = integer_columns | float_columns | boolean_columns
+
+
+class SizeIndex:
+	def __init__(self, filename):
+		"""
+		Open a size index built by vidinfo.py, to look up the sizes of files missing from the
+		source file
+		:param filename: path to the SQLite database, which is only read
+		"""
+		self.connection = sqlite3.connect(f"file:{filename}?mode=ro", uri=True)
+
+	def get(self, path, default=None):
+		"""
+		Look up the size of a file, like dict.get
+		:param path: path relative to the root of the listing
+		:param default: what to return if the file isn't listed
+		:return: size in bytes
+		"""
+		row = self.connection.execute('SELECT size FROM sizes WHERE path = ?', (path,)).fetchone()
+		return default if row is None else row[0]
+
+	def close(self):
+		self.connection.close()
+
+
+def parse_value(column, value):
+	"""
+	Convert a value from a csv vidinfo file to the type of its column
+	:param column: name of the column
+	:param value: the value as a string
+	:return: the value as an int, float or bool for those columns (None if it's empty), otherwise
+	the string
+	"""
+	if column not in typed_columns:
+		return value
+	value = value.strip()
+	if not value:
+		return None
+	if column in boolean_columns:
+		return value == 'True'
+	if column in integer_columns:
+		# Sizes in csv files edited in a spreadsheet can have thousands separators
+		for separator in {',', locale.localeconv()['thousands_sep']} - {''}:
+			value = value.replace(separator, '')
+		return int(value)
+	return number(float(value))
+
+
+def parse_row(row):
+	"""
+	Convert the numbers and booleans in a row read from a csv vidinfo file, so the row has the same
+	types as one read from a Parquet file
+	:param row: dict of strings, as read by csv.DictReader
+	:return: the same dict
+	"""
+	for column, value in row.items():
+		if isinstance(value, str):
+			row[column] = parse_value(column, value)
+	return row
+
+
+def number(value):
+	"""
+	Durations are stored as floats, but they're usually whole, and then they're integers, like in
+	csv files
+	"""
+	return int(value) if isinstance(value, float) and value.is_integer() else value
+
+
+def iter_parquet_rows(filename, columns=None):
+	"""
+	Read a Parquet vidinfo file one batch of rows at a time
+	:param filename: path to the vidinfo file
+	:param columns: names of the columns to read (default: all of them)
+	:return: generator of dicts representing vidinfo rows, with numbers and booleans like
+	parse_row, and empty strings for missing text
+	"""
+	if pyarrow is None:
+		raise ImportError(f"pyarrow must be installed to read {filename}")
+	parquet_file = pyarrow.parquet.ParquetFile(filename)
+	for expected_key in columns or []:
+		if expected_key not in parquet_file.schema_arrow.names:
+			raise ValueError(f"Did not find key {expected_key} in vidinfo file. "
+			                 f"columns: {parquet_file.schema_arrow.names}")
+	for batch in parquet_file.iter_batches(columns=columns):
+		for video in batch.to_pylist():
+			yield {key: number(value) if value is not None else None if key in typed_columns else ''
+			       for key, value in video.items()}
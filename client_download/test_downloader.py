@@ -0,0 +1,194 @@
+import asyncio
+import importlib
+import io
+import os
+import pathlib
+
+import pytest
+
+import downloader
+from journal import Journal
+
+# The log of an 'rclone move -vv --use-json-log' that skips a video that was already downloaded
+# and moves a thumbnail and two videos, the second one with multi-thread copying
+rclone_move_log = os.path.join(os.path.dirname(__file__), 'fixtures', 'rclone_move.log')
+old_video = 'dl/Funhaus/20200101 - Old [a1].mp4'
+thumbnail = 'dl/Funhaus/20200102 - New [b2].jpg'
+new_video = 'dl/Funhaus/20200102 - New [b2].mp4'
+big_video = 'dl/Funhaus/20200103 - Big [c3].mkv'
+
+pyarrow = pytest.importorskip('pyarrow')
+pytest.importorskip('pyarrow.parquet')
+
+
+def info_json(extractor, video_id, filename):
+	return {'_filename': f"/bucket/{filename}", 'extractor': extractor, 'display_id': video_id,
+	        'uploader': 'Rooster Teeth', 'title': 'Podcast #500', 'upload_date': '20200101',
+	        'duration': 3600, 'format_id': '137+140',
+	        'formats': [{'format_id': '137', 'vcodec': 'avc1.640028', 'height': 1080},
+	                    {'format_id': '140', 'acodec': 'mp4a.40.2', 'abr': 128}]}
+
+
+def test_parquet_from_vidinfo_to_download(tmp_path, monkeypatch):
+	# The files are written by client_processing
+	monkeypatch.syspath_prepend(os.path.join(os.path.dirname(__file__), '..', 'client_processing'))
+	categorize = importlib.import_module('categorize')
+	vidinfo = importlib.import_module('vidinfo')
+	vidinfo_file = str(tmp_path / 'vidinfo.parquet')
+	categorized_file = str(tmp_path / 'categorized.parquet')
+	sizes = {'yt.mp4': 2000000000, 'rt.mp4': 1000000000}
+	rows = [tuple(vidinfo.VideoMetadata(info_json(extractor, video_id, filename),
+	                                    base_map=[('/bucket', 'S')], size_map=sizes))
+	        for extractor, video_id, filename in [('youtube', 'yt', 'yt.mp4'),
+	                                              ('RoosterTeeth', 'rt', 'rt.mp4')]]
+	vidinfo.write_parquet(rows, vidinfo_file)
+	schema = pyarrow.parquet.read_schema(vidinfo_file)
+	assert schema.field('Size').type == pyarrow.int64()
+	assert schema.field('Duration').type == pyarrow.float64()
+	assert 'Group' in schema.names
+
+	videos = categorize.read_vidinfo(vidinfo_file, False)
+	assert videos[0]['Size'] == 2000000000
+	assert videos[0]['Duration'] == 3600
+	assert videos[0]['Group'] == ''
+	categorize.write_vidinfo_parquet(categorize.process_vidinfo(videos, set()), categorized_file)
+	schema = pyarrow.parquet.read_schema(categorized_file)
+	assert schema.field('Size').type == pyarrow.int64()
+	assert schema.field('original_row').type == pyarrow.int64()
+	assert schema.field('alive').type == pyarrow.bool_()
+
+	videos = downloader.read_source_file(categorized_file)
+	assert {x['Filename']: x['result'] for x in videos} == {'yt.mp4': 'keep', 'rt.mp4': 'delete'}
+	assert {x['Filename']: x['Size'] for x in videos} == {'yt.mp4': 2000000000,
+	                                                       'rt.mp4': 1000000000}
+	assert [x['Filename'] for x in downloader.filter_videos(videos, 'keep')] == ['yt.mp4']
+	assert downloader.new_filename(videos[0]) == 'yt'
+
+	# csv files have the same values once they're read
+	categorized_csv = str(tmp_path / 'categorized.csv')
+	with open(categorized_csv, 'w', newline='') as file:
+		categorize.write_vidinfo(categorize.process_vidinfo(
+			categorize.read_vidinfo(vidinfo_file, False), set()), file)
+	assert [{key: x[key] for key in videos[0]}
+	        for x in downloader.read_source_file(categorized_csv)] == videos
+
+
+def test_parse_rclone_log():
+	with open(rclone_move_log) as file:
+		logs = [downloader.parse_rclone_log(line.rstrip()) for line in file]
+	# Lines from before logging is set up aren't JSON
+	assert logs[0]['level'] == 'error'
+	assert downloader.format_rclone_log(logs[0]).startswith('ERROR: 2024/05/02 10:15:01 NOTICE')
+	assert [downloader.format_rclone_log(x) for x in logs if x.get('object') == new_video] == [
+		f"INFO: {new_video}: Copied (new)", f"INFO: {new_video}: Deleted"]
+	stats = [downloader.Downloader.StatsMessage(x['stats']) for x in logs if 'stats' in x]
+	assert [x.bytes for x in stats] == [3048213, 7048213, 8048213]
+	assert [x.name for x in stats[0].transferring] == [new_video, big_video]
+
+
+class RecordingPublisher:
+	def __init__(self):
+		self.messages = []
+
+	def publish(self, key, message):
+		self.messages.append(message)
+
+
+@pytest.fixture
+def replaying_rclone(tmp_path, monkeypatch):
+	"""
+	A stand-in for rclone that replays the log
+	"""
+	bin_directory = tmp_path / 'bin'
+	bin_directory.mkdir()
+	(bin_directory / 'rclone').write_text(f"#!/bin/sh\ncat '{rclone_move_log}' >&2\n")
+	(bin_directory / 'rclone').chmod(0o755)
+	monkeypatch.setenv('PATH', f"{bin_directory}{os.pathsep}{os.environ['PATH']}")
+	monkeypatch.chdir(tmp_path)
+
+
+def test_progress_from_rclone_log(replaying_rclone, tmp_path):
+	journal = Journal(str(tmp_path / 'journal.db'))
+	d = downloader.Downloader(io.StringIO('S,wasabi-us:sdg-spout\n'), downloader.aiopubsub.Hub(),
+	                          'test', output_file=io.StringIO(), journal=journal)
+	d.publisher = RecordingPublisher()
+	sizes = {old_video: 1000000, new_video: 3000000, big_video: 5000000}
+	files = []
+	asyncio.run(d.run_rclone('wasabi-us:sdg-spout', '.', 'move', 'filter', ['S'], sizes, 'S',
+	                         files.append))
+
+	progress = [x for x in d.publisher.messages
+	            if isinstance(x, downloader.Downloader.ProgressMessage)]
+	# Bytes are credited as they're transferred, and every byte is credited exactly once
+	assert sum(x.items or 0 for x in progress) == 3
+	assert sum(x.bytes or 0 for x in progress) == sum(sizes.values())
+	assert files == [old_video, thumbnail, new_video, big_video]
+	for path in files:
+		assert journal.get('S', path) == {'transferred', 'deleted'}
+	journal.close()
+
+	# The last stats are kept in the total after the task finishes
+	throughput = [x for x in d.publisher.messages
+	              if isinstance(x, downloader.Downloader.ThroughputMessage)]
+	assert [(x.bytes, x.tasks) for x in throughput] == [
+		(3048213, 1), (7048213, 1), (8048213, 1), (8048213, 0)]
+	assert throughput[-1].speed == 0
+
+
+def test_throughput_of_concurrent_tasks(replaying_rclone, tmp_path):
+	# Report the first stats, then wait for the other task to start before replaying the log
+	(tmp_path / 'bin' / 'rclone').write_text(
+		f"#!/bin/sh\ngrep -m 1 '\"stats\"' '{rclone_move_log}' >&2\nsleep 0.5\n"
+		f"cat '{rclone_move_log}' >&2\n")
+	d = downloader.Downloader(io.StringIO('S,wasabi-us:sdg-spout\n'), downloader.aiopubsub.Hub(),
+	                          'test', output_file=io.StringIO())
+	d.publisher = RecordingPublisher()
+
+	async def run_both():
+		await asyncio.gather(*[d.run_rclone('wasabi-us:sdg-spout', '.', 'copy', 'filter',
+		                                    ['S', task], server_name='S') for task in ('t0', 't1')])
+
+	asyncio.run(run_both())
+	throughput = [x for x in d.publisher.messages
+	              if isinstance(x, downloader.Downloader.ThroughputMessage)]
+	assert max(x.tasks for x in throughput) == 2
+	assert (throughput[-1].bytes, throughput[-1].tasks) == (2 * 8048213, 0)
+
+
+class ForgetfulRcd:
+	"""
+	A stand-in for Rcd that moves every file from one local directory to another, but like
+	rclone's core/transferred, only remembers the last file it moved
+	"""
+	async def list_files(self, fs, **params):
+		return {path.relative_to(fs).as_posix(): path.stat().st_size
+		        for path in sorted(pathlib.Path(fs).rglob('*')) if path.is_file()}
+
+	async def run_job(self, command, params, on_update):
+		moved = []
+		for path in await self.list_files(params['srcFs']):
+			os.renames(os.path.join(params['srcFs'], path), os.path.join(params['dstFs'], path))
+			moved.append({'name': path, 'size': 1, 'bytes': 1, 'checked': False})
+		on_update({}, moved[-1:])
+		return {'finished': True, 'success': True}
+
+
+def test_rcd_move_reports_every_file(tmp_path, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+	server = tmp_path / 'server'
+	for path in old_video, thumbnail, new_video, big_video:
+		(server / path).parent.mkdir(parents=True, exist_ok=True)
+		(server / path).write_text(path)
+
+	journal = Journal(str(tmp_path / 'journal.db'))
+	d = downloader.Downloader(io.StringIO(f"S,{server}\n"), downloader.aiopubsub.Hub(), 'test',
+	                          output_file=io.StringIO(), journal=journal, rcd=ForgetfulRcd())
+	d.publisher = RecordingPublisher()
+	files = []
+	asyncio.run(d.run_rclone(str(server), str(tmp_path / 'out'), 'move', 'filter', ['S'],
+	                         None, 'S', files.append))
+
+	assert sorted(files) == sorted([old_video, thumbnail, new_video, big_video])
+	for path in files:
+		assert journal.get('S', path) == {'transferred', 'deleted'}
+	journal.close()
@@ -0,0 +1,48 @@
+import asyncio
+import os
+
+import pytest
+
+import merge
+
+
+class DiscardingPublisher:
+	def publish(self, key, message):
+		pass
+
+
+@pytest.fixture
+def mkvmerge(tmp_path, monkeypatch):
+	"""
+	A stand-in for mkvmerge that takes a while, then writes the name of its last input to its
+	output, or fails if that name contains "bad"
+	"""
+	bin_directory = tmp_path / 'bin'
+	bin_directory.mkdir()
+	(bin_directory / 'mkvmerge').write_text(
+		'#!/bin/sh\nsleep 0.2\nfor last; do :; done\n'
+		'case "$last" in *bad*) exit 1;; esac\necho "$last" > "$3"\n')
+	(bin_directory / 'mkvmerge').chmod(0o755)
+	monkeypatch.setenv('PATH', f"{bin_directory}{os.pathsep}{os.environ['PATH']}")
+	monkeypatch.chdir(tmp_path)
+
+
+def test_concurrent_merges_get_different_names(mkvmerge, tmp_path):
+	(tmp_path / 'out').mkdir()
+	(tmp_path / 'out' / 'video.mkv').write_text('already there\n')
+
+	async def merge_all():
+		await asyncio.gather(*[merge.merge_async([f"{x}.mp4"], [], [], [], 'out/video.mkv',
+		                                         DiscardingPublisher()) for x in 'abc'])
+
+	asyncio.run(merge_all())
+	outputs = {x: (tmp_path / 'out' / x).read_text() for x in os.listdir(tmp_path / 'out')}
+	assert outputs == {'video.mkv': 'already there\n', 'video_1.mkv': 'a.mp4\n',
+	                   'video_2.mkv': 'b.mp4\n', 'video_3.mkv': 'c.mp4\n'}
+
+
+def test_failed_merge_releases_its_name(mkvmerge, tmp_path):
+	with pytest.raises(RuntimeError):
+		asyncio.run(merge.merge_async(['bad.mp4'], [], [], [], 'out/video.mkv',
+		                              DiscardingPublisher()))
+	assert os.listdir(tmp_path / 'out') == []
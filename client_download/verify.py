@@ -0,0 +1,77 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import os
+
+from listing import parse_lsjson_line
+
+
+def md5sum(filename, chunk_size=1024 * 1024):
+	"""
+	:return: the MD5 hash of a file as a hex string
+	"""
+	md5 = hashlib.md5()
+	with open(filename, 'rb') as file:
+		while chunk := file.read(chunk_size):
+			md5.update(chunk)
+	return md5.hexdigest()
+
+
+async def remote_files(server, filter_file, files_from=False):
+	"""
+	Get the sizes and MD5 hashes of files on an rclone server with 'rclone lsjson --hash'. Backends
+	that don't store MD5 hashes (like S3, for files uploaded in parts) only give the size.
+	:param server: an rclone path like "wasabi-us:sdg-spout"
+	:param filter_file: filter file selecting the files, or a list of paths if files_from
+	:param files_from: Whether filter_file is a list of exact paths rather than filters
+	:return: a dict like {path: {"Size": 40186938, "Hashes": {"md5": "..."}}}
+	"""
+	p = await asyncio.create_subprocess_exec(
+		'rclone', 'lsjson', '-R', '--files-only', '--no-mimetype', '--no-modtime', '--hash',
+		'--hash-type', 'md5',
+		*(['--files-from', filter_file, '--no-traverse'] if files_from
+		  else ['--include-from', filter_file]), server,
+		stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+	output, errors = await p.communicate()
+	if p.returncode != 0:
+		raise RuntimeError(f"rclone lsjson {server} exited with return code {p.returncode}: "
+		                   f"{errors.decode('utf-8').strip()}")
+	items = (parse_lsjson_line(line) for line in output.decode('utf-8').splitlines())
+	return {x['Path']: x for x in items if x is not None}
+
+
+class Verifier:
+	def __init__(self, jobs=4):
+		"""
+		Check downloaded files against the copies on the server
+		:param jobs: maximum number of files to hash at once
+		"""
+		# hashlib releases the GIL while hashing, so threads hash files in parallel
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+
+	async def verify(self, filename, remote):
+		"""
+		Check a downloaded file against the copy on the server, by MD5 hash if the server has
+		one, or else by size
+		:param filename: path to the downloaded file
+		:param remote: the file's entry from remote_files, or None if it wasn't found
+		:return: None if it matches, or else why not
+		"""
+		if remote is None:
+			return "not found on the server"
+		try:
+			size = os.path.getsize(filename)
+		except OSError as ex:
+			return str(ex)
+		if size != remote.get('Size'):
+			return f"{size} bytes, but {remote.get('Size')} bytes on the server"
+		md5 = (remote.get('Hashes') or {}).get('md5')
+		if md5:
+			local_md5 = await asyncio.get_running_loop().run_in_executor(
+				self.executor, md5sum, filename)
+			if local_md5 != md5:
+				return f"MD5 {local_md5}, but {md5} on the server"
+		return None
+
+	def close(self):
+		self.executor.shutdown()
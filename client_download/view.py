@@ -58,6 +58,8 @@ class DownloadView:
 		self.hub = hub
 		self.log_lines = []
 		self.jobs = OrderedDict()
+		self.scheduler = None
+		self.throughput = None
 
 		self.stdscr = curses.initscr()
 		curses.noecho()
@@ -91,7 +93,15 @@ class DownloadView:
 		print('; '.join([f"{'.'.join(key)}: {job}" for key, job in self.jobs.items()]))
 
 	def update_jobs(self, key, message):
-		if isinstance(message, Downloader.ProgressMessage):
+		if isinstance(message, (Downloader.ProgressMessage, Downloader.StatsMessage)):
+			return
+		if isinstance(message, Downloader.SchedulerMessage):
+			self.scheduler = message
+			self.refresh_progress_window()
+			return
+		if isinstance(message, Downloader.ThroughputMessage):
+			self.throughput = message
+			self.refresh_progress_window()
 			return
 		if isinstance(message, Downloader.NewTaskMessage) and (
 				message.total_items or message.total_bytes):
@@ -103,6 +113,11 @@ class DownloadView:
 		self.refresh_progress_window()
 
 	def log(self, key, message):
+		if isinstance(message, (Downloader.StatsMessage, Downloader.SchedulerMessage,
+		                        Downloader.ThroughputMessage)) or (
+				isinstance(message, Downloader.ProgressMessage) and message.message is None):
+			# Periodic progress is shown in the progress window rather than logged
+			return
 		log_message = f"[{'.'.join(key)}] {message}"
 		print(log_message, file=self.logfile)
 		self.log_lines.append(log_message)
@@ -110,7 +125,7 @@ class DownloadView:
 
 	def create_windows(self):
 		self.height, self.width = self.stdscr.getmaxyx()
-		self.progress_height = max(4, len(self.jobs) + 1)
+		self.progress_height = max(4, len(self.jobs) + 2)
 		self.log_height = self.height - self.progress_height
 		self.log_pad = InfinitePad(self.stdscr, self.log_height, self.width, self.progress_height,
 		                           0)
@@ -127,12 +142,15 @@ class DownloadView:
 			self.progress_window.clear()
 		for key, job in self.jobs.items():
 			self.progress_window.addstr(f"{'.'.join(key)}: {job}")
+		if self.scheduler or self.throughput:
+			self.progress_window.addstr(' - '.join(str(x) for x in (self.scheduler, self.throughput)
+			                                       if x))
 		self.progress_window.refresh()
 
 	def need_new_windows(self):
 		return (not self.log_pad or not self.progress_window or
 		        (self.height, self.width) != self.stdscr.getmaxyx() or
-		        self.progress_height < len(self.jobs))
+		        self.progress_height < len(self.jobs) + 1)
 
 	class Job:
 		def __init__(self, key, hub, total_items, total_bytes, view):
@@ -140,6 +158,7 @@ class DownloadView:
 			self.total_bytes = total_bytes
 			self.processed_items = 0
 			self.processed_bytes = 0
+			self.stats = {}  # key of each rclone process -> latest StatsMessage
 			self.subscriber = aiopubsub.Subscriber(hub, '.'.join(key))
 			self.subscriber.add_sync_listener(aiopubsub.Key(*key, '*'), self.update_progress)
 			self.view = view
@@ -154,9 +173,21 @@ class DownloadView:
 					string += ', '
 			if self.total_bytes:
 				string += f"{naturalsize(self.processed_bytes)} / {naturalsize(self.total_bytes)}"
+			if self.stats:
+				string += f" at {naturalsize(sum(x.speed for x in self.stats.values()))}/s"
+				transferring = [x for stats in self.stats.values() for x in stats.transferring]
+				if transferring:
+					string += f" ({', '.join(f'{x.percentage}%' for x in transferring)})"
 			return string
 
 		def update_progress(self, key, message):
+			if isinstance(message, Downloader.StatsMessage):
+				self.stats[key] = message
+				self.view.refresh_progress_window()
+				return
+			if isinstance(message, Downloader.CompletedMessage):
+				self.stats.pop(key, None)
+				return
 			if not isinstance(message, Downloader.ProgressMessage):
 				return
 			if message.items:
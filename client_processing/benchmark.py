@@ -0,0 +1,310 @@
+import argparse
+import csv
+import datetime
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+from categorize import longest_common_substring, process_vidinfo, read_vidinfo, titles_match, \
+	write_vidinfo
+import vidinfo
+from vidinfo import VideoMetadata, load_json, read_files
+
+words = ['Achievement', 'Hunter', 'Minecraft', 'Lets', 'Play', 'Rooster', 'Teeth', 'Podcast',
+         'Episode', 'Part', 'Funhaus', 'Off', 'Topic', 'Things', 'to', 'Do', 'in', 'the', 'of',
+         'VS', 'Top', '10', 'Best', 'Worst', 'Ever', 'Live', 'Gameplay', 'Highlights', 'Trials']
+
+channels = ['Achievement Hunter', 'LetsPlay', 'Rooster Teeth', 'Funhaus', 'Red vs. Blue',
+            'Inside Gaming', 'Camp Camp', 'Good Boy Gaming']
+
+manual_columns = ['Group', 'Series', 'Episode', 'Output Title', 'Part', 'Flag']
+
+results_header = ['date', 'commit', 'stage', 'rows', 'seconds', 'peak_mb']
+
+
+def random_title(rng):
+	return ' '.join(rng.choice(words) for _ in range(rng.randint(3, 12)))
+
+
+def noisy_title(rng, title):
+	"""Simulate the differences seen between YT and RT titles of the same video"""
+	choice = rng.randint(0, 3)
+	if choice == 0:
+		return title
+	if choice == 1:
+		return f"{title} - {rng.choice(words)} #{rng.randint(1, 300)}"
+	if choice == 2:
+		return f"{rng.choice(words)} {rng.choice(words)}: {title}"
+	return random_title(rng)
+
+
+def title_pairs(count, seed=0):
+	rng = random.Random(seed)
+	pairs = []
+	for _ in range(count):
+		title = random_title(rng)
+		pairs.append((title, noisy_title(rng, title)))
+	return pairs
+
+
+def lcs_match(s1, s2):
+	return len(longest_common_substring(s1, s2)) >= max(len(s1), len(s2)) // 2
+
+
+def benchmark_titles(count, repeat, logfile):
+	pairs = title_pairs(count)
+	mismatches = sum(1 for s1, s2 in pairs if lcs_match(s1, s2) != titles_match(s1, s2))
+	if mismatches:
+		raise RuntimeError(f"titles_match disagrees with longest_common_substring on "
+		                   f"{mismatches} of {count} pairs")
+	for name, function in ('longest_common_substring', lcs_match), ('titles_match', titles_match):
+		seconds = min(timeit.repeat(lambda: [function(s1, s2) for s1, s2 in pairs],
+		                            number=1, repeat=repeat))
+		print(f"{name}: {count} pairs in {seconds:.3f} s "
+		      f"({seconds / count * 1e6:.1f} us per pair)", file=logfile)
+
+
+def random_formats(rng, count):
+	"""Filler formats, since real info.json files list dozens"""
+	return [{'format_id': str(100 + i), 'ext': rng.choice(['mp4', 'webm', 'm4a']),
+	         'url': f"https://example.com/videoplayback?itag={100 + i}&"
+	                f"{'x' * rng.randint(200, 800)}",
+	         'height': rng.choice([None, 144, 240, 360, 480, 720, 1080]),
+	         'tbr': rng.randint(50, 5000), 'filesize': rng.randint(10 ** 5, 10 ** 9),
+	         'http_headers': {'User-Agent': 'Mozilla/5.0', 'Accept-Language': 'en-us,en;q=0.5'}}
+	        for i in range(count)]
+
+
+def generate_info(rng, website, video_id, channel, title, date, duration, height):
+	"""
+	Generate an info.json dict with the fields VideoMetadata uses, plus filler of realistic size
+	"""
+	if website == 'youtube':
+		audio = {'format_id': '140', 'acodec': 'mp4a.40.2', 'vcodec': 'none', 'abr': 128}
+		video = {'format_id': '137', 'acodec': 'none',
+		         'vcodec': rng.choice(['avc1.640028', 'vp9']), 'height': height, 'fps': 30,
+		         'vbr': rng.randint(1000, 5000)}
+		format_id = '137+140'
+		formats = random_formats(rng, rng.randint(10, 30)) + [audio, video]
+		extension = 'mkv' if video['vcodec'] == 'vp9' else 'mp4'
+	else:
+		video = {'format_id': f'hls-{height}p', 'acodec': 'mp4a.40.2', 'vcodec': 'avc1.4d401f',
+		         'height': height, 'fps': 30, 'tbr': rng.randint(1000, 6000)}
+		format_id = video['format_id']
+		formats = random_formats(rng, rng.randint(3, 8)) + [video]
+		extension = 'mp4'
+	rng.shuffle(formats)
+	return {
+		'_filename': f"dl/{channel}/{date} - {title} [{video_id}].{extension}",
+		'extractor': website,
+		'display_id': video_id,
+		'id': video_id,
+		'uploader': channel,
+		'fulltitle': title,
+		'title': title,
+		'upload_date': date,
+		'duration': duration,
+		'description': ' '.join(rng.choice(words) for _ in range(rng.randint(10, 200))),
+		'subtitles': {'en': [{'ext': 'vtt', 'url': 'https://example.com/subs'}]}
+		if rng.random() < 0.3 else {},
+		'format_id': format_id,
+		'formats': formats,
+		'thumbnails': [{'url': f"https://example.com/thumb/{video_id}/{i}.jpg", 'id': str(i)}
+		               for i in range(rng.randint(1, 40))],
+	}
+
+
+def generate_catalog(count, duplicate_rate=0.3, title_noise=0.3, videos_per_day=20, seed=0):
+	"""
+	Generate info.json dicts and file sizes for a synthetic catalog, deterministically
+	:param count: number of videos
+	:param duplicate_rate: fraction of videos that have a copy on the other website
+	:param title_noise: fraction of copies that have a different title
+	:param videos_per_day: average number of videos uploaded per day
+	:param seed: random seed
+	:return: generator of (info.json dict, file size or None if the file doesn't exist)
+	"""
+	rng = random.Random(seed)
+	first_day = datetime.date(2012, 1, 1)
+	days = max(1, round(count / videos_per_day / (1 + duplicate_rate)))
+	generated = 0
+	while generated < count:
+		website = rng.choice(['youtube', 'RoosterTeeth'])
+		day = first_day + datetime.timedelta(days=rng.randrange(days))
+		title = random_title(rng)
+		duration = rng.randint(30, 7200)
+		copies = [(website, day, title, duration)]
+		if rng.random() < duplicate_rate:
+			copies.append(('RoosterTeeth' if website == 'youtube' else 'youtube',
+			               day + datetime.timedelta(days=rng.choice([0, 0, 1])),
+			               noisy_title(rng, title) if rng.random() < title_noise else title,
+			               duration + rng.randint(-5, 30)))
+		for website, day, title, duration in copies[:count - generated]:
+			info = generate_info(rng, website, f"v{generated:08d}", rng.choice(channels), title,
+			                     day.strftime('%Y%m%d'), duration, rng.choice([480, 720, 1080]))
+			size = duration * rng.randint(100, 1000) * 1000 if rng.random() < 0.95 else None
+			generated += 1
+			yield info, size
+
+
+def write_catalog(catalog, directory):
+	"""
+	Write info.json files to a directory, like the youtube-dl output format in download3.sh
+	:param catalog: iterable of (info.json dict, file size) from generate_catalog
+	:param directory: where to write the files
+	:return: size map like {"video1.mkv": 40186938}, like vidinfo.py's --size-map
+	"""
+	sizes = {}
+	for info, size in catalog:
+		filename = os.path.join(directory, info['_filename'].rsplit('.', 1)[0] + '.info.json')
+		os.makedirs(os.path.dirname(filename), exist_ok=True)
+		with open(filename, 'w') as file:
+			json.dump(info, file)
+		if size is not None:
+			sizes[info['_filename'].removeprefix('dl/')] = size
+	return sizes
+
+
+def benchmark_json(count, repeat, logfile, **catalog_options):
+	"""
+	Time decoding info.json files with json and with load_json, which uses orjson if it's installed
+	:param count: number of files
+	:param repeat: number of times to repeat each timing
+	:param logfile: where to print timings
+	:param catalog_options: options for generate_catalog
+	"""
+	def json_load(filename):
+		with open(filename) as file:
+			return json.load(file)
+
+	with tempfile.TemporaryDirectory() as directory:
+		write_catalog(generate_catalog(count, **catalog_options), directory)
+		filenames = vidinfo.find_json_files(directory)
+		total_mb = sum(os.path.getsize(x) for x in filenames) / 1024 ** 2
+		backend = 'orjson' if vidinfo.orjson else 'json'
+		for name, function in ('json.load', json_load), (f'load_json ({backend})', load_json):
+			seconds = min(timeit.repeat(
+				lambda: [VideoMetadata(function(x), base_map=[('dl', 'wasabi')])
+				         for x in filenames],
+				number=1, repeat=repeat))
+			print(f"{name}: {count} files ({total_mb:.0f} MB) in {seconds:.3f} s "
+			      f"({total_mb / seconds:.0f} MB/s)", file=logfile)
+
+
+def write_vidinfo_csv(videos, filename):
+	"""
+	Write the output of vidinfo.py plus the columns added manually, as categorize.py expects
+	"""
+	with open(filename, 'w', newline='', encoding='utf-8') as file:
+		writer = csv.writer(file, dialect='excel', quoting=csv.QUOTE_ALL)
+		writer.writerow(VideoMetadata.csv_header + manual_columns)
+		writer.writerows(list(video) + [''] * len(manual_columns) for video in videos)
+
+
+def current_commit():
+	result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+	                        text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+	return result.stdout.strip() if result.returncode == 0 else ''
+
+
+def benchmark_catalog(count, logfile, results_writer, memory=False, **catalog_options):
+	"""
+	Time each stage of vidinfo.py and categorize.py on a synthetic catalog
+	:param count: number of videos
+	:param logfile: where to print timings
+	:param results_writer: csv writer for results
+	:param memory: whether to measure the peak memory allocated by each stage, which slows down
+	allocations, so the timings aren't comparable with runs without it
+	:param catalog_options: options for generate_catalog
+	"""
+	commit = current_commit()
+	date = datetime.datetime.now().isoformat(timespec='seconds')
+
+	def timed(stage, function, *args, **kwargs):
+		if memory:
+			tracemalloc.reset_peak()
+			before, _ = tracemalloc.get_traced_memory()
+		start = time.perf_counter()
+		result = function(*args, **kwargs)
+		seconds = time.perf_counter() - start
+		if memory:
+			# Memory held before the stage, like its input, isn't counted
+			peak = (tracemalloc.get_traced_memory()[1] - before) / 1024 ** 2
+			print(f"{stage}: {count} rows in {seconds:.3f} s (peak {peak:.0f} MB allocated)",
+			      file=logfile)
+			results_writer.writerow([date, commit, stage, count, f"{seconds:.3f}", f"{peak:.0f}"])
+		else:
+			print(f"{stage}: {count} rows in {seconds:.3f} s", file=logfile)
+			results_writer.writerow([date, commit, stage, count, f"{seconds:.3f}", ''])
+		return result
+
+	if memory:
+		tracemalloc.start()
+
+	with tempfile.TemporaryDirectory() as directory:
+		sizes = timed('write_catalog', write_catalog, generate_catalog(count, **catalog_options),
+		              directory)
+
+		with open(os.devnull, 'w') as devnull:
+			videos = timed('read_files', read_files, os.path.join(directory, 'dl'), devnull,
+			               base_map=[('dl', 'wasabi')], size_map=sizes)
+			vidinfo_filename = os.path.join(directory, 'vidinfo.csv')
+			write_vidinfo_csv(videos, vidinfo_filename)
+			del videos
+
+			vidinfo = timed('read_vidinfo', read_vidinfo, vidinfo_filename, False)
+			vidinfo = timed('process_vidinfo', process_vidinfo, vidinfo, set())
+			timed('write_vidinfo', write_vidinfo, vidinfo, devnull)
+	if memory:
+		tracemalloc.stop()
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark the client processing scripts")
+	parser.add_argument('suites', nargs='*', choices=['titles', 'json', 'catalog'],
+	                    default=['titles', 'json', 'catalog'], help="benchmarks to run")
+	parser.add_argument('-c', '--count', help="number of title pairs", type=int, default=10000)
+	parser.add_argument('-r', '--repeat', help="number of times to repeat each timing",
+	                    type=int, default=3)
+	# A catalog of a million videos is over 10 GB of info.json files, so it has to be asked for
+	parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[10000, 100000],
+	                    help="numbers of videos in the synthetic catalogs (default: 10000 100000)")
+	parser.add_argument('-d', '--duplicate-rate', type=float, default=0.3,
+	                    help="fraction of videos with a copy on the other website")
+	parser.add_argument('--title-noise', type=float, default=0.3,
+	                    help="fraction of copies with a different title")
+	parser.add_argument('--videos-per-day', type=float, default=20,
+	                    help="average number of videos uploaded per day")
+	parser.add_argument('--seed', type=int, default=0, help="random seed")
+	parser.add_argument('-m', '--memory', action='store_true',
+	                    help="also measure the peak memory allocated by each catalog stage, which "
+	                         "makes them slower")
+	parser.add_argument('-o', '--results', help="csv file to append results to",
+	                    default='benchmark_results.csv')
+	args = parser.parse_args()
+
+	if 'titles' in args.suites:
+		benchmark_titles(args.count, args.repeat, sys.stdout)
+
+	if 'json' in args.suites:
+		benchmark_json(min(args.sizes), args.repeat, sys.stdout,
+		               duplicate_rate=args.duplicate_rate, title_noise=args.title_noise,
+		               videos_per_day=args.videos_per_day, seed=args.seed)
+
+	if 'catalog' in args.suites:
+		new_results_file = not os.path.exists(args.results)
+		with open(args.results, 'a', newline='') as results_file:
+			writer = csv.writer(results_file)
+			if new_results_file:
+				writer.writerow(results_header)
+			for size in args.sizes:
+				benchmark_catalog(size, sys.stdout, writer, args.memory,
+				                  duplicate_rate=args.duplicate_rate,
+				                  title_noise=args.title_noise,
+				                  videos_per_day=args.videos_per_day, seed=args.seed)
@@ -1,8 +1,22 @@
 import argparse
+import bisect
+import concurrent.futures
 import csv
+import functools
+import heapq
+import itertools
 import locale
+import math
 import sys
 
+from match_cache import MatchCache, content_hash, decision_key, fingerprint_rows
+from vidinfo_parquet import iter_parquet_rows, parse_row, write_parquet_rows
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
 locale.setlocale(locale.LC_ALL, '')
 
 
@@ -22,17 +36,176 @@ def longest_common_substring(s1, s2):
 	return s1[x_longest - longest: x_longest]
 
 
+@functools.lru_cache(maxsize=65536)
+def _substrings(s, length):
+	"""
+	Get every substring of s with the given length. Cached, since each title is compared to many
+	others with the same length requirement.
+	"""
+	return frozenset(s[i:i + length] for i in range(len(s) - length + 1))
+
+
+def titles_match(s1, s2):
+	"""
+	Check whether the longest common substring of two titles is at least half of the longer title.
+	Equivalent to len(longest_common_substring(s1, s2)) >= max(len(s1), len(s2)) // 2, but only
+	checks substrings of exactly the required length instead of filling in the whole DP matrix.
+	:param s1: a title
+	:param s2: another title
+	:return: True if the titles match
+	"""
+	shorter, longer = sorted((s1, s2), key=len)
+	required = len(longer) // 2
+	if required == 0:
+		return True
+	if len(shorter) < required:
+		return False
+	# Any common substring at least as long as required contains one exactly that long
+	candidates = _substrings(shorter, required)
+	return any(longer[i:i + required] in candidates for i in range(len(longer) - required + 1))
+
+
+TITLE_NGRAM = 3
+
+
+def _ngrams(title):
+	return {title[i:i + TITLE_NGRAM] for i in range(len(title) - TITLE_NGRAM + 1)}
+
+
+def duration_bounds(duration):
+	"""
+	Find the range of durations that can match the given duration, i.e. those where the longer one
+	is within 5% + max(45 seconds, 10%) of the shorter one. The range is padded slightly, so the
+	exact check still needs to be done.
+	:param duration: duration in seconds
+	:return: (shortest, longest) matching duration in seconds
+	"""
+	shortest = min((duration - 45) / 1.05, duration / 1.15)
+	longest = duration * 1.05 + max(45., duration / 10)
+	return math.floor(shortest) - 1, math.ceil(longest) + 1
+
+
+class CandidateIndex:
+	def __init__(self, videos):
+		"""
+		Build a blocking index over a vidinfo list sorted by date, so each video is only compared
+		to videos that can pass the date, length and title checks in process_vidinfo.
+		Videos are bucketed by date, sorted by duration within each bucket, and indexed by title
+		n-grams within each bucket. Two titles can only match without sharing an n-gram if both are
+		shorter than 2 * TITLE_NGRAM.
+		:param videos: list of dicts representing a vidinfo file, sorted by date
+		"""
+		self.durations = {}  # date -> sorted list of (duration, index)
+		self.unknown_durations = {}  # date -> set of indices without a usable duration
+		self.ngrams = {}  # date -> {ngram -> set of indices}
+		self.short_titles = {}  # date -> set of indices with titles shorter than 2 * TITLE_NGRAM
+		for i, video in enumerate(videos):
+			if not video['Date']:
+				continue
+			date = int(video['Date'])
+			if video['Duration'] is None:
+				self.unknown_durations.setdefault(date, set()).add(i)
+			else:
+				self.durations.setdefault(date, []).append((int(video['Duration']), i))
+			ngrams = self.ngrams.setdefault(date, {})
+			for ngram in _ngrams(video['Title']):
+				ngrams.setdefault(ngram, set()).add(i)
+			if len(video['Title']) < 2 * TITLE_NGRAM:
+				self.short_titles.setdefault(date, set()).add(i)
+		for entries in self.durations.values():
+			entries.sort()
+		self.duration_keys = {date: [x[0] for x in entries]
+		                      for date, entries in self.durations.items()}
+
+	def candidates(self, index, video):
+		"""
+		Find the videos after the given one which might be the same video
+		:param index: index of the video in the list the index was built from
+		:param video: the video at that index
+		:return: sorted list of candidate indices
+		"""
+		date = int(video['Date'])
+		title_ngrams = _ngrams(video['Title'])
+		short_title = len(video['Title']) < 2 * TITLE_NGRAM
+		if video['Duration'] is None:
+			shortest, longest = -math.inf, math.inf
+		else:
+			shortest, longest = duration_bounds(int(video['Duration']))
+
+		results = set()
+		for bucket in date, date + 1:
+			entries = self.durations.get(bucket, [])
+			keys = self.duration_keys.get(bucket, [])
+			by_duration = {i for _, i in entries[bisect.bisect_left(keys, shortest):
+			                                     bisect.bisect_right(keys, longest)]}
+			by_duration |= self.unknown_durations.get(bucket, set())
+			if not by_duration:
+				continue
+
+			ngrams = self.ngrams.get(bucket, {})
+			by_title = set().union(*(ngrams.get(x, ()) for x in title_ngrams))
+			if short_title:
+				by_title |= self.short_titles.get(bucket, set())
+
+			results |= by_duration & by_title
+		return sorted(i for i in results if i > index)
+
+
+# Columns a vidinfo file has to have, as written by vidinfo.py and filled in manually
+vidinfo_columns = ('Server', 'Filename', 'Size', 'Website', 'ID', 'Channel', 'Title', 'Date',
+                   'Duration', 'Subtitles', 'Height', 'Group', 'Series', 'Episode', 'Output Title',
+                   'Part', 'Flag', 'Audio bitrate', 'Video codec', 'Audio codec')
+
+
 def read_vidinfo(filename, tab_separated):
+	return list(iter_vidinfo(filename, tab_separated))
+
+
+def iter_vidinfo(filename, tab_separated):
+	"""
+	Read a vidinfo file one row at a time
+	:param filename: path to the vidinfo file
+	:param tab_separated: whether the file is UTF-16 TSV rather than UTF-8 CSV. Files ending in
+	.parquet are read as Parquet
+	:return: generator of dicts representing vidinfo rows, with numbers and booleans in the columns
+	that have them (see vidinfo_parquet)
+	"""
+	for i, video in enumerate(iter_parquet_rows(filename) if filename.endswith('.parquet') else
+	                          map(parse_row, iter_csv(filename, tab_separated))):
+		if i == 0:
+			for expected_key in vidinfo_columns:
+				if expected_key not in video:
+					raise ValueError(
+						f"Did not find key {expected_key} in vidinfo csv. values: {video}")
+		yield video
+
+
+def iter_csv(filename, tab_separated):
 	with open(filename, 'r', newline='',
 	          encoding='utf-16' if tab_separated else 'utf-8') as csvfile:
-		reader = csv.DictReader(csvfile, dialect='excel-tab' if tab_separated else 'excel')
-		videos = list(reader)
-	for expected_key in 'Server', 'Filename', 'Size', 'Website', 'ID', 'Channel', 'Title', 'Date', \
-	                    'Duration', 'Subtitles', 'Height', 'Group', 'Series', 'Episode', \
-	                    'Output Title', 'Part', 'Flag', 'Audio bitrate', 'Video codec', 'Audio codec':
-		if expected_key not in videos[0]:
-			raise ValueError(f"Did not find key {expected_key} in vidinfo csv. values: {videos[0]}")
-	return videos
+		yield from csv.DictReader(csvfile, dialect='excel-tab' if tab_separated else 'excel')
+
+
+def sort_stream(videos, buffer_size):
+	"""
+	Sort a stream of videos by date (stably), holding at most buffer_size videos in memory.
+	This only works if no video is more than buffer_size rows after a video with a later date.
+	:param videos: iterable of dicts representing vidinfo rows
+	:param buffer_size: number of videos to hold in memory
+	:return: generator of dicts representing vidinfo rows, sorted by date
+	"""
+	heap = []
+	last_date = None
+	for i, video in enumerate(videos):
+		if last_date is not None and video['Date'] < last_date:
+			raise ValueError(f"Video {video['ID']} with date {video['Date']} came after videos "
+			                 f"dated {last_date}; use a bigger sort buffer or sort the input")
+		heapq.heappush(heap, (video['Date'], i, video))
+		if len(heap) > buffer_size:
+			last_date, _, video = heapq.heappop(heap)
+			yield video
+	while heap:
+		yield heapq.heappop(heap)[2]
 
 
 def read_alive_list(filename):
@@ -52,30 +225,555 @@ def quality(video_info):
 	# When audio bitrate is given, it is correct.
 	# For now, need to use just the file size, duration, audio codec and bitrate, and video codec.
 
-	if not video_info['Size']:
+	if video_info['Size'] is None:
 		return 0
 
 	# These are integers in case the file size is big.
 	# Once we have total bitrate (a smallish number), casting it to float later is fine
-	file_size_kbits = locale.atoi((video_info['Size'] or '0').strip()) * 8 // 1000
+	file_size_kbits = video_info['Size'] * 8 // 1000
 	total_bitrate = file_size_kbits // int(video_info['Duration'])
 
 	# In a small sample of RoosterTeeth videos with unknown audio bitrate using AAC (mp4a.*), the
 	# audio bitrate was usually about 128 kbps. Otherwise, assume it's 160 kbps unless specified.
 	audio_bitrate = int(video_info['Audio bitrate'] or (
-		128 if (video_info['Audio codec'] or '').startswith('mp4a.') else 160))
+		128 if (video_info['Audio codec'] or '').startswith('mp4a') else 160))
 
 	approximate_video_bitrate = total_bitrate - audio_bitrate
 
 	# H.264 (avc1.*) needs about 50% more bitrate than AV1 (av01.*), VP9 (vp9), H.264 (hvc1.*):
 	# https://blogs.gnome.org/rbultje/2015/09/28/vp9-encodingdecoding-performance-vs-hevch-264/
-	if (video_info['Video codec'] or '').startswith(('av01.', 'vp9', 'hvc1.')):
+	if (video_info['Video codec'] or '').startswith(('av01', 'vp9', 'hvc1')):
 		approximate_video_bitrate *= 1.5
 
 	return approximate_video_bitrate
 
 
-def process_vidinfo(input_vidinfo, alivelist):
+def videos_match(current, compare):
+	"""
+	Check whether two videos that were uploaded within a day of each other match
+	:param current: dict representing a video
+	:param compare: dict representing another video
+	:return: True if the videos are assumed to be identical
+	"""
+	# Check for a length mismatch
+	len1 = int(current['Duration'])
+	len2 = int(compare['Duration'])
+	min_length = min(len1, len2)
+	max_length = max(len1, len2)
+	if max_length > min_length * 1.05 + max(45., min_length / 10):
+		return False
+
+	# Check for a title mismatch
+	return titles_match(current['Title'], compare['Title'])
+
+
+def quality_scores(input_vidinfo):
+	"""
+	Compute quality() for every video at once.
+	Videos that quality() can't handle (such as a zero duration) are NaN, so quality() can be
+	called for them to get the same error.
+	:param input_vidinfo: list of dicts representing a vidinfo file
+	:return: numpy array of bitrates in kbps, or None if numpy isn't installed
+	"""
+	if numpy is None:
+		return None
+
+	sizes = numpy.zeros(len(input_vidinfo), dtype=numpy.int64)
+	durations = numpy.ones(len(input_vidinfo), dtype=numpy.int64)
+	audio_bitrates = numpy.zeros(len(input_vidinfo), dtype=numpy.int64)
+	valid = numpy.ones(len(input_vidinfo), dtype=bool)
+	has_size = numpy.zeros(len(input_vidinfo), dtype=bool)
+	for i, video in enumerate(input_vidinfo):
+		if video['Size'] is None:
+			continue
+		has_size[i] = True
+		if video['Duration'] is None:
+			valid[i] = False
+			continue
+		sizes[i] = video['Size']
+		durations[i] = video['Duration']
+		audio_bitrates[i] = video['Audio bitrate'] or (
+			128 if (video['Audio codec'] or '').startswith('mp4a') else 160)
+	efficient_codec = numpy.fromiter(
+		((video['Video codec'] or '').startswith(('av01', 'vp9', 'hvc1'))
+		 for video in input_vidinfo), dtype=bool, count=len(input_vidinfo))
+	valid &= durations != 0
+	durations[~valid] = 1
+
+	# Same arithmetic as quality(), one column at a time
+	total_bitrates = sizes * 8 // 1000 // durations
+	results = (total_bitrates - audio_bitrates).astype(numpy.float64)
+	results[efficient_codec] *= 1.5
+	results[~has_size] = 0
+	results[~valid] = numpy.nan
+	return results
+
+
+def match_videos(input_vidinfo):
+	"""
+	Find groups of matching videos in a vidinfo list sorted by date.
+
+	Videos are assumed to be identical if all of the following are true:
+	* They were uploaded within 1 day of each other
+	* Their length is within 5% + max(45 seconds, 10%) of the shorter length
+	* Longest common substring is more than half of longer title
+
+	Videos with a missing date are not matched to anything.
+
+	:param input_vidinfo: list of dicts representing a vidinfo file, sorted by date
+	:return: generator of lists of indices of matching videos, in order of the first index
+	"""
+	processed_indices = set()
+	candidate_index = CandidateIndex(input_vidinfo)
+
+	for i in range(len(input_vidinfo)):
+		# Skip rows that matched a previous video
+		if i in processed_indices:
+			continue
+
+		current = input_vidinfo[i]
+		matching_indices = [i]
+
+		# Check for a missing date
+		if not current['Date'] or int(current['Date']) < 20040101:
+			yield matching_indices
+			continue
+
+		# Compare to all videos between the next one and the last video tomorrow that could match
+		for j in candidate_index.candidates(i, current):
+			if j in processed_indices:
+				continue
+			if not videos_match(current, input_vidinfo[j]):
+				continue
+
+			# No mismatch = same video
+			matching_indices.append(j)
+			processed_indices.add(j)
+
+		yield matching_indices
+
+
+def match_videos_stream(videos):
+	"""
+	Find groups of matching videos like match_videos, from a stream of videos sorted by date.
+	Only the videos from the day being grouped and the following day are held in memory.
+	:param videos: iterable of dicts representing vidinfo rows, sorted by date
+	:return: generator of lists of (index, video) of matching videos, in order of the first index
+	"""
+	window = []  # (index, video) for videos with a date that haven't been grouped yet
+	claimed = set()
+
+	def group_first_day():
+		day = window[0][1]['Date']
+		window_videos = [x[1] for x in window]
+		candidate_index = CandidateIndex(window_videos)
+		position = 0
+		while position < len(window) and window[position][1]['Date'] == day:
+			i, current = window[position]
+			if i not in claimed:
+				matching = [(i, current)]
+				for j in candidate_index.candidates(position, current):
+					if window[j][0] not in claimed and videos_match(current, window_videos[j]):
+						matching.append(window[j])
+						claimed.add(window[j][0])
+				yield matching
+			claimed.discard(i)
+			position += 1
+		del window[:position]
+
+	for i, video in enumerate(videos):
+		date = _date(video)
+		if date is None or date < 20040101:
+			# Videos without a date aren't matched to anything
+			while window:
+				yield from group_first_day()
+			yield [(i, video)]
+			continue
+
+		# Every video that can match a video from the first day has been read
+		while window and _date(window[0][1]) < date - 1:
+			yield from group_first_day()
+		window.append((i, video))
+
+	while window:
+		yield from group_first_day()
+
+
+def process_vidinfo_stream(videos, alivelist, buffer_size=10000):
+	"""
+	Process the vidinfo file like process_vidinfo, one row at a time.
+	:param videos: iterable of dicts representing vidinfo rows
+	:param alivelist: set of alive videos
+	:param buffer_size: number of videos to hold in memory for sorting by date (see sort_stream)
+	:return: generator of dicts representing vidinfo rows, with more columns
+	"""
+	for matching in match_videos_stream(sort_stream(videos, buffer_size)):
+		for i, row in matching:
+			row['original_row'] = i
+		yield from categorize_matches([x[1] for x in matching], alivelist)
+
+
+def _date(video):
+	try:
+		return int(video['Date'])
+	except ValueError:
+		return None
+
+
+# Videos matched by each worker process at a time in match_pairs_parallel
+PARTITION_SIZE = 2000
+
+
+def partition_vidinfo(input_vidinfo, target_size=PARTITION_SIZE):
+	"""
+	Split a vidinfo list sorted by date into partitions of whole days, each with at least
+	target_size videos (except the last). The partitions only depend on the videos, not on how
+	many processes match them. Since videos can match videos from the next day, each partition
+	overlaps the following day.
+	:param input_vidinfo: list of dicts representing a vidinfo file, sorted by date
+	:param target_size: minimum number of videos in a partition
+	:return: list of (start, end, overlap_end) where input_vidinfo[start:end] are the videos in the
+	partition and input_vidinfo[end:overlap_end] are the videos they can also match
+	"""
+	dates = [x['Date'] for x in input_vidinfo]
+	results = []
+	start = 0
+	while start < len(dates):
+		end = min(start + target_size, len(dates))
+		while end < len(dates) and dates[end] == dates[end - 1]:
+			end += 1
+		overlap_end = end
+		last_date = _date(input_vidinfo[end - 1])
+		if last_date is not None:
+			while overlap_end < len(dates) and (
+					_date(input_vidinfo[overlap_end]) or math.inf) <= last_date + 1:
+				overlap_end += 1
+		results.append((start, end, overlap_end))
+		start = end
+	return results
+
+
+def match_videos_parallel(input_vidinfo, jobs):
+	"""
+	Find groups of matching videos like match_videos, finding the pairs of matching videos in a
+	process pool over partitions of days. The pairs are then grouped in order like match_videos
+	does, so the results are the same as match_videos for any number of jobs.
+	:param input_vidinfo: list of dicts representing a vidinfo file, sorted by date
+	:param jobs: number of worker processes
+	:return: list of lists of indices of matching videos, in order of the first index
+	"""
+	later_matches = [[] for _ in input_vidinfo]
+	for i, j in match_pairs_parallel(input_vidinfo, jobs):
+		later_matches[i].append(j)
+
+	grouped = set()
+	results = []
+	for i in range(len(input_vidinfo)):
+		if i in grouped:
+			continue
+		results.append([i] + [j for j in later_matches[i] if j not in grouped])
+		grouped.update(results[-1])
+	return results
+
+
+def match_videos_cached(input_vidinfo, fingerprints, hashes, cached_rows, jobs=1):
+	"""
+	Find groups of matching videos like match_videos, reusing the groups found in a previous run.
+	Groups are found again if a video was added, removed or edited within a day of one of the
+	videos in the group, or if one of the groups found again could match one of its videos.
+	:param input_vidinfo: list of dicts representing a vidinfo file, sorted by date
+	:param fingerprints: fingerprint of each video, from fingerprint_rows
+	:param hashes: content hash of each video, from content_hash
+	:param cached_rows: rows from the previous run, from MatchCache.rows
+	:param jobs: number of worker processes to use for matching
+	:return: list of lists of indices of matching videos, in order of the first index
+	"""
+	indices = {fingerprint: i for i, fingerprint in enumerate(fingerprints)}
+
+	# Find the dates of added, removed and edited videos
+	affected = set()
+	changed_dates = set()
+	for fingerprint, (row_hash, date, _) in cached_rows.items():
+		if fingerprint not in indices or hashes[indices[fingerprint]] != row_hash:
+			changed_dates.add(date)
+	for i, fingerprint in enumerate(fingerprints):
+		if fingerprint not in cached_rows or cached_rows[fingerprint][0] != hashes[i]:
+			affected.add(i)
+			changed_dates.add(input_vidinfo[i]['Date'])
+	by_date = {}
+	for i, video in enumerate(input_vidinfo):
+		by_date.setdefault(video['Date'], []).append(i)
+	affected.update(i for date in changed_dates if date.isdigit() for offset in (-1, 0, 1)
+	                for i in by_date.get(str(int(date) + offset), ()))
+
+	# Group the videos that were matched before
+	clusters = {}
+	for i, fingerprint in enumerate(fingerprints):
+		if fingerprint in cached_rows:
+			clusters.setdefault(cached_rows[fingerprint][2], []).append(i)
+	cluster_of = {i: cluster_indices for cluster_indices in clusters.values()
+	              for i in cluster_indices}
+
+	while True:
+		# Every group including an affected video must be found again
+		for i in list(affected):
+			affected.update(cluster_of.get(i, ()))
+
+		sorted_affected = sorted(affected)
+		affected_videos = [input_vidinfo[i] for i in sorted_affected]
+		matches = match_videos_parallel(affected_videos, jobs) if jobs > 1 \
+			else match_videos(affected_videos)
+		matches = [[sorted_affected[i] for i in x] for x in matches]
+
+		# Check whether a group found again and a group that was kept could have matched each
+		# other's videos, in which case the group that was kept has to be found again too
+		dates = {input_vidinfo[i]['Date'] for i in affected}
+		near_dates = {str(int(date) + offset) for date in dates if date.isdigit()
+		              for offset in (-1, 0, 1)}
+		near = sorted(i for date in near_dates for i in by_date.get(date, ()))
+		near_videos = [input_vidinfo[i] for i in near]
+		candidate_index = CandidateIndex(near_videos)
+		starts = {x[0] for x in matches} | {x[0] for x in clusters.values() if x[0] not in affected}
+		grown = set()
+		for position, start in enumerate(near):
+			if start not in starts or (_date(input_vidinfo[start]) or 0) < 20040101:
+				continue
+			for j in candidate_index.candidates(position, near_videos[position]):
+				j = near[j]
+				if (start in affected) != (j in affected) \
+						and videos_match(input_vidinfo[start], input_vidinfo[j]):
+					grown.add(j if start in affected else start)
+		if not grown:
+			break
+		affected.update(grown)
+
+	results = [x for x in clusters.values() if affected.isdisjoint(x)] + matches
+	results.sort(key=lambda x: x[0])
+	return results
+
+
+def match_pairs(input_vidinfo, start=0, end=None):
+	"""
+	Find every pair of matching videos, regardless of whether either matched something else
+	:param input_vidinfo: list of dicts representing a vidinfo file, sorted by date
+	:param start: index of the first video to find pairs for
+	:param end: index after the last video to find pairs for (default: all videos)
+	:return: list of (i, j) pairs of indices where i < j
+	"""
+	candidate_index = CandidateIndex(input_vidinfo)
+	results = []
+	for i in range(start, len(input_vidinfo) if end is None else end):
+		current = input_vidinfo[i]
+		if (_date(current) or 0) < 20040101:
+			continue
+		results += [(i, j) for j in candidate_index.candidates(i, current)
+		            if videos_match(current, input_vidinfo[j])]
+	return results
+
+
+def _match_pairs_partition(partition):
+	videos, offset, size = partition
+	return [(offset + i, offset + j) for i, j in match_pairs(videos, end=size)]
+
+
+def match_pairs_parallel(input_vidinfo, jobs):
+	"""
+	Find every pair of matching videos like match_pairs, using a process pool over partitions of
+	days
+	:param input_vidinfo: list of dicts representing a vidinfo file, sorted by date
+	:param jobs: number of worker processes
+	:return: list of (i, j) pairs of indices where i < j, in order
+	"""
+	partitions = [(input_vidinfo[start:overlap_end], start, end - start) for start, end, overlap_end
+	              in partition_vidinfo(input_vidinfo)]
+	with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+		return [x for partition_pairs in executor.map(_match_pairs_partition, partitions)
+		        for x in partition_pairs]
+
+
+def cluster_videos(input_vidinfo, jobs=1):
+	"""
+	Find groups of videos that all match each other, so the groups can include any number of
+	copies. Pairs of matches aren't chained together: consecutive episodes with similar titles can
+	each match the next one without being the same video.
+	:param input_vidinfo: list of dicts representing a vidinfo file, sorted by date
+	:param jobs: number of worker processes to use for finding pairs
+	:return: list of lists of indices of matching videos, in order of the first index
+	"""
+	pairs = match_pairs_parallel(input_vidinfo, jobs) if jobs > 1 else match_pairs(input_vidinfo)
+
+	matches = [set() for _ in input_vidinfo]
+	for i, j in pairs:
+		matches[i].add(j)
+		matches[j].add(i)
+
+	# Each group starts with its earliest video, and takes its later matches in order as long as
+	# they match everything already in the group
+	grouped = set()
+	results = []
+	for i in range(len(input_vidinfo)):
+		if i in grouped:
+			continue
+		group = [i]
+		for j in sorted(matches[i]):
+			if j > i and j not in grouped and all(k in matches[j] for k in group):
+				group.append(j)
+		grouped.update(group)
+		results.append(group)
+	return results
+
+
+def preference(video, qualities=None):
+	"""
+	Rank copies of a video from the same website
+	:param video: video info dictionary
+	:param qualities: precomputed quality_scores() indexed by "original_row" (optional)
+	:return: a key that is greater for preferable copies
+	"""
+	return video['Height'] or 0, lookup_quality(video, qualities)
+
+
+def lookup_quality(video, qualities=None):
+	"""
+	Get quality() for a video, from the precomputed scores if possible
+	:param video: video info dictionary, with "original_row" set
+	:param qualities: precomputed quality_scores() indexed by "original_row" (optional)
+	:return: bitrate in kbps
+	"""
+	if qualities is not None:
+		score = qualities[video['original_row']]
+		if not math.isnan(score):
+			return float(score)
+	return quality(video)
+
+
+def categorize_matches(matching_rows, alivelist, n_way=False, qualities=None):
+	"""
+	Decide what to do with each of a group of matching videos, as described in process_vidinfo
+	:param matching_rows: list of dicts representing matching videos, with "original_row" set
+	:param alivelist: set of alive videos
+	:param n_way: whether to pick the preferred copy from each website rather than inspecting
+	groups with more than one copy from the same website
+	:param qualities: precomputed quality_scores() indexed by "original_row" (optional)
+	:return: list of dicts representing the videos, with more columns
+	"""
+	results = []
+
+	# Check for a missing date
+	current = matching_rows[0]
+	if not current['Date'] or int(current['Date']) < 20040101:
+		current['result'] = 'inspect'
+		results.append(current)
+		return results
+
+	# Remove any rows with the same server, path, size
+	matching_rows = list(
+		{f"{x['Server']}/{x['Filename']}/{x['Size']}": x for x in matching_rows}.values())
+
+	# Check for inspection conditions
+	flag_already_exists = sum(1 for x in matching_rows if x['Flag'])
+	existing_videos = [x for x in matching_rows if x['Size'] is not None]
+	youtube_videos = [x for x in existing_videos if x['Website'] == 'youtube']
+	roosterteeth_videos = [x for x in existing_videos if x['Website'] == 'RoosterTeeth']
+	duplicate_videos = []
+	if n_way and not flag_already_exists:
+		# Keep only the preferred copy from each website; the rest are duplicates
+		for website_videos in youtube_videos, roosterteeth_videos:
+			if len(website_videos) > 1:
+				preferred = max(website_videos, key=lambda x: preference(x, qualities))
+				duplicate_videos += [x | {'result': 'duplicate',
+				                          'other_server': preferred['Server'],
+				                          'other_path': preferred['Filename']}
+				                     for x in website_videos if x is not preferred]
+				website_videos[:] = [preferred]
+	if flag_already_exists or not existing_videos or len(youtube_videos) > 1 or len(
+			roosterteeth_videos) > 1:
+		results += [x | {'result': 'inspect'} for x in matching_rows]
+		return results
+
+	youtube_video = youtube_videos[0] if youtube_videos else None
+	roosterteeth_video = roosterteeth_videos[0] if roosterteeth_videos else None
+	values = {'alive': youtube_video['ID'] in alivelist if youtube_video else None,
+	          'yt_id': youtube_video['ID'] if youtube_video else None,
+	          'rt_id': roosterteeth_video['ID'] if roosterteeth_video else None}
+	non_existing_videos = [x | {'result': 'ignore'} for x in matching_rows if
+	                       x['Size'] is None]
+
+	# If only one or the other exists, our decision is easy
+	if not youtube_video or not roosterteeth_video:
+		video = youtube_video if youtube_video else roosterteeth_video
+		video['result'] = 'keep'
+		results += [x | values for x in non_existing_videos]
+		results.append(video | values)
+		results += [x | values for x in duplicate_videos]
+		return results
+
+	earlier_date = min(int(youtube_video['Date']), int(roosterteeth_video['Date']))
+	values['Date'] = earlier_date
+
+	# Default preference
+	youtube_preferred = earlier_date < 20180101
+
+	# Compare video resolution
+	if youtube_video['Height'] < roosterteeth_video['Height']:
+		youtube_preferred = False
+	elif roosterteeth_video['Height'] > youtube_video['Height']:
+		youtube_preferred = True
+	else:
+		# Compare video quality
+		# Quality is in approximate H.264 equivalent bitrate in kbps; allow a tolerance of 10%
+		quality_ratio = lookup_quality(youtube_video, qualities) / lookup_quality(
+			roosterteeth_video, qualities)
+		if quality_ratio < (1 / 1.1):
+			youtube_preferred = False
+		elif quality_ratio > 1.1:
+			youtube_preferred = True
+
+	# Check for AH videos with YT preferred after 20191001 to avoid censored audio
+	is_achievement_hunter = any(
+		x['Channel'] in ['Achievement Hunter', 'LetsPlay'] for x in matching_rows)
+	merge_videos = youtube_preferred and is_achievement_hunter and earlier_date >= 20191001
+
+	# Video A has preferred video feed; video B may have preferred other stuff
+	video_a = youtube_video if youtube_preferred else roosterteeth_video
+	video_b = roosterteeth_video if youtube_preferred else youtube_video
+	subs_from_a = video_a['Subtitles'] > video_b['Subtitles']
+	subs_from_b = video_b['Subtitles'] > video_a['Subtitles']
+
+	if merge_videos:
+		video_a['result'] = 'video+subs' if subs_from_a else 'video'
+		video_b['result'] = 'audio+subs' if subs_from_b else 'audio'
+	else:
+		video_a['result'] = 'audio+video' if subs_from_b else 'keep'
+		video_b['result'] = 'subs' if subs_from_b else 'delete'
+
+	# Avoid merging audio and video tracks of disparate length
+	# keep both audio tracks too just in case
+	if video_a['result'] != 'keep' and abs(
+			int(video_a['Duration']) - int(video_b['Duration'])) > 2:
+		# Keep the one with the preferred audio (video_b) if merging because one might be
+		# censored; otherwise, keep the one with the preferred video (video_a)
+		video_a['result'] = ('archive_' if merge_videos else 'keep_') + video_a['result']
+		video_b['result'] = ('keep_' if merge_videos else 'archive_') + video_b['result']
+
+	video_a['other_server'] = video_b['Server']
+	video_a['other_path'] = video_b['Filename']
+	video_b['other_server'] = video_a['Server']
+	video_b['other_path'] = video_a['Filename']
+
+	# Merge manually entered metadata
+	for metadata_key in ['Group', 'Series', 'Episode', 'Output Title', 'Part', 'Flag']:
+		values[metadata_key] = video_a[metadata_key] or video_b[metadata_key] or next(
+			(x[metadata_key] for x in non_existing_videos if x[metadata_key]), None)
+
+	results += [youtube_video | values, roosterteeth_video | values]
+	results += [x | values for x in non_existing_videos]
+	results += [x | values for x in duplicate_videos]
+
+	return results
+
+
+def process_vidinfo(input_vidinfo, alivelist, jobs=1, cache=None, n_way=False):
 	"""
 	Process the vidinfo file, adding columns to indicate what should be done with the video.
 
@@ -95,7 +793,13 @@ def process_vidinfo(input_vidinfo, alivelist):
 	The result is "inspect" if:
 	* Flag already exists in flag column
 	* There are no matching videos with nonempty size
-	* There is more than 1 yt video or more than 1 rt video
+	* There is more than 1 yt video or more than 1 rt video (unless n_way is set)
+
+	If n_way is set, matching videos are grouped so that every video in a group matches every
+	other one, instead of matching everything to the first video in the group, and only the
+	preferred yt video and the preferred rt video (by height, then quality) are considered. The
+	result for the others is "duplicate", with the preferred copy in "other_server" and
+	"other_path", so they can be checked before deleting them.
 
 	If YouTube > 2019-10-01 is preferred, the results are "audio" and "video"
 	If one has subtitles and the other doesn't, the results are "subs" and "audio+video"
@@ -113,179 +817,134 @@ def process_vidinfo(input_vidinfo, alivelist):
 
 	:param input_vidinfo: list of dicts representing a vidinfo file
 	:param alivelist: set of alive videos
+	:param jobs: number of worker processes to use for matching
+	:param cache: MatchCache with results from previous runs (optional)
+	:param n_way: whether to group any number of copies of the same video
 	:return: list of dicts representing a vidinfo file, with more columns
 	"""
+	if cache and n_way:
+		raise ValueError("Cannot use a match cache with n-way grouping")
+
 	results = []
-	processed_indices = set()
 
 	# Sort by dates, ascending
 	input_vidinfo = sorted(input_vidinfo, key=lambda x: x['Date'])
-
-	for i in range(len(input_vidinfo)):
-		# Skip rows that matched a previous video
-		if i in processed_indices:
+	qualities = quality_scores(input_vidinfo)
+
+	if cache:
+		fingerprints = fingerprint_rows(input_vidinfo)
+		hashes = [content_hash(x) for x in input_vidinfo]
+		matches = match_videos_cached(input_vidinfo, fingerprints, hashes, cache.rows(), jobs)
+	elif n_way:
+		matches = cluster_videos(input_vidinfo, jobs)
+	elif jobs > 1:
+		matches = match_videos_parallel(input_vidinfo, jobs)
+	else:
+		matches = match_videos(input_vidinfo)
+
+	cached_rows = []
+	for matching_indices in matches:
+		matching_rows = [input_vidinfo[i] for i in matching_indices]
+		if not cache:
+			for i, row in zip(matching_indices, matching_rows):
+				row['original_row'] = i
+			results += categorize_matches(matching_rows, alivelist, n_way, qualities)
 			continue
 
-		current = input_vidinfo[i]
-		current['original_row'] = i
-		matching_rows = [current]
-
-		# Check for a missing date
-		if not current['Date'] or int(current['Date']) < 20040101:
-			current['result'] = 'inspect'
-			results.append(current)
-			continue
-
-		# Compare to all videos between the next one and the last video tomorrow
-		j = i
-		while True:
-			j = j + 1
-			if j > len(input_vidinfo) - 1:
-				break
-			if j in processed_indices:
-				continue
-			compare = input_vidinfo[j]
-
-			# Check for a date mismatch
-			if compare['Date'] and int(compare['Date']) > int(current['Date']) + 1:
-				break
-
-			# Check for a length mismatch
-			len1 = int(current['Duration'])
-			len2 = int(compare['Duration'])
-			min_length = min(len1, len2)
-			max_length = max(len1, len2)
-			if max_length > min_length * 1.05 + max(45., min_length / 10):
-				continue
-
-			# Check for a title mismatch
-			title_match = longest_common_substring(current['Title'], compare['Title'])
-			if len(title_match) < max(len(current['Title']), len(compare['Title'])) // 2:
-				continue
-
-			# No mismatch = same video
-			compare['original_row'] = j
-			matching_rows.append(compare)
-			processed_indices.add(j)
-
-		# Remove any rows with the same server, path, size
-		matching_rows = list(
-			{f"{x['Server']}/{x['Filename']}/{x['Size']}": x for x in matching_rows}.values())
-
-		# Check for inspection conditions
-		flag_already_exists = sum(1 for x in matching_rows if x['Flag'])
-		existing_videos = [x for x in matching_rows if x['Size']]
-		youtube_videos = [x for x in existing_videos if x['Website'] == 'youtube']
-		roosterteeth_videos = [x for x in existing_videos if x['Website'] == 'RoosterTeeth']
-		if flag_already_exists or not existing_videos or len(youtube_videos) > 1 or len(
-				roosterteeth_videos) > 1:
-			results += [x | {'result': 'inspect'} for x in matching_rows]
-			continue
-
-		youtube_video = youtube_videos[0] if youtube_videos else None
-		roosterteeth_video = roosterteeth_videos[0] if roosterteeth_videos else None
-		values = {'alive': youtube_video['ID'] in alivelist if youtube_video else None,
-		          'yt_id': youtube_video['ID'] if youtube_video else None,
-		          'rt_id': roosterteeth_video['ID'] if roosterteeth_video else None}
-		non_existing_videos = [x | {'result': 'ignore'} for x in matching_rows if
-		                       not x['Size']]
-
-		# If only one or the other exists, our decision is easy
-		if not youtube_video or not roosterteeth_video:
-			video = youtube_video if youtube_video else roosterteeth_video
-			video['result'] = 'keep'
-			results += [x | values for x in non_existing_videos]
-			results.append(video | values)
-			continue
-
-		earlier_date = min(int(youtube_video['Date']), int(roosterteeth_video['Date']))
-		values['Date'] = earlier_date
-
-		# Default preference
-		youtube_preferred = earlier_date < 20180101
-
-		# Compare video resolution
-		if int(youtube_video['Height']) < int(roosterteeth_video['Height']):
-			youtube_preferred = False
-		elif int(roosterteeth_video['Height']) > int(youtube_video['Height']):
-			youtube_preferred = True
-		else:
-			# Compare video quality
-			# Quality is in approximate H.264 equivalent bitrate in kbps; allow a tolerance of 10%
-			quality_ratio = quality(youtube_video) / quality(roosterteeth_video)
-			if quality_ratio < (1 / 1.1):
-				youtube_preferred = False
-			elif quality_ratio > 1.1:
-				youtube_preferred = True
-
-		# Check for AH videos with YT preferred after 20191001 to avoid censored audio
-		is_achievement_hunter = any(
-			x['Channel'] in ['Achievement Hunter', 'LetsPlay'] for x in matching_rows)
-		merge_videos = youtube_preferred and is_achievement_hunter and earlier_date >= 20191001
-
-		# Video A has preferred video feed; video B may have preferred other stuff
-		video_a = youtube_video if youtube_preferred else roosterteeth_video
-		video_b = roosterteeth_video if youtube_preferred else youtube_video
-		subs_from_a = int(video_a['Subtitles']) > int(video_b['Subtitles'])
-		subs_from_b = int(video_b['Subtitles']) > int(video_a['Subtitles'])
-
-		if merge_videos:
-			video_a['result'] = 'video+subs' if subs_from_a else 'video'
-			video_b['result'] = 'audio+subs' if subs_from_b else 'audio'
-		else:
-			video_a['result'] = 'audio+video' if subs_from_b else 'keep'
-			video_b['result'] = 'subs' if subs_from_b else 'delete'
-
-		# Avoid merging audio and video tracks of disparate length
-		# keep both audio tracks too just in case
-		if video_a['result'] != 'keep' and abs(
-				int(video_a['Duration']) - int(video_b['Duration'])) > 2:
-			# Keep the one with the preferred audio (video_b) if merging because one might be
-			# censored; otherwise, keep the one with the preferred video (video_a)
-			video_a['result'] = ('archive_' if merge_videos else 'keep_') + video_a['result']
-			video_b['result'] = ('keep_' if merge_videos else 'archive_') + video_b['result']
-
-		video_a['other_server'] = video_b['Server']
-		video_a['other_path'] = video_b['Filename']
-		video_b['other_server'] = video_a['Server']
-		video_b['other_path'] = video_a['Filename']
-
-		# Merge manually entered metadata
-		for metadata_key in ['Group', 'Series', 'Episode', 'Output Title', 'Part', 'Flag']:
-			values[metadata_key] = video_a[metadata_key] or video_b[metadata_key] or next(
-				(x[metadata_key] for x in non_existing_videos if x[metadata_key]), None)
-
-		results += [youtube_video | values, roosterteeth_video | values]
-		results += [x | values for x in non_existing_videos]
+		cached_rows += [(fingerprints[i], hashes[i], input_vidinfo[i]['Date'],
+		                 fingerprints[matching_indices[0]]) for i in matching_indices]
+		key = decision_key([hashes[i] for i in matching_indices],
+		                   [x['ID'] in alivelist for x in matching_rows])
+		decision = cache.decision(key, matching_indices)
+		if decision is None:
+			for i, row in zip(matching_indices, matching_rows):
+				row['original_row'] = i
+			decision = categorize_matches(matching_rows, alivelist, qualities=qualities)
+			cache.add_decision(key, matching_indices, decision)
+		results += decision
+
+	if cache:
+		cache.update(cached_rows)
 
 	return results
 
 
-def write_vidinfo(vidinfo_dict, csvfile):
-	fieldnames = list(vidinfo_dict[0])
+def output_fieldnames(first):
+	"""
+	:param first: dict representing the first row of the output, or None if there are no rows
+	:return: the columns of the output: the input columns, then the ones categorizing adds
+	"""
+	fieldnames = list(first if first is not None else vidinfo_columns)
 	for extra_name in 'rt_id', 'yt_id', 'alive', 'original_row', 'result', \
 	                  'other_path', 'other_server':
 		if extra_name not in fieldnames:
 			fieldnames.append(extra_name)
-	writer = csv.DictWriter(csvfile, fieldnames)
+	return fieldnames
+
+
+def write_vidinfo(vidinfo_dict, csvfile):
+	vidinfo_dict = iter(vidinfo_dict)
+	first = next(vidinfo_dict, None)
+	writer = csv.DictWriter(csvfile, output_fieldnames(first))
 	writer.writeheader()
-	writer.writerows(vidinfo_dict)
+	if first is not None:
+		writer.writerow(first)
+		writer.writerows(vidinfo_dict)
+
+
+def write_vidinfo_parquet(vidinfo_dict, filename):
+	"""
+	Write the output to a Parquet file with typed columns, for download.py
+	:param vidinfo_dict: iterable of dicts representing vidinfo rows
+	:param filename: path to the output file
+	"""
+	vidinfo_dict = iter(vidinfo_dict)
+	first = next(vidinfo_dict, None)
+	rows = itertools.chain([first], vidinfo_dict) if first is not None else []
+	write_parquet_rows(rows, filename, output_fieldnames(first))
 
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser(
 		description="Identify preferable versions of RoosterTeeth videos in a processed vidinfo csv file")
-	parser.add_argument('source', help="vidinfo csv file")
-	parser.add_argument('-o', '--output', help="output file", nargs='?',
-	                    type=argparse.FileType('w'), default=sys.stdout)
+	parser.add_argument('source', help="vidinfo csv (or .parquet) file")
+	parser.add_argument('-o', '--output',
+	                    help="output file (Parquet if it ends with .parquet; default: stdout)")
 	parser.add_argument('-a', '--alive-list', help="file listing still-alive video ids")
 	parser.add_argument('-t', '--tab-separated', action='store_true',
 	                    help="Use a tab-separated UTF-16 input file instead of UTF-8 csv")
+	parser.add_argument('-j', '--jobs', type=int, default=1,
+	                    help="number of worker processes to use for matching")
+	parser.add_argument('-c', '--cache',
+	                    help="SQLite file caching matches and decisions between runs")
+	parser.add_argument('-u', '--n-way', action='store_true',
+	                    help="Group any number of copies of the same video and pick the preferred "
+	                         "one from each website instead of inspecting them")
+	parser.add_argument('-s', '--stream', action='store_true',
+	                    help="Process the file one row at a time instead of reading it into memory")
+	parser.add_argument('--sort-buffer', type=int, default=10000,
+	                    help="number of rows to hold in memory to sort by date when streaming")
 	args = parser.parse_args()
+	if args.cache and args.n_way:
+		parser.error("--cache cannot be used with --n-way")
+	if args.stream and (args.cache or args.n_way or args.jobs > 1):
+		parser.error("--stream cannot be used with --cache, --n-way or --jobs")
 
-	vidinfo = read_vidinfo(args.source, args.tab_separated)
+	match_cache = MatchCache(args.cache) if args.cache else None
 	alive_videos = read_alive_list(args.alive_list)
-	vidinfo = process_vidinfo(vidinfo, alive_videos)
-	write_vidinfo(vidinfo, args.output)
-
-	args.output.close()
+	if args.stream:
+		vidinfo = process_vidinfo_stream(iter_vidinfo(args.source, args.tab_separated),
+		                                 alive_videos, buffer_size=args.sort_buffer)
+	else:
+		vidinfo = read_vidinfo(args.source, args.tab_separated)
+		vidinfo = process_vidinfo(vidinfo, alive_videos, jobs=args.jobs, cache=match_cache,
+		                          n_way=args.n_way)
+	if args.output and args.output.endswith('.parquet'):
+		write_vidinfo_parquet(vidinfo, args.output)
+	elif args.output:
+		with open(args.output, 'w', newline='', encoding='utf-8') as output_file:
+			write_vidinfo(vidinfo, output_file)
+	else:
+		write_vidinfo(vidinfo, sys.stdout)
+	if match_cache:
+		match_cache.close()
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import sqlite3
+
+
+def text(value):
+	"""
+	Format a value from a vidinfo row the way it is in a csv file, so a cache works with either
+	"""
+	return '' if value is None else str(value)
+
+
+def fingerprint_rows(videos):
+	"""
+	Get a stable fingerprint for each row of a vidinfo list, from its server, filename, size and id.
+	Rows with the same fingerprint are numbered in order.
+	:param videos: list of dicts representing a vidinfo file
+	:return: list of fingerprints
+	"""
+	counts = {}
+	results = []
+	for video in videos:
+		fingerprint = '\0'.join((video['Server'], video['Filename'], text(video['Size']),
+		                         video['ID']))
+		counts[fingerprint] = counts.get(fingerprint, 0) + 1
+		results.append(f"{fingerprint}#{counts[fingerprint]}")
+	return results
+
+
+def content_hash(video):
+	"""
+	Hash the entire contents of a vidinfo row, to find rows that were edited
+	:param video: dict representing a vidinfo row
+	:return: hex digest
+	"""
+	return hashlib.sha1('\0'.join(f"{key}\0{text(value)}" for key, value in sorted(video.items()))
+	                    .encode('utf-8')).hexdigest()
+
+
+def decision_key(hashes, alive):
+	"""
+	Identify the inputs to a decision about a group of matching videos
+	:param hashes: content hashes of the videos in the group
+	:param alive: whether each video in the group is in the alive list
+	:return: hex digest
+	"""
+	return hashlib.sha1(''.join(x + ('1' if y else '0') for x, y in zip(hashes, alive))
+	                    .encode('utf-8')).hexdigest()
+
+
+class MatchCache:
+	def __init__(self, filename):
+		"""
+		Open or create a cache of the groups of matching videos and the decisions made about them
+		:param filename: path to a SQLite database
+		"""
+		self.connection = sqlite3.connect(filename)
+		self.connection.executescript("""
+			CREATE TABLE IF NOT EXISTS rows (
+				fingerprint TEXT PRIMARY KEY,
+				hash TEXT NOT NULL,
+				date TEXT NOT NULL,
+				cluster TEXT NOT NULL
+			);
+			CREATE TABLE IF NOT EXISTS decisions (
+				key TEXT PRIMARY KEY,
+				results TEXT NOT NULL
+			);
+		""")
+		self.decisions = dict(self.connection.execute('SELECT key, results FROM decisions'))
+		self.new_decisions = {}
+		self.used_decisions = set()
+
+	def rows(self):
+		"""
+		Get the rows from the previous run
+		:return: a dict like {fingerprint: (hash, date, cluster)}, where cluster is the fingerprint
+		of the first video in the group the row belonged to
+		"""
+		return {fingerprint: (row_hash, date, cluster) for fingerprint, row_hash, date, cluster in
+		        self.connection.execute('SELECT fingerprint, hash, date, cluster FROM rows')}
+
+	def decision(self, key, indices):
+		"""
+		Get a cached decision
+		:param key: decision key from decision_key
+		:param indices: indices of the videos in the group, which are used for "original_row"
+		:return: list of dicts like categorize_matches returns, or None if not cached
+		"""
+		results = self.new_decisions.get(key) or self.decisions.get(key)
+		if results is None:
+			return None
+		self.used_decisions.add(key)
+		return [x | {'original_row': indices[x['original_row']]} for x in json.loads(results)]
+
+	def add_decision(self, key, indices, results):
+		"""
+		Cache a decision
+		:param key: decision key from decision_key
+		:param indices: indices of the videos in the group
+		:param results: list of dicts returned by categorize_matches
+		"""
+		positions = {index: position for position, index in enumerate(indices)}
+		self.new_decisions[key] = json.dumps(
+			[x | {'original_row': positions[x['original_row']]} for x in results])
+		self.used_decisions.add(key)
+
+	def update(self, rows):
+		"""
+		Replace the cached rows, save new decisions, and drop decisions that were not used
+		:param rows: list of (fingerprint, hash, date, cluster)
+		"""
+		with self.connection:
+			self.connection.execute('DELETE FROM rows')
+			self.connection.executemany('INSERT INTO rows VALUES (?, ?, ?, ?)', rows)
+			self.connection.executemany('INSERT OR REPLACE INTO decisions VALUES (?, ?)',
+			                            self.new_decisions.items())
+			self.connection.execute('CREATE TEMP TABLE used_decisions (key TEXT PRIMARY KEY)')
+			self.connection.executemany('INSERT INTO used_decisions VALUES (?)',
+			                            [(x,) for x in self.used_decisions])
+			self.connection.execute(
+				'DELETE FROM decisions WHERE key NOT IN (SELECT key FROM used_decisions)')
+			self.connection.execute('DROP TABLE used_decisions')
+		self.decisions = {key: results for key, results in
+		                  {**self.decisions, **self.new_decisions}.items()
+		                  if key in self.used_decisions}
+		self.new_decisions = {}
+
+	def close(self):
+		self.connection.close()
@@ -0,0 +1,57 @@
+class PathTrie:
+	def __init__(self, prefixes=()):
+		"""
+		Map path prefixes to values, and find the most specific prefix of a path in time
+		proportional to the length of the path, whatever the number of prefixes
+		:param prefixes: list like [("/bucket", "Server 1")]. If the same prefix is given more than
+		once, the first value is used
+		"""
+		self.root = {}
+		self.entries = []
+		for prefix, value in prefixes:
+			self.add(prefix, value)
+
+	@staticmethod
+	def split(path):
+		"""
+		:return: list of the components of a path, ignoring trailing slashes. Absolute paths start
+		with an empty component.
+		"""
+		components = path.split('/')
+		while len(components) > 1 and not components[-1]:
+			components.pop()
+		return components
+
+	def add(self, prefix, value):
+		node = self.root
+		for component in self.split(prefix):
+			node = node.setdefault(component, {})
+		if None not in node:
+			node[None] = value
+			self.entries.append((prefix, value))
+
+	def longest_prefix(self, path):
+		"""
+		Find the longest prefix of a path, matching whole components only
+		:param path: path to look up
+		:return: (value, the rest of the path relative to the prefix), or None if no prefix matches
+		"""
+		components = self.split(path)
+		node = self.root
+		match = None
+		for depth, component in enumerate(components):
+			node = node.get(component)
+			if node is None:
+				break
+			if None in node:
+				match = node[None], depth + 1
+		if match is None:
+			return None
+		value, depth = match
+		return value, '/'.join(components[depth:])
+
+	def __len__(self):
+		return len(self.entries)
+
+	def __repr__(self):
+		return f"PathTrie({self.entries!r})"
@@ -0,0 +1,195 @@
+import concurrent.futures
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+
+# ffprobe codec names, as the codec strings used in info.json files begin
+codec_names = {'h264': 'avc1', 'hevc': 'hvc1', 'av1': 'av01', 'aac': 'mp4a'}
+
+# Columns of a vidinfo row that probing can fill in
+probe_columns = ['Duration', 'Video codec', 'Height', 'Video bitrate', 'FPS', 'Audio codec',
+                 'Audio bitrate', 'Total bitrate']
+
+
+def _bitrate(stream):
+	"""
+	:return: the bitrate of an ffprobe stream or format in kbps, or None if it isn't known
+	"""
+	tags = stream.get('tags', {})
+	# mkv files only have the bitrate in tags written by mkvmerge
+	bit_rate = stream.get('bit_rate') or tags.get('BPS') or tags.get('BPS-eng')
+	return round(int(bit_rate) / 1024) if bit_rate else None
+
+
+def _frame_rate(stream):
+	numerator, _, denominator = stream.get('avg_frame_rate', '0/0').partition('/')
+	if not int(denominator or 1) or not int(numerator):
+		return None
+	return round(int(numerator) / int(denominator or 1), 3)
+
+
+def probe_file(filename):
+	"""
+	Get the streams of a video file using ffprobe
+	:param filename: path to the video file
+	:return: a dict with the columns in probe_columns that ffprobe found, or None if it failed
+	"""
+	result = subprocess.run(['ffprobe', '-v', 'error', '-print_format', 'json', '-show_format',
+	                         '-show_streams', filename], capture_output=True, text=True)
+	if result.returncode != 0:
+		print(f"ffprobe failed for {filename}: {result.stderr.strip()}", file=sys.stderr)
+		return None
+	data = json.loads(result.stdout)
+
+	streams = data.get('streams', [])
+	video = next((x for x in streams if x.get('codec_type') == 'video'
+	              and not x.get('disposition', {}).get('attached_pic')), {})
+	audio = next((x for x in streams if x.get('codec_type') == 'audio'), {})
+	duration = data.get('format', {}).get('duration')
+	results = {
+		'Duration': round(float(duration)) if duration else None,
+		'Video codec': codec_names.get(video.get('codec_name'), video.get('codec_name')),
+		'Height': video.get('height'),
+		'Video bitrate': _bitrate(video),
+		'FPS': _frame_rate(video),
+		'Audio codec': codec_names.get(audio.get('codec_name'), audio.get('codec_name')),
+		'Audio bitrate': _bitrate(audio),
+		'Total bitrate': _bitrate(data.get('format', {})),
+	}
+	if results['Total bitrate'] and results['Audio bitrate'] and not results['Video bitrate']:
+		results['Video bitrate'] = results['Total bitrate'] - results['Audio bitrate']
+	return {key: value for key, value in results.items() if value is not None}
+
+
+class ProbeCache:
+	def __init__(self, filename):
+		"""
+		Open or create a cache of ffprobe results, so each video file is only probed once
+		:param filename: path to a SQLite database
+		"""
+		self.connection = sqlite3.connect(filename)
+		self.connection.executescript("""
+			CREATE TABLE IF NOT EXISTS probes (
+				path TEXT PRIMARY KEY,
+				mtime INTEGER NOT NULL,
+				size INTEGER NOT NULL,
+				result TEXT NOT NULL
+			);
+		""")
+
+	def probes(self):
+		"""
+		:return: a dict like {path: (mtime in ns, size in bytes, result of probe_file)}
+		"""
+		return {path: (mtime, size, json.loads(result)) for path, mtime, size, result in
+		        self.connection.execute('SELECT path, mtime, size, result FROM probes')}
+
+	def update(self, probes):
+		"""
+		Add or replace probe results
+		:param probes: list of (path, mtime in ns, size in bytes, result of probe_file)
+		"""
+		with self.connection:
+			self.connection.executemany(
+				'INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?)',
+				[(path, mtime, size, json.dumps(result)) for path, mtime, size, result in probes])
+
+	def close(self):
+		self.connection.close()
+
+
+def _stat_and_probe(filename, cached):
+	"""
+	Probe a file unless the cached result is for the same version of it
+	:param filename: path to the video file
+	:param cached: (mtime in ns, size in bytes, result) from the cache, or None
+	:return: (mtime in ns, size in bytes, result, whether it was probed), or None if the file
+	doesn't exist
+	"""
+	try:
+		stat = os.stat(filename)
+	except OSError:
+		return None
+	# Only successful probes are reused
+	if cached and cached[2] is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+		return (*cached, False)
+	return stat.st_mtime_ns, stat.st_size, probe_file(filename), True
+
+
+def probe_files(filenames, jobs=8, cache=None, logfile=sys.stderr):
+	"""
+	Probe video files with a pool of threads, since the time is spent waiting on ffprobe and
+	the disk (or network, for a mounted bucket) rather than in python
+	:param filenames: list of paths to video files
+	:param jobs: maximum number of ffprobe processes to run at once
+	:param cache: ProbeCache of previous results, which is updated (optional)
+	:param logfile: where to print progress
+	:return: a dict like {path: result of probe_file} for the files that could be probed
+	"""
+	if shutil.which('ffprobe') is None:
+		raise RuntimeError("ffprobe wasn't found; install ffmpeg to probe video files")
+	cached = cache.probes() if cache else {}
+	results = {}
+	new_probes = []
+	probed_count = 0
+	cache_hits = 0
+	with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+		futures = {executor.submit(_stat_and_probe, x, cached.get(x)): x for x in filenames}
+		for future in concurrent.futures.as_completed(futures):
+			filename = futures[future]
+			probe = future.result()
+			if probe is None:
+				continue
+			mtime, size, result, probed = probe
+			if probed:
+				probed_count += 1
+			else:
+				cache_hits += 1
+			if result is not None:
+				results[filename] = result
+				# Failures aren't cached, since they can be temporary, like a mount going away
+				if probed:
+					new_probes.append((filename, mtime, size, result))
+	print(f"Probed {probed_count} video files, of which {probed_count - len(new_probes)} failed; "
+	      f"{cache_hits} were cached", file=logfile)
+	if cache:
+		cache.update(new_probes)
+	return results
+
+
+def probe_vidinfo(vidinfo, roots, header, jobs=8, cache=None, logfile=sys.stderr):
+	"""
+	Replace the stream information from info.json files with what ffprobe finds in the video
+	files, where they can be reached
+	:param vidinfo: list of rows in the order of header
+	:param roots: a dict like {"Server 1": "/mnt/bucket"} of local directories where the files
+	on each server can be found
+	:param header: column names of the rows
+	:param jobs: maximum number of ffprobe processes to run at once
+	:param cache: ProbeCache (optional)
+	:param logfile: where to print progress
+	:return: list of rows with the probed values
+	"""
+	server_column = header.index('Server')
+	filename_column = header.index('Filename')
+	paths = [os.path.join(roots[row[server_column]], row[filename_column])
+	         if row[server_column] in roots else None for row in vidinfo]
+	probes = probe_files(sorted({x for x in paths if x}), jobs, cache, logfile)
+
+	columns = [(header.index(x), x) for x in probe_columns]
+	results = []
+	for row, path in zip(vidinfo, paths):
+		probe = probes.get(path)
+		if probe:
+			row = list(row)
+			for index, column in columns:
+				if column.endswith('codec') and row[index]:
+					# The codec strings in info.json files are more specific
+					continue
+				row[index] = probe.get(column, row[index])
+			row = tuple(row)
+		results.append(row)
+	return results
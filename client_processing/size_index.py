@@ -0,0 +1,94 @@
+import json
+import os
+import re
+import sqlite3
+import sys
+
+size_map_pattern = re.compile(r'^\s*(\d+)\s+(.+)$')
+
+
+def parse_size_map(file):
+	"""
+	Parse a size map file
+	:param file: a file in the format of 'rclone ls' opened for reading
+	:return: generator of (path, size in bytes)
+	"""
+	for line in file:
+		match = size_map_pattern.match(line)
+		if not match:
+			print(f"Warning! The following sizemap row is invalid and ignored:\n{line}\n",
+			      file=sys.stderr)
+		else:
+			yield match.group(2), int(match.group(1))
+
+
+class SizeIndex:
+	def __init__(self, filename):
+		"""
+		Open or create an on-disk size map, so that huge 'rclone ls' listings don't have to be
+		read into memory on every run. Looking up a file is a search of the primary key.
+		download.py reads the same database with client_download/source_files.py.
+		:param filename: path to a SQLite database
+		"""
+		self.filename = filename
+		self.connection = sqlite3.connect(filename)
+		self.connection.executescript("""
+			CREATE TABLE IF NOT EXISTS sizes (
+				path TEXT PRIMARY KEY,
+				size INTEGER NOT NULL
+			) WITHOUT ROWID;
+			CREATE TABLE IF NOT EXISTS meta (
+				key TEXT PRIMARY KEY,
+				value TEXT NOT NULL
+			);
+		""")
+
+	def __getstate__(self):
+		# The connection can't be pickled, so worker processes open their own
+		return {'filename': self.filename}
+
+	def __setstate__(self, state):
+		self.__init__(state['filename'])
+
+	def build(self, size_maps, logfile=sys.stderr):
+		"""
+		Compile size map files into the index, unless it was already built from the same files
+		:param size_maps: list of filenames in the format of 'rclone ls'
+		:param logfile: where to print progress
+		:return: whether the index was rebuilt
+		"""
+		listings_key = json.dumps([(x, os.stat(x).st_mtime_ns, os.stat(x).st_size)
+		                           for x in size_maps or []])
+		stored_key = self.connection.execute(
+			"SELECT value FROM meta WHERE key = 'listings'").fetchone()
+		if stored_key is not None and stored_key[0] == listings_key:
+			return False
+
+		print(f"Building size index {self.filename} from {len(size_maps or [])} listings",
+		      file=logfile)
+		with self.connection:
+			self.connection.execute('DELETE FROM sizes')
+			for filename in size_maps or []:
+				with open(filename, 'r') as file:
+					# Later listings replace earlier ones, like read_size_maps
+					self.connection.executemany('INSERT OR REPLACE INTO sizes VALUES (?, ?)',
+					                            parse_size_map(file))
+			self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('listings', ?)",
+			                        (listings_key,))
+		return True
+
+	def get(self, path, default=None):
+		"""
+		Look up the size of a file, like dict.get
+		:param path: path relative to the root of the listing
+		:param default: what to return if the file isn't listed
+		:return: size in bytes
+		"""
+		row = self.connection.execute('SELECT size FROM sizes WHERE path = ?', (path,)).fetchone()
+		return default if row is None else row[0]
+
+	def __len__(self):
+		return self.connection.execute('SELECT COUNT(*) FROM sizes').fetchone()[0]
+
+	def close(self):
+		self.connection.close()
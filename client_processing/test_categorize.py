@@ -0,0 +1,117 @@
+import copy
+import io
+import random
+
+import pytest
+
+import categorize
+from match_cache import MatchCache
+
+
+def video(website, video_id, title, date, duration, size=100000000):
+	return {'Server': 'S', 'Filename': f"{video_id}.mp4", 'Size': size, 'Website': website,
+	        'ID': video_id, 'Channel': 'Rooster Teeth', 'Title': title, 'Date': date,
+	        'Duration': duration, 'Subtitles': 0, 'Height': 1080, 'Group': '', 'Series': '',
+	        'Episode': '', 'Output Title': '', 'Part': '', 'Flag': '', 'Audio bitrate': None,
+	        'Video codec': 'avc1', 'Audio codec': 'mp4a.40.2'}
+
+
+def test_n_way_does_not_chain_episodes():
+	# Each video matches the next one, but the first and last don't match
+	videos = [video('youtube', 'yt500', 'Podcast #500', '20200101', 1000),
+	          video('RoosterTeeth', 'rt500', 'Podcast #500', '20200101', 1140),
+	          video('youtube', 'yt501', 'Podcast #501', '20200102', 1280)]
+	assert categorize.videos_match(videos[0], videos[1])
+	assert categorize.videos_match(videos[1], videos[2])
+	assert not categorize.videos_match(videos[0], videos[2])
+
+	assert categorize.cluster_videos(videos) == [[0, 1], [2]]
+	results = categorize.process_vidinfo(videos, set(), n_way=True)
+	results = {x['ID']: x for x in results}
+	assert results['yt501']['result'] == 'keep'
+	assert results['rt500']['yt_id'] == 'yt500'
+
+
+def test_n_way_marks_copies_that_all_match():
+	videos = [video('youtube', 'a', 'Podcast #500', '20200101', 1000, 200000000),
+	          video('youtube', 'b', 'Podcast #500', '20200101', 1000),
+	          video('youtube', 'c', 'Podcast #500', '20200102', 1000)]
+	results = {x['ID']: x for x in categorize.process_vidinfo(videos, set(), n_way=True)}
+	assert {x: y['result'] for x, y in results.items()} == \
+	       {'a': 'keep', 'b': 'duplicate', 'c': 'duplicate'}
+	assert results['b']['other_path'] == 'a.mp4'
+
+
+def random_videos(seed, count, days=10):
+	"""Videos with a few titles and durations repeated over a few days, so some of them match"""
+	rng = random.Random(seed)
+	videos = []
+	for i in range(count):
+		episode = rng.randint(1, 50)
+		title = f"{rng.choice(['Podcast', 'Lets Play', 'Off Topic'])} #{episode}"
+		duration = 600 + 60 * episode + rng.choice([0, 10, 200])
+		videos.append(video(rng.choice(['youtube', 'RoosterTeeth']), f"v{i}", title,
+		                    str(20200101 + rng.randrange(days)), duration,
+		                    rng.choice([None, 100000000, 200000000])))
+		videos[-1]['Height'] = rng.choice([720, 1080])
+		videos[-1]['Subtitles'] = rng.choice([0, 1])
+	return sorted(videos, key=lambda x: x['Date'])
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_stream_matches_batch(seed):
+	videos = random_videos(seed, 300)
+	batch = categorize.process_vidinfo(copy.deepcopy(videos), set())
+	stream = list(categorize.process_vidinfo_stream(copy.deepcopy(videos), set(), buffer_size=10))
+	assert sorted(stream, key=lambda x: x['original_row']) == \
+	       sorted(batch, key=lambda x: x['original_row'])
+
+
+def test_write_empty_output():
+	output = io.StringIO()
+	categorize.write_vidinfo(categorize.process_vidinfo_stream([], set()), output)
+	assert output.getvalue().splitlines() == [','.join(categorize.output_fieldnames(None))]
+
+
+@pytest.mark.parametrize('n_way', [False, True])
+def test_jobs_match_a_single_process(monkeypatch, n_way):
+	# Small partitions, so there are many boundaries between them
+	monkeypatch.setattr(categorize.partition_vidinfo, '__defaults__', (20,))
+	videos = random_videos(0, 600, days=40)
+	assert len(categorize.partition_vidinfo(videos)) > 10
+	single = categorize.process_vidinfo(copy.deepcopy(videos), set(), n_way=n_way)
+	parallel = categorize.process_vidinfo(copy.deepcopy(videos), set(), jobs=2, n_way=n_way)
+	assert parallel == single
+
+
+def edit_videos(rng, videos, run):
+	"""Add, remove and edit a few random videos"""
+	videos = copy.deepcopy(videos)
+	for i in range(rng.randint(1, 20)):
+		other = random_videos(rng.random(), 1, days=40)[0]
+		action = rng.choice(['add', 'remove', 'edit'])
+		if action == 'add':
+			videos.append(other | {'ID': f"new{run}-{i}", 'Filename': f"new{run}-{i}.mp4"})
+		elif action == 'remove':
+			videos.pop(rng.randrange(len(videos)))
+		else:
+			key = rng.choice(['Title', 'Duration', 'Size', 'Date', 'Height'])
+			rng.choice(videos)[key] = other[key]
+	return sorted(videos, key=lambda x: x['Date'])
+
+
+@pytest.mark.parametrize('seed,jobs', [(0, 1), (1, 1), (2, 1), (3, 2)])
+def test_cache_matches_a_full_run(tmp_path, monkeypatch, seed, jobs):
+	monkeypatch.setattr(categorize.partition_vidinfo, '__defaults__', (50,))
+	rng = random.Random(seed)
+	videos = random_videos(seed, 400, days=40)
+	cache = MatchCache(str(tmp_path / 'cache.sqlite'))
+	categorize.process_vidinfo(copy.deepcopy(videos), set(), cache=cache)
+	for run in range(4):
+		videos = edit_videos(rng, videos, run)
+		alive = {x['ID'] for x in videos if rng.random() < 0.2}
+		cached = categorize.process_vidinfo(copy.deepcopy(videos), alive, jobs=jobs, cache=cache)
+		full = categorize.process_vidinfo(copy.deepcopy(videos), alive)
+		assert sorted(cached, key=lambda x: x['original_row']) == \
+		       sorted(full, key=lambda x: x['original_row'])
+	cache.close()
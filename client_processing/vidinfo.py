@@ -1,10 +1,28 @@
 import argparse
+import concurrent.futures
 import csv
 import json
 import os
-import re
+import shutil
 import sys
 
+from path_trie import PathTrie
+from probe import ProbeCache, probe_vidinfo
+from size_index import SizeIndex, parse_size_map
+from vidinfo_index import VidinfoIndex
+from vidinfo_parquet import write_parquet_rows
+from watch import watch_changes
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+try:
+	import pyarrow
+except ImportError:
+	pyarrow = None
+
 
 class VideoMetadata:
 
@@ -13,8 +31,8 @@ class VideoMetadata:
 		Construct a VideoMetadata object from an info.json file
 		:param info: a dict resulting from decoding the info.json file
 		:param date_map: a dict like {"video_id": "YYYY-MM-DD"}
-		:param base_map: a list like [("/bucket", "Server 1")]
-		:param size_map: a dict like {"video1.mkv": 40186938}
+		:param base_map: a list like [("/bucket", "Server 1")], or a PathTrie of one
+		:param size_map: a dict like {"video1.mkv": 40186938}, or a SizeIndex
 		:param channel_map: a dict like {"video_id": "An Excellent Channel"}
 		"""
 		if date_map is None:
@@ -57,10 +75,11 @@ class VideoMetadata:
 			audio_format = downloaded_format
 			video_format = downloaded_format
 
+		formats = VideoMetadata.find_formats(info.get('formats', []), audio_format, video_format)
 		if audio_format is not None:
-			audio_format = [x for x in info.get('formats', []) if x['format_id'] == audio_format][0]
+			audio_format = formats[audio_format]
 		if video_format is not None:
-			video_format = [x for x in info.get('formats', []) if x['format_id'] == video_format][0]
+			video_format = formats[video_format]
 
 		# TODO: bitrate calculation is fucked up
 
@@ -105,11 +124,40 @@ class VideoMetadata:
 		            self.date, self.duration, self.subtitles, self.vcodec, self.height, self.vbr,
 		            self.fps, self.acodec, self.abr, self.bitrate)
 
+	@staticmethod
+	def find_formats(formats, *format_ids):
+		"""
+		Find formats by id in a single pass, stopping once they have all been found
+		:param formats: the formats list from an info.json file
+		:param format_ids: ids to find (None is ignored)
+		:return: a dict like {"137": {"format_id": "137", ...}} with the first format for each id
+		"""
+		wanted = set(format_ids) - {None}
+		results = {}
+		for video_format in formats:
+			format_id = video_format['format_id']
+			if format_id in wanted and format_id not in results:
+				results[format_id] = video_format
+				if len(results) == len(wanted):
+					break
+		return results
+
 	@staticmethod
 	def split_path(filename, base_map):
-		for basename, alias in base_map + [('/', '/')]:
-			if filename.startswith(basename):
-				return alias, filename.removeprefix(basename).removeprefix('/')
+		"""
+		Split a path into the server it's on and the path relative to the server, using the most
+		specific base directory that contains it
+		:param filename: path from an info.json file
+		:param base_map: a list like [("/bucket", "Server 1")], or a PathTrie of one
+		:return: a tuple like ("Server 1", "video1.mkv")
+		"""
+		if not isinstance(base_map, PathTrie):
+			base_map = PathTrie(base_map)
+		match = base_map.longest_prefix(filename)
+		if match:
+			return match
+		if filename.startswith('/'):
+			return '/', filename.removeprefix('/')
 		print(f"Didn't find a basename (not even /) in filename {filename}", file=sys.stderr)
 		return '', filename
 
@@ -137,9 +185,6 @@ def read_csv_maps(map_files):
 	return results
 
 
-size_map_pattern = re.compile(r'^\s*(\d+)\s+(.+)$')
-
-
 def read_size_maps(size_maps):
 	"""
 	Read all size map files and create a size map
@@ -149,13 +194,7 @@ def read_size_maps(size_maps):
 	results = {}
 	for filename in size_maps or []:
 		with open(filename, 'r') as file:
-			for line in file:
-				match = size_map_pattern.match(line)
-				if not match:
-					print(f"Warning! The following sizemap row is invalid and ignored:\n{line}\n",
-					      sys.stderr)
-				else:
-					results[match.group(2)] = int(match.group(1))
+			results.update(parse_size_map(file))
 	return results
 
 
@@ -178,29 +217,247 @@ def read_base_maps(base_maps):
 	return results
 
 
-def read_files(directory, logfile, excludes=None, date_map=None, base_map=None, channel_map=None,
-               size_map=None, dry_run=False):
-	if excludes is None:
-		excludes = []
-	videos = []
+def load_json(json_file):
+	"""
+	Decode an info.json file, using orjson if it is installed, since YouTube info.json files can be
+	hundreds of KB. orjson doesn't accept everything json does (like NaN), so fall back to json.
+	:param json_file: path to the file
+	:return: the decoded dict
+	"""
+	with open(json_file, 'rb') as f:
+		text = f.read()
+	if orjson:
+		try:
+			return orjson.loads(text)
+		except orjson.JSONDecodeError:
+			pass
+	return json.loads(text)
+
+
+def read_json_file(json_file, date_map=None, base_map=None, channel_map=None, size_map=None):
+	"""
+	Read an info.json file
+	:return: a tuple of values in the order of VideoMetadata.csv_header
+	"""
+	data = load_json(json_file)
+	return tuple(VideoMetadata(data, date_map=date_map, base_map=base_map,
+	                           channel_map=channel_map, size_map=size_map))
+
+
+# Maps used by worker processes, which are sent once per process rather than once per file
+_worker_maps = {}
+
+
+def _init_worker(maps):
+	_worker_maps.update(maps)
 
-	files = 0
 
+def _read_json_file_in_worker(json_file):
+	return read_json_file(json_file, **_worker_maps)
+
+
+def find_json_files(directory, excludes=None):
+	"""
+	Find info.json files in a directory
+	:param directory: the directory to search
+	:param excludes: names of subdirectories to skip
+	:return: sorted list of paths
+	"""
+	if excludes is None:
+		excludes = []
+	results = []
 	for dirpath, dirnames, filenames in os.walk(directory):
 		dirnames[:] = [dirname for dirname in dirnames if dirname not in excludes]
-		for json_file in [os.path.join(dirpath, file) for file in filenames if
-		                  file.endswith('.info.json')]:
-			files += 1
-			print(json_file, file=logfile)
-			if not dry_run:
-				with open(json_file) as f:
-					data = json.load(f)
-					videos.append(VideoMetadata(data, date_map=date_map, base_map=base_map,
-					                            channel_map=channel_map, size_map=size_map))
+		results += [os.path.join(dirpath, file) for file in filenames if
+		            file.endswith('.info.json')]
+	results.sort()
+	return results
 
-	print(f"Found {files} json files", file=logfile)
 
-	return videos
+def parse_files(json_files, jobs=1, **maps):
+	"""
+	Parse info.json files, optionally in a process pool
+	:param json_files: list of paths
+	:param jobs: number of worker processes to parse files with
+	:param maps: date_map, base_map, channel_map and size_map for VideoMetadata
+	:return: list of tuples of values in the order of VideoMetadata.csv_header
+	"""
+	if jobs > 1 and len(json_files) > 1:
+		with concurrent.futures.ProcessPoolExecutor(jobs, initializer=_init_worker,
+		                                            initargs=(maps,)) as executor:
+			return list(executor.map(_read_json_file_in_worker, json_files, chunksize=64))
+	return [read_json_file(json_file, **maps) for json_file in json_files]
+
+
+def read_files(directory, logfile, excludes=None, date_map=None, base_map=None, channel_map=None,
+               size_map=None, dry_run=False, jobs=1, index=None):
+	"""
+	Read all info.json files in a directory
+	:param jobs: number of worker processes to parse files with
+	:param index: VidinfoIndex of previously parsed files, which is updated (optional)
+	:return: list of tuples of values in the order of VideoMetadata.csv_header, sorted by path
+	"""
+	json_files = find_json_files(directory, excludes)
+	for json_file in json_files:
+		print(json_file, file=logfile)
+	print(f"Found {len(json_files)} json files", file=logfile)
+
+	if dry_run:
+		return []
+
+	maps = {'date_map': date_map, 'base_map': base_map, 'channel_map': channel_map,
+	        'size_map': size_map}
+	if not index:
+		return parse_files(json_files, jobs, **maps)
+
+	# Only parse files that are new or changed since they were indexed, or whose video's size
+	# has changed in the size maps
+	indexed_files = index.files()
+	stats = {}
+	for json_file in json_files:
+		stat = os.stat(json_file)
+		stats[json_file] = (stat.st_mtime_ns, stat.st_size)
+	unchanged_files = [x for x in json_files if indexed_files.get(x) == stats[x]]
+	rows = dict(zip(unchanged_files, index.rows(unchanged_files)))
+	resized_files = sizes_changed(rows, size_map)
+	changed_files = [x for x in json_files if x not in rows or x in resized_files]
+	removed_files = set(indexed_files).difference(stats)
+	print(f"Parsing {len(changed_files)} new or changed json files, of which "
+	      f"{len(resized_files)} have new sizes; removing {len(removed_files)} deleted json files "
+	      f"from the index", file=logfile)
+
+	parsed_rows = parse_files(changed_files, jobs, **maps)
+	index.update([(x, *stats[x], row) for x, row in zip(changed_files, parsed_rows)],
+	             removed_files)
+	rows.update(zip(changed_files, parsed_rows))
+	return [rows[x] for x in json_files]
+
+
+def sizes_changed(rows, size_map):
+	"""
+	Find rows whose size isn't the one in the size map any more. The size maps are listings that
+	are regenerated all the time, so instead of starting over whenever they change, only the rows
+	for videos whose size changed are parsed again.
+	:param rows: dict like {path: tuple of values in the order of VideoMetadata.csv_header}
+	:param size_map: a dict like {"video1.mkv": 40186938}, or a SizeIndex (optional)
+	:return: set of paths
+	"""
+	if size_map is None:
+		size_map = {}
+	filename_column = VideoMetadata.csv_header.index('Filename')
+	size_column = VideoMetadata.csv_header.index('Size')
+	return {path for path, row in rows.items()
+	        if size_map.get(row[filename_column], None) != row[size_column]}
+
+
+def parse_files_safely(json_files, logfile, jobs=1, **maps):
+	"""
+	Parse info.json files, skipping the ones that can't be parsed, such as files that are still
+	being written
+	:return: list of (path, tuple of values in the order of VideoMetadata.csv_header)
+	"""
+	try:
+		return list(zip(json_files, parse_files(json_files, jobs, **maps)))
+	except Exception:
+		results = []
+		for json_file in json_files:
+			try:
+				results.append((json_file, read_json_file(json_file, **maps)))
+			except Exception as ex:
+				print(f"Couldn't parse {json_file}, will try again when it changes: {ex!r}",
+				      file=logfile)
+		return results
+
+
+def watch_files(directory, logfile, on_update, excludes=None, interval=5.0, jobs=1, index=None,
+                process_rows=None, **maps):
+	"""
+	Read all info.json files in a directory, then keep reading the ones that are created or
+	changed, until interrupted
+	:param on_update: called with the list of all rows, sorted by path, whenever they change
+	:param interval: seconds to wait for more changes before calling on_update
+	:param index: VidinfoIndex of previously parsed files, which is updated (optional)
+	:param process_rows: function applied to lists of newly parsed rows (optional)
+	:param maps: date_map, base_map, channel_map and size_map for VideoMetadata
+	"""
+	if process_rows is None:
+		process_rows = list
+	stats = index.files() if index else {}
+	rows = dict(zip(stats, index.rows(list(stats)))) if index else {}
+	# Files whose video's size has changed are parsed again with the first complete listing
+	for json_file in sizes_changed(rows, maps.get('size_map')):
+		del stats[json_file]
+	rows = dict(zip(rows, process_rows(list(rows.values()))))
+
+	for paths, complete in watch_changes(directory, excludes, interval, logfile):
+		if complete:
+			# Anything not in a complete listing has been deleted
+			paths = paths.union(rows)
+		changed_files = []
+		removed_files = []
+		changed_stats = {}
+		for json_file in sorted(paths):
+			try:
+				stat = os.stat(json_file)
+			except FileNotFoundError:
+				if json_file in rows:
+					removed_files.append(json_file)
+				continue
+			changed_stats[json_file] = (stat.st_mtime_ns, stat.st_size)
+			if stats.get(json_file) != changed_stats[json_file]:
+				changed_files.append(json_file)
+
+		parsed = parse_files_safely(changed_files, logfile, jobs, **maps)
+		if not (parsed or removed_files or complete):
+			continue
+		parsed_files = [x for x, _ in parsed]
+		rows.update(zip(parsed_files, process_rows([row for _, row in parsed])))
+		stats.update((x, changed_stats[x]) for x in parsed_files)
+		for json_file in removed_files:
+			del rows[json_file]
+			stats.pop(json_file, None)
+		if index:
+			index.update([(x, *changed_stats[x], row) for x, row in parsed], removed_files)
+		print(f"Parsed {len(parsed)} new or changed json files; removed {len(removed_files)} "
+		      f"deleted json files; {len(rows)} videos", file=logfile)
+		on_update([rows[x] for x in sorted(rows)])
+
+
+def write_csv(vidinfo, file):
+	writer = csv.writer(file, dialect='excel', quoting=csv.QUOTE_ALL)
+	writer.writerow(VideoMetadata.csv_header)
+	writer.writerows(vidinfo)
+
+
+def replace_output(vidinfo, filename):
+	"""
+	Replace an output file (csv, or Parquet if it ends with .parquet) in one step, so that
+	programs reading it never see it half written
+	:param vidinfo: list of tuples of values in the order of VideoMetadata.csv_header
+	:param filename: path to the output file
+	"""
+	temporary_filename = f"{filename}.tmp"
+	if filename.endswith('.parquet'):
+		write_parquet(vidinfo, temporary_filename)
+	else:
+		with open(temporary_filename, 'w', newline='', encoding='utf-8') as file:
+			write_csv(vidinfo, file)
+	os.replace(temporary_filename, filename)
+
+
+# Columns that are otherwise added to the csv in a spreadsheet before categorize.py reads it
+spreadsheet_header = ["Group", "Series", "Episode", "Output Title", "Part", "Flag"]
+
+
+def write_parquet(vidinfo, filename):
+	"""
+	Write vidinfo rows to a Parquet file with typed columns. It also has the columns that are
+	otherwise added in a spreadsheet, all empty, so categorize.py can read it as it is.
+	:param vidinfo: list of tuples of values in the order of VideoMetadata.csv_header
+	:param filename: path to the output file
+	"""
+	write_parquet_rows((dict(zip(VideoMetadata.csv_header, row)) for row in vidinfo), filename,
+	                   VideoMetadata.csv_header + spreadsheet_header)
 
 
 if __name__ == "__main__":
@@ -211,8 +468,8 @@ if __name__ == "__main__":
 	                    action='store_true')
 	parser.add_argument('-x', '--exclude', help="files or directories to exclude from input",
 	                    action='append')
-	parser.add_argument('-o', '--output', help="output file", nargs='?',
-	                    type=argparse.FileType('w'), default=sys.stdout)
+	parser.add_argument('-o', '--output',
+	                    help="output file (Parquet if it ends with .parquet; default: stdout)")
 	parser.add_argument('-v', '--verbose', help="print all filenames", action='store_true')
 	parser.add_argument('-m', '--print-maps', help="print parsed maps", action='store_true')
 	parser.add_argument('-n', '--dry-run', help="list info.json files only (implies -vm)",
@@ -222,19 +479,59 @@ if __name__ == "__main__":
 	                    action='append')
 	parser.add_argument('--size-map', help="list of filesizes (in format of 'rclone ls')",
 	                    action='append')
+	parser.add_argument('--size-index',
+	                    help="SQLite file to compile the size maps into, so they are only read again "
+	                         "when they change and don't have to fit in memory")
 	parser.add_argument('--base-map', help="csv file mapping base directories to servers",
 	                    action='append')
-	# TODO: Allow appending to the output file
-	# TODO: Allow getting info from the video file
+	parser.add_argument('-j', '--jobs', help="number of worker processes to parse files with",
+	                    type=int, default=1)
+	parser.add_argument('-i', '--index',
+	                    help="SQLite file indexing parsed info.json files, so only new or changed "
+	                         "files are parsed on the next run")
+	parser.add_argument('-p', '--probe', metavar='SERVER=DIRECTORY', action='append',
+	                    help="get stream information from the video files on a server using "
+	                         "ffprobe, where the server's files are in a local directory (such as an "
+	                         "rclone mount)")
+	parser.add_argument('--probe-jobs', help="maximum number of ffprobe processes to run at once",
+	                    type=int, default=8)
+	parser.add_argument('--probe-cache',
+	                    help="SQLite file caching ffprobe results by path, modification time and "
+	                         "size, so each file is only probed once")
+	parser.add_argument('-w', '--watch', action='store_true',
+	                    help="keep running, and update the output file whenever info.json files are "
+	                         "created, changed or deleted")
+	parser.add_argument('--watch-interval', type=float, default=5.0,
+	                    help="seconds to wait for more changes before updating the output file "
+	                         "(or between scans, if inotify_simple isn't installed)")
 	args = parser.parse_args()
 
+	parquet_output = args.output is not None and args.output.endswith('.parquet')
+	if parquet_output and pyarrow is None:
+		parser.error("pyarrow must be installed to write Parquet files")
+	if args.watch and (args.dry_run or args.output is None):
+		parser.error("--watch needs an output file and can't be combined with -n")
+
+	probe_roots = {}
+	for probe in args.probe or []:
+		server, separator, directory = probe.partition('=')
+		if not separator:
+			parser.error(f"--probe must be in the format SERVER=DIRECTORY, not {probe}")
+		probe_roots[server] = directory
+	if probe_roots and shutil.which('ffprobe') is None:
+		parser.error("--probe needs ffprobe, which comes with ffmpeg")
+
 	dates = read_csv_maps(args.date_map)
 	channels = read_csv_maps(args.channel_map)
-	sizes = read_size_maps(args.size_map)
-	bases = read_base_maps(args.base_map)
+	if args.size_index:
+		sizes = SizeIndex(args.size_index)
+		sizes.build(args.size_map)
+	else:
+		sizes = read_size_maps(args.size_map)
+	bases = PathTrie(read_base_maps(args.base_map))
 
 	if args.dry_run or args.verbose:
-		if args.output == sys.stdout:
+		if args.output is None:
 			verbose_output = sys.stderr
 		else:
 			verbose_output = sys.stdout
@@ -244,17 +541,53 @@ if __name__ == "__main__":
 	if args.print_maps or args.dry_run:
 		print(f"Date map with {len(dates)} entries:\n{dates}\n", file=verbose_output)
 		print(f"Channel map with {len(channels)} entries:\n{channels}\n", file=verbose_output)
-		print(f"Size map with {len(sizes)} entries:\n{sizes}\n", file=verbose_output)
+		print(f"Size map with {len(sizes)} entries:\n"
+		      f"{sizes.filename if args.size_index else sizes}\n", file=verbose_output)
 		print(f"Base map with {len(bases)} entries:\n{bases}\n", file=verbose_output)
 
-	vidinfo = read_files(args.source, verbose_output, excludes=args.exclude, date_map=dates,
-	                     channel_map=channels, size_map=sizes, base_map=bases, dry_run=args.dry_run)
+	# The index has to be rebuilt if any of the maps change, except the size maps, which are
+	# checked row by row
+	map_files = [*(args.date_map or []), *(args.channel_map or []), *(args.base_map or [])]
+	maps_key = json.dumps([(x, os.stat(x).st_mtime_ns, os.stat(x).st_size) for x in map_files])
+	index = VidinfoIndex(args.index, maps_key) if args.index and not args.dry_run else None
+
+	probe_cache = ProbeCache(args.probe_cache) if probe_roots and args.probe_cache else None
+
+	def probe_rows(rows):
+		if not probe_roots:
+			return rows
+		return probe_vidinfo(rows, probe_roots, VideoMetadata.csv_header, args.probe_jobs,
+		                     probe_cache, verbose_output)
+
+	if args.watch:
+		try:
+			watch_files(args.source, verbose_output,
+			            lambda rows: replace_output(rows, args.output),
+			            excludes=args.exclude, interval=args.watch_interval, jobs=args.jobs,
+			            index=index, process_rows=probe_rows, date_map=dates,
+			            channel_map=channels, size_map=sizes, base_map=bases)
+		except KeyboardInterrupt:
+			pass
+	else:
+		vidinfo = read_files(args.source, verbose_output, excludes=args.exclude, date_map=dates,
+		                     channel_map=channels, size_map=sizes, base_map=bases,
+		                     dry_run=args.dry_run, jobs=args.jobs, index=index)
+		if not args.dry_run:
+			vidinfo = probe_rows(vidinfo)
+			print(f"Found {len(vidinfo)} videos", file=verbose_output)
+			if parquet_output:
+				write_parquet(vidinfo, args.output)
+			elif args.output:
+				with open(args.output, 'w', newline='', encoding='utf-8') as output_file:
+					write_csv(vidinfo, output_file)
+			else:
+				write_csv(vidinfo, sys.stdout)
 
-	if not args.dry_run:
-		print(f"Found {len(vidinfo)} videos", file=verbose_output)
-		writer = csv.writer(args.output, dialect='excel', quoting=csv.QUOTE_ALL)
-		writer.writerow(VideoMetadata.csv_header)
-		writer.writerows(vidinfo)
+	if index:
+		index.close()
+	if args.size_index:
+		sizes.close()
+	if probe_cache:
+		probe_cache.close()
 
-	args.output.close()
 	verbose_output.close()
@@ -0,0 +1,64 @@
+import json
+import sqlite3
+
+
+class VidinfoIndex:
+	def __init__(self, filename, maps_key=''):
+		"""
+		Open or create an index of parsed info.json files
+		:param filename: path to a SQLite database
+		:param maps_key: identifies the maps the rows were made with; if it differs from the one
+		stored in the index, the index is cleared
+		"""
+		self.connection = sqlite3.connect(filename)
+		self.connection.executescript("""
+			CREATE TABLE IF NOT EXISTS files (
+				path TEXT PRIMARY KEY,
+				mtime INTEGER NOT NULL,
+				size INTEGER NOT NULL,
+				row TEXT NOT NULL
+			);
+			CREATE TABLE IF NOT EXISTS meta (
+				key TEXT PRIMARY KEY,
+				value TEXT NOT NULL
+			);
+		""")
+		stored_key = self.connection.execute(
+			"SELECT value FROM meta WHERE key = 'maps'").fetchone()
+		if stored_key is None or stored_key[0] != maps_key:
+			with self.connection:
+				self.connection.execute('DELETE FROM files')
+				self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('maps', ?)",
+				                        (maps_key,))
+
+	def files(self):
+		"""
+		:return: a dict like {path: (mtime in ns, size in bytes)}
+		"""
+		return {path: (mtime, size) for path, mtime, size in
+		        self.connection.execute('SELECT path, mtime, size FROM files')}
+
+	def rows(self, paths):
+		"""
+		Get the rows for the given files
+		:param paths: list of paths
+		:return: list of tuples of values in the order of VideoMetadata.csv_header
+		"""
+		rows = dict(self.connection.execute('SELECT path, row FROM files'))
+		return [tuple(json.loads(rows[path])) for path in paths]
+
+	def update(self, rows, removed):
+		"""
+		Add or replace rows and remove deleted files
+		:param rows: list of (path, mtime in ns, size in bytes, row)
+		:param removed: list of paths of files that no longer exist
+		"""
+		with self.connection:
+			self.connection.executemany(
+				'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+				[(path, mtime, size, json.dumps(row)) for path, mtime, size, row in rows])
+			self.connection.executemany('DELETE FROM files WHERE path = ?',
+			                            [(path,) for path in removed])
+
+	def close(self):
+		self.connection.close()
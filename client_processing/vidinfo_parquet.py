@@ -0,0 +1,137 @@
+import itertools
+import locale
+
+try:
+	import pyarrow
+	import pyarrow.parquet
+except ImportError:
+	pyarrow = None
+
+# Columns of vidinfo files (as written by vidinfo.py and categorize.py) that hold numbers or
+# booleans; the rest are strings. client_download/source_files.py reads these files too, so keep
+# it in sync.
+integer_columns = {'Size', 'Subtitles', 'Height', 'original_row'}
+float_columns = {'Duration', 'Video bitrate', 'FPS', 'Audio bitrate', 'Total bitrate'}
+boolean_columns = {'alive'}
+typed_columns = integer_columns | float_columns | boolean_columns
+
+
+def parquet_schema(columns):
+	"""
+	:param columns: names of the columns, in order
+	:return: pyarrow schema with the numbers and booleans typed, so they don't have to be parsed
+	from strings by other programs reading the file
+	"""
+	def column_type(column):
+		if column in integer_columns:
+			return pyarrow.int64()
+		if column in float_columns:
+			return pyarrow.float64()
+		if column in boolean_columns:
+			return pyarrow.bool_()
+		return pyarrow.string()
+
+	return pyarrow.schema([(x, column_type(x)) for x in columns])
+
+
+def parse_value(column, value):
+	"""
+	Convert a value from a csv vidinfo file to the type of its column
+	:param column: name of the column
+	:param value: the value as a string
+	:return: the value as an int, float or bool for those columns (None if it's empty), otherwise
+	the string
+	"""
+	if column not in typed_columns:
+		return value
+	value = value.strip()
+	if not value:
+		return None
+	if column in boolean_columns:
+		return value == 'True'
+	if column in integer_columns:
+		# Sizes in csv files edited in a spreadsheet can have thousands separators
+		for separator in {',', locale.localeconv()['thousands_sep']} - {''}:
+			value = value.replace(separator, '')
+		return int(value)
+	return number(float(value))
+
+
+def parse_row(row):
+	"""
+	Convert the numbers and booleans in a row read from a csv vidinfo file, so the row has the same
+	types as one read from a Parquet file
+	:param row: dict of strings, as read by csv.DictReader
+	:return: the same dict
+	"""
+	for column, value in row.items():
+		if isinstance(value, str):
+			row[column] = parse_value(column, value)
+	return row
+
+
+def number(value):
+	"""
+	Numbers like durations are stored as floats, but they're usually whole, and then they're
+	integers, so they're written to csv files the same way they were read
+	"""
+	return int(value) if isinstance(value, float) and value.is_integer() else value
+
+
+def parquet_value(value, column_type):
+	"""
+	Convert a value from a vidinfo row to the type of its Parquet column
+	:param value: the value, which can still be a string; empty values are null
+	:param column_type: pyarrow type of the column
+	:return: the converted value
+	"""
+	if value is None or value == '':
+		return None
+	if column_type == pyarrow.string():
+		return str(value)
+	if column_type == pyarrow.bool_():
+		return value == 'True' if isinstance(value, str) else bool(value)
+	if isinstance(value, str):
+		# Sizes in csv files edited in a spreadsheet can have thousands separators
+		value = value.strip().replace(',', '')
+	return int(value) if column_type == pyarrow.int64() else float(value)
+
+
+def write_parquet_rows(rows, filename, columns, batch_size=10000):
+	"""
+	Write vidinfo rows to a Parquet file with typed columns, one batch at a time
+	:param rows: iterable of dicts representing vidinfo rows; missing values are null
+	:param filename: path to the output file
+	:param columns: names of the columns, in order
+	:param batch_size: number of rows to hold in memory
+	"""
+	if pyarrow is None:
+		raise ImportError(f"pyarrow must be installed to write {filename}")
+	schema = parquet_schema(columns)
+	rows = iter(rows)
+	with pyarrow.parquet.ParquetWriter(filename, schema) as writer:
+		while batch := list(itertools.islice(rows, batch_size)):
+			writer.write_table(pyarrow.Table.from_arrays(
+				[[parquet_value(row.get(field.name), field.type) for row in batch]
+				 for field in schema], schema=schema))
+
+
+def iter_parquet_rows(filename, columns=None):
+	"""
+	Read a Parquet vidinfo file one batch of rows at a time
+	:param filename: path to the vidinfo file
+	:param columns: names of the columns to read (default: all of them)
+	:return: generator of dicts representing vidinfo rows, with numbers and booleans like
+	parse_row, and empty strings for missing text
+	"""
+	if pyarrow is None:
+		raise ImportError(f"pyarrow must be installed to read {filename}")
+	parquet_file = pyarrow.parquet.ParquetFile(filename)
+	for expected_key in columns or []:
+		if expected_key not in parquet_file.schema_arrow.names:
+			raise ValueError(f"Did not find key {expected_key} in vidinfo file. "
+			                 f"columns: {parquet_file.schema_arrow.names}")
+	for batch in parquet_file.iter_batches(columns=columns):
+		for video in batch.to_pylist():
+			yield {key: number(value) if value is not None else None if key in typed_columns else ''
+			       for key, value in video.items()}
@@ -0,0 +1,133 @@
+import os
+import sys
+import time
+
+try:
+	import inotify_simple
+except ImportError:
+	inotify_simple = None
+
+
+def _walk(directory, excludes):
+	for dirpath, dirnames, filenames in os.walk(directory):
+		dirnames[:] = [dirname for dirname in dirnames if dirname not in excludes]
+		yield dirpath, filenames
+
+
+def poll_changes(directory, excludes=(), interval=5.0, suffix='.info.json'):
+	"""
+	Watch a directory tree for files being created, changed or deleted by scanning it repeatedly
+	:param directory: the directory to watch
+	:param excludes: names of subdirectories to skip
+	:param interval: seconds to wait between scans
+	:param suffix: only files with names ending in this are watched
+	:return: generator of (set of paths, whether the set is every file in the tree). The first
+	set is every file in the tree.
+	"""
+	previous = None
+	while True:
+		current = {}
+		for dirpath, filenames in _walk(directory, excludes):
+			for filename in filenames:
+				if filename.endswith(suffix):
+					path = os.path.join(dirpath, filename)
+					try:
+						stat = os.stat(path)
+					except FileNotFoundError:
+						continue
+					current[path] = (stat.st_mtime_ns, stat.st_size)
+		if previous is None:
+			yield set(current), True
+		else:
+			changed = {path for path, stat in current.items() if previous.get(path) != stat}
+			changed.update(set(previous).difference(current))
+			if changed:
+				yield changed, False
+		previous = current
+		time.sleep(interval)
+
+
+def inotify_changes(directory, excludes=(), interval=5.0, suffix='.info.json'):
+	"""
+	Watch a directory tree for files being created, changed or deleted using inotify
+	:param directory: the directory to watch
+	:param excludes: names of subdirectories to skip
+	:param interval: seconds to wait for more events after one arrives, so files written in a
+	batch are handled together
+	:param suffix: only files with names ending in this are watched
+	:return: generator of (set of paths, whether the set is every file in the tree). The first
+	set is every file in the tree.
+	"""
+	flags = inotify_simple.flags
+	mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM | flags.CREATE | flags.DELETE
+	inotify = inotify_simple.INotify()
+	directories = {}  # watch descriptor -> path
+
+	def add_tree(root):
+		# Each directory is watched before it's listed, so no file can be missed in between
+		found = set()
+		pending = [root]
+		while pending:
+			dirpath = pending.pop()
+			try:
+				directories[inotify.add_watch(dirpath, mask)] = dirpath
+				entries = list(os.scandir(dirpath))
+			except OSError:
+				continue  # deleted since its parent was listed
+			for entry in entries:
+				if entry.is_dir(follow_symlinks=False):
+					if entry.name not in excludes:
+						pending.append(entry.path)
+				elif entry.name.endswith(suffix):
+					found.add(entry.path)
+		return found
+
+	def remove_tree(root):
+		for descriptor, path in list(directories.items()):
+			if path == root or path.startswith(root + os.sep):
+				try:
+					inotify.rm_watch(descriptor)
+				except OSError:
+					pass
+				del directories[descriptor]
+
+	yield add_tree(directory), True
+	while True:
+		changed = set()
+		rescan = False
+		for event in inotify.read(read_delay=interval * 1000):
+			if event.mask & flags.Q_OVERFLOW:
+				rescan = True
+			elif event.mask & flags.IGNORED:
+				directories.pop(event.wd, None)
+			elif event.wd in directories:
+				path = os.path.join(directories[event.wd], event.name)
+				if not event.mask & flags.ISDIR:
+					# A created file will have a CLOSE_WRITE event once it's been written
+					if event.name.endswith(suffix) and not event.mask & flags.CREATE:
+						changed.add(path)
+				elif event.name in excludes:
+					continue
+				elif event.mask & (flags.CREATE | flags.MOVED_TO):
+					changed.update(add_tree(path))
+				elif event.mask & flags.MOVED_FROM:
+					# The files in it are gone, but there are no events for them
+					remove_tree(path)
+					rescan = True
+		if rescan:
+			yield add_tree(directory), True
+		elif changed:
+			yield changed, False
+
+
+def watch_changes(directory, excludes=None, interval=5.0, logfile=sys.stderr):
+	"""
+	Watch a directory tree for info.json files being created, changed or deleted, using inotify
+	if inotify_simple is installed, or scanning the tree repeatedly if not
+	:return: generator like poll_changes
+	"""
+	if inotify_simple is not None and sys.platform.startswith('linux'):
+		return inotify_changes(directory, excludes or (), interval)
+	print(f"inotify_simple isn't installed; scanning {directory} every {interval} seconds",
+	      file=logfile)
+	return poll_changes(directory, excludes or (), interval)